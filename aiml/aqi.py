@@ -0,0 +1,97 @@
+"""
+Air Quality Index
+Indian (CPCB) National AQI computed with NumPy from OpenWeather pollutant readings
+"""
+
+import numpy as np
+
+# Sub-index breakpoints per pollutant, keyed by OpenWeather component name.
+# Concentrations are in μg/m³ as OpenWeather reports them (CO too, so the
+# CPCB mg/m³ limits are multiplied by 1000). Each band's upper limit is the
+# next band's lower limit, so readings such as PM2.5=30.5 interpolate between
+# 50 and 51 instead of falling into a gap. CPCB leaves the Severe band open;
+# it is extended with the slope of the band below and capped at 500.
+AQI_LEVELS = np.array([0, 50, 100, 200, 300, 400, 500], dtype=float)
+BREAKPOINTS = {
+    'pm2_5': [0, 30, 60, 90, 120, 250, 380],
+    'pm10': [0, 50, 100, 250, 350, 430, 510],
+    'no2': [0, 40, 80, 180, 280, 400, 520],
+    'o3': [0, 50, 100, 168, 208, 748, 1028],
+    'co': [0, 1000, 2000, 10000, 17000, 34000, 51000],
+    'so2': [0, 40, 80, 380, 800, 1600, 2400],
+    'nh3': [0, 200, 400, 800, 1200, 1800, 2400],
+}
+POLLUTANTS = tuple(BREAKPOINTS)
+
+CATEGORIES = np.array(['Good', 'Satisfactory', 'Moderate', 'Poor', 'Very Poor', 'Severe'])
+CATEGORY_LIMITS = AQI_LEVELS[1:-1]  # upper AQI of every category but Severe
+
+
+def sub_index(pollutant, concentrations):
+    """CPCB sub-index for an array of concentrations (NaN stays NaN)"""
+    c = np.asarray(concentrations, dtype=float)
+    knots = np.asarray(BREAKPOINTS[pollutant], dtype=float)
+    index = np.interp(c.ravel(), knots, AQI_LEVELS, right=AQI_LEVELS[-1]).reshape(c.shape)
+    return np.where(np.isnan(c), np.nan, index)
+
+
+def category(aqi):
+    """Category name(s) for AQI value(s)"""
+    return CATEGORIES[np.searchsorted(CATEGORY_LIMITS, np.asarray(aqi), side='left')]
+
+
+def compute_aqi(readings):
+    """Overall AQI for whole arrays of readings in one call
+
+    readings maps OpenWeather component names ('pm2_5', 'pm10', 'no2', ...)
+    to arrays of equal shape, e.g. one value per city or per timestamp.
+    Missing pollutants and NaN readings are ignored. Returns a dict of arrays
+    of that shape: 'aqi' (int, -1 where no pollutant was available),
+    'dominant' (the pollutant with the highest sub-index), 'category' and
+    'sub_indices' per pollutant.
+
+    CPCB's official index uses 24-hour (8-hour for CO and O3) averages; fed
+    with instantaneous readings this gives the same "current AQI" the
+    OpenWeather-based lookups have always shown.
+    """
+    names = [p for p in POLLUTANTS if p in readings]
+    if not names:
+        raise ValueError(f'readings must contain at least one of {", ".join(POLLUTANTS)}')
+
+    subs = np.stack([sub_index(p, readings[p]) for p in names])
+    available = ~np.isnan(subs)
+    filled = np.where(available, subs, -1.0)
+    top = filled.argmax(axis=0)
+    best = np.take_along_axis(filled, top[None], axis=0)[0]
+    aqi = np.where(available.any(axis=0), np.rint(best), -1).astype(int)
+
+    return {
+        'aqi': aqi,
+        'dominant': np.array(names)[top],
+        'category': category(aqi),
+        'sub_indices': dict(zip(names, subs)),
+    }
+
+
+def aqi_from_components(components):
+    """AQI summary for one OpenWeather 'components' dict, or None without data
+
+    This is the liveData['aqi'] block served by every entry point.
+    """
+    result = compute_aqi({p: components.get(p, np.nan) for p in POLLUTANTS})
+    aqi = int(result['aqi'])
+    if aqi < 0:
+        return None
+
+    return {
+        'aqi': aqi,
+        'category': str(result['category']),
+        'dominant': str(result['dominant']),
+        'pm25': components.get('pm2_5', 0),
+        'pm10': components.get('pm10', 0),
+        'no2': components.get('no2', 0),
+        'co': components.get('co', 0),
+        'o3': components.get('o3', 0),
+        'so2': components.get('so2', 0),
+        'sub_indices': {p: int(np.rint(v)) for p, v in result['sub_indices'].items() if not np.isnan(v)},
+    }
@@ -0,0 +1,458 @@
+"""
+Weather Prediction ASGI Server
+Async serving mode with the same endpoints as weather_server.py, without a thread per open request
+"""
+
+import os
+import json
+import asyncio
+import contextlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+import http_client
+import weather_server as ws
+from retrieval import afetch_all
+from router import OPEN
+from metrics import CONTENT_TYPE
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+# Configuration (the rest is shared with weather_server.py)
+INFERENCE_THREADS = int(os.getenv('INFERENCE_THREADS', '2'))
+
+# Model loading and tokenization run here instead of on the event loop;
+# the forward passes themselves run on the batching thread
+INFERENCE = ThreadPoolExecutor(max_workers=INFERENCE_THREADS, thread_name_prefix='inference')
+
+
+async def in_inference(fn, *args):
+    """Run a blocking model call on the inference executor"""
+    return await asyncio.get_running_loop().run_in_executor(INFERENCE, fn, *args)
+
+
+async def fetch_upstream(stage, provider, url, parse, timeout=10):
+    """GET url without blocking and parse the JSON body, or None on any failure"""
+    try:
+        with ws.STAGE_SECONDS.time(stage=stage):
+            r = await http_client.aget(provider, url, timeout=timeout)
+
+        if r.status_code == 200:
+            return parse(r.json())
+    except Exception:
+        pass
+
+    return None
+
+
+async def cached_live(key, fetch):
+    """weather_server.cached_live() for a coroutine function fetch"""
+    return await ws.live_cache.aget_or_fetch(key, fetch, stale=ws.refreshed(key))
+
+
+async def get_live_aqi(city):
+    place = ws.GAZETTEER.get(city)
+    if place is None:
+        return None
+
+    return await cached_live((place.key, 'aqi'),
+                             lambda: fetch_upstream('openweather_aqi', 'openweather', ws.aqi_url(place), ws.parse_aqi))
+
+
+async def get_live_weather(city):
+    place = ws.GAZETTEER.get(city)
+    if place is None:
+        return None
+
+    return await cached_live((place.key, 'weather'),
+                             lambda: fetch_upstream('openweather_weather', 'openweather', ws.weather_url(place), ws.parse_weather))
+
+
+async def get_weather_forecast(city, days=5):
+    place = ws.GAZETTEER.get(city)
+    if place is None:
+        return None
+
+    # Not refreshed in the background, so never served past its TTL
+    fetch = lambda: fetch_upstream('openweather_forecast', 'openweather', ws.forecast_url(place),
+                                   lambda data: ws.parse_forecast(data, days))
+    return await ws.live_cache.aget_or_fetch((place.key, 'forecast', days), fetch)
+
+
+async def search_internet(query):
+    return await fetch_upstream('serpapi', 'serpapi', ws.search_url(query), ws.parse_search, timeout=15)
+
+
+# Async versions of weather_server.LOOKUPS
+LOOKUPS = {
+    'aqi': get_live_aqi,
+    'weather': get_live_weather,
+    'forecast': get_weather_forecast,
+    'web_search': search_internet,
+}
+
+
+async def run_lookups(lookups):
+    """weather_server.run_lookups() on the event loop"""
+    coros = {name: LOOKUPS[name](arg) for name, arg in lookups.items()}
+    with ws.STAGE_SECONDS.time(stage='retrieval'):
+        return await afetch_all(coros, ws.RETRIEVAL_DEADLINE)
+
+
+async def fast_answer(query):
+    """weather_server.fast_answer() with non-blocking lookups"""
+    started_at = time.perf_counter()
+    plan = ws.plan_route(query)
+    results, sources = await run_lookups(plan[-1]) if plan[-1] else ({}, {})
+    return ws.finish_route(query, plan, results, sources, started_at)
+
+
+async def retrieve_context(prompt):
+    """weather_server.retrieve_context() with non-blocking lookups"""
+    detected_city, lookups = ws.plan_retrieval(prompt)
+    results, sources = await run_lookups(lookups)
+    context, live_data = ws.build_context(detected_city, results, sources)
+
+    return context, live_data, sources
+
+
+async def generate_response(prompt, context, live_data, on_text=None, stop=None, deadline=None):
+    """Run the model on the RAG prompt and return (answer text, finish reason)
+
+    stop and deadline are as for weather_server.generate_response().
+    Tokens are decoded on the batching thread as they land; on_text, if
+    given, is called on the event loop with every new piece of text.
+    Cancelling the coroutine frees the request's batch slot.
+    """
+    from tokenization import IncrementalDecoder
+
+    ids, prefix_len = await in_inference(ws.encode_prompt, prompt, context)
+
+    loop = asyncio.get_running_loop()
+    decoder = IncrementalDecoder(ws.tokenizer)
+    detokenize = [0.0]
+
+    def on_token(token):
+        start = time.perf_counter()
+        text = decoder.push(token)
+        detokenize[0] += time.perf_counter() - start
+        if text and on_text is not None:
+            loop.call_soon_threadsafe(on_text, text)
+
+    future = ws.scheduler.submit(ids, ws.MAX_TOKENS, ws.TEMPERATURE, on_token=on_token, prefix_len=prefix_len,
+                                 prefix_tag=live_data.get('city', '').lower(),
+                                 stop=ws.prompt_encoder.stop_ids(ws.STOP_SEQUENCES if stop is None else stop),
+                                 deadline=deadline)
+    try:
+        _, stats = await asyncio.wrap_future(future)
+    finally:
+        future.cancel()
+
+    ws.observe_generation(stats, detokenize[0])
+    print(f'⚡ Generated {stats["new_tokens"]} tokens ({stats["ms_per_token"]:.1f} ms/token, queued {stats["queue_ms"]:.0f} ms, '
+          f'{stats["prefix_tokens"]} prefix tokens reused, {stats["finish_reason"]})')
+
+    return decoder.response(), stats['finish_reason']
+
+
+async def rag_generate(prompt, bypass_cache=False, stop=None, deadline_ms=None, started_at=None):
+    """weather_server.rag_generate(); identical queries share one generation"""
+    deadline = ws.generation_deadline(deadline_ms, started_at)
+    context, live_data, sources = await retrieve_context(prompt)
+
+    if ws.response_cache is None or stop is not None or deadline_ms is not None:
+        response, finish_reason = await generate_response(prompt, context, live_data, stop=stop, deadline=deadline)
+        return response, live_data, sources, False, finish_reason
+
+    key = ws.response_key(prompt, context, live_data)
+    if bypass_cache:
+        ws.response_cache.invalidate(key)
+
+    finished = []
+
+    async def fetch():
+        response, finish_reason = await generate_response(prompt, context, live_data, deadline=deadline)
+        finished.append(finish_reason)
+        return response
+
+    response = await ws.response_cache.aget_or_fetch(key, fetch)
+    if finished == ['deadline']:
+        ws.response_cache.invalidate(key)
+
+    return response, live_data, sources, not finished, finished[0] if finished else None
+
+
+async def read_json(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def wants_fresh(request, data):
+    """Per-request response cache bypass: {"bypassCache": true} or Cache-Control: no-cache"""
+    return bool(data.get('bypassCache')) or 'no-cache' in request.headers.get('cache-control', '')
+
+
+async def predict(request):
+    """Prediction endpoint"""
+    started_at = time.perf_counter()
+    try:
+        data = await read_json(request)
+        query = data.get('query', '')
+
+        if not query:
+            return JSONResponse({'error': 'No query provided', 'success': False}, status_code=400)
+
+        from tokenization import generation_options
+
+        try:
+            stop, deadline_ms = generation_options(data)
+        except ValueError as e:
+            return JSONResponse({'error': str(e), 'success': False}, status_code=400)
+
+        # Data lookups and forecasts are answered from live data alone
+        fast = await fast_answer(query)
+        if fast is not None:
+            response, live_data, sources, route, forecast = fast
+            cached = False
+            finish_reason = None
+        else:
+            response, live_data, sources, cached, finish_reason = await rag_generate(
+                query, bypass_cache=wants_fresh(request, data), stop=stop, deadline_ms=deadline_ms, started_at=started_at)
+            response = ws.format_live_data(response, live_data)
+            route = OPEN
+            forecast = None
+
+        with ws.STAGE_SECONDS.time(stage='serialize'):
+            return JSONResponse({
+                'success': True,
+                'response': response,
+                'liveData': live_data,
+                'sources': sources,
+                'cached': cached,
+                'route': route,
+                'forecast': forecast,
+                'finishReason': finish_reason
+            })
+
+    except Exception as e:
+        print(f'❌ Error: {e}')
+        return JSONResponse({'error': str(e), 'success': False}, status_code=500)
+
+
+async def predict_stream(request):
+    """Streaming prediction endpoint; same newline-delimited JSON events as weather_server.py"""
+    started_at = time.perf_counter()
+    data = await read_json(request)
+    query = data.get('query', '')
+
+    if not query:
+        return JSONResponse({'error': 'No query provided', 'success': False}, status_code=400)
+
+    from tokenization import generation_options
+
+    try:
+        stop, deadline_ms = generation_options(data)
+    except ValueError as e:
+        return JSONResponse({'error': str(e), 'success': False}, status_code=400)
+
+    bypass_cache = wants_fresh(request, data)
+    custom = stop is not None or deadline_ms is not None
+    deadline = ws.generation_deadline(deadline_ms, started_at)
+
+    async def events():
+        task = None
+        try:
+            fast = await fast_answer(query)
+            if fast is not None:
+                response, live_data, sources, route, forecast = fast
+                yield json.dumps({'type': 'liveData', 'liveData': live_data, 'sources': sources}) + '\n'
+                yield json.dumps({'type': 'token', 'text': response}) + '\n'
+                yield json.dumps({
+                    'type': 'done',
+                    'success': True,
+                    'response': response,
+                    'liveData': live_data,
+                    'sources': sources,
+                    'cached': False,
+                    'route': route,
+                    'forecast': forecast,
+                    'finishReason': None
+                }) + '\n'
+                return
+
+            context, live_data, sources = await retrieve_context(query)
+            yield json.dumps({'type': 'liveData', 'liveData': live_data, 'sources': sources}) + '\n'
+
+            key = ws.response_key(query, context, live_data) if ws.response_cache is not None and not custom else None
+            response = ws.response_cache.get(key) if key and not bypass_cache else None
+            if response is not None:
+                yield json.dumps({'type': 'token', 'text': response}) + '\n'
+                yield json.dumps({
+                    'type': 'done',
+                    'success': True,
+                    'response': ws.format_live_data(response, live_data),
+                    'liveData': live_data,
+                    'sources': sources,
+                    'cached': True,
+                    'route': OPEN,
+                    'forecast': None,
+                    'finishReason': None
+                }) + '\n'
+                return
+
+            texts = asyncio.Queue()
+            task = asyncio.ensure_future(generate_response(query, context, live_data, on_text=texts.put_nowait,
+                                                           stop=stop, deadline=deadline))
+            task.add_done_callback(lambda _: texts.put_nowait(None))
+
+            sent = False
+            while True:
+                text = await texts.get()
+                if text is None:
+                    break
+                if not sent:
+                    text = text.lstrip()
+                if text:
+                    yield json.dumps({'type': 'token', 'text': text}) + '\n'
+                    sent = True
+
+            response, finish_reason = task.result()
+            if key and finish_reason != 'deadline':
+                ws.response_cache.put(key, response)
+
+            yield json.dumps({
+                'type': 'done',
+                'success': True,
+                'response': ws.format_live_data(response, live_data),
+                'liveData': live_data,
+                'sources': sources,
+                'cached': False,
+                'route': OPEN,
+                'forecast': None,
+                'finishReason': finish_reason
+            }) + '\n'
+
+        except Exception as e:
+            print(f'❌ Error: {e}')
+            yield json.dumps({'type': 'error', 'error': str(e), 'success': False}) + '\n'
+
+        finally:
+            # Client went away or we finished: free the batch slot
+            if task is not None:
+                task.cancel()
+
+    return StreamingResponse(events(), media_type='application/x-ndjson',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+async def snapshot(request):
+    """Live AQI and weather for the featured cities, ?cities=delhi,pune or the city nearest ?lat=&lon="""
+    try:
+        try:
+            cities, nearest = ws.snapshot_cities(request.query_params)
+        except ValueError as e:
+            return JSONResponse({'error': str(e), 'success': False}, status_code=400)
+
+        lookups = ws.snapshot_lookups(cities)
+        coros = {name: LOOKUPS[kind](city) for name, (kind, city) in lookups.items()}
+        results, sources = await afetch_all(coros, ws.RETRIEVAL_DEADLINE)
+
+        result = {
+            'success': True,
+            'generatedAt': ws.iso_time(time.time()),
+            'cities': ws.build_snapshot(cities, results, sources)
+        }
+        if nearest:
+            result['nearest'] = nearest
+
+        return JSONResponse(result)
+
+    except Exception as e:
+        print(f'❌ Error: {e}')
+        return JSONResponse({'error': str(e), 'success': False}, status_code=500)
+
+
+async def metrics_endpoint(request):
+    """Prometheus metrics: per-stage latency histograms, token counts, cache hit rates"""
+    return Response(ws.metrics.render(), headers={'Content-Type': CONTENT_TYPE})
+
+
+async def health(request):
+    """Health check endpoint"""
+    report = ws.health_report()
+    report['server'] = {'mode': 'asgi', 'inference_threads': INFERENCE_THREADS}
+    return JSONResponse(report)
+
+
+routes = [
+    Route('/predict', predict, methods=['POST'], name='predict'),
+    Route('/predict/stream', predict_stream, methods=['POST'], name='predict_stream'),
+    Route('/snapshot', snapshot, methods=['GET'], name='snapshot'),
+    Route('/metrics', metrics_endpoint, methods=['GET'], name='metrics'),
+    Route('/health', health, methods=['GET'], name='health'),
+]
+ENDPOINTS = {route.path: route.name for route in routes}
+
+
+class RequestMetrics:
+    """Request count, latency and in-flight gauge per endpoint
+
+    Plain ASGI middleware, so a streamed response is timed until its last
+    chunk has been sent.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        endpoint = ENDPOINTS.get(scope['path'], 'unknown')
+        status = [500]
+
+        async def send_with_status(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+
+        started_at = time.perf_counter()
+        ws.IN_FLIGHT.inc(endpoint=endpoint)
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            ws.IN_FLIGHT.dec(endpoint=endpoint)
+            ws.REQUEST_SECONDS.observe(time.perf_counter() - started_at, endpoint=endpoint)
+            ws.REQUESTS.inc(endpoint=endpoint, status=status[0])
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    if ws.PRELOAD_MODEL:
+        # Warm up on the inference executor so the port opens right away
+        asyncio.get_running_loop().run_in_executor(INFERENCE, ws.init_model)
+    if ws.LIVE_REFRESH_INTERVAL > 0 and ws.OPENWEATHER_API_KEY:
+        ws.start_refresher()
+    print(f'🧵 Inference executor: {INFERENCE_THREADS} threads')
+    yield
+    INFERENCE.shutdown(wait=False, cancel_futures=True)
+
+
+app = Starlette(
+    routes=routes,
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*']),
+                Middleware(RequestMetrics)],
+    lifespan=lifespan,
+)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    print('🚀 Starting ASGI server on http://localhost:5001')
+    uvicorn.run(app, host='0.0.0.0', port=5001, log_level='warning')
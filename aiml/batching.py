@@ -0,0 +1,325 @@
+"""
+Dynamic Batching Scheduler
+Runs concurrent generation requests through the model as one padded batch
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+
+import torch
+import torch.nn.functional as F
+
+from generation import StopMatcher, cache_to_legacy, cache_from_legacy
+
+
+class BatchScheduler:
+    """Continuous batching over a single GPT-2 model
+
+    Requests are queued by submit() and picked up by one worker thread, which
+    is the only thread that touches the model. When idle the worker waits
+    window_ms after the first request to collect more. While a batch is
+    running, waiting requests are prefilled and merged into free slots
+    between decode steps, and each sequence is retired as soon as it samples
+    EOS or one of its stop sequences, reaches its own token limit or passes
+    its deadline. Cancelling a request's Future frees its slot at the next
+    step.
+
+    Prompts are left-padded with pad_token_id. Padding is masked out through
+    attention_mask and skipped in position_ids, so a sequence samples the same
+    distribution as it would alone.
+
+    With a PrefixCache, prompts submitted with a prefix_len are prefilled on
+    top of the cached KV of their prefix and then merged into the batch.
+    """
+
+    def __init__(self, model, pad_token_id, eos_token_id, max_batch_size=8, window_ms=10, prefix_cache=None):
+        self.model = model
+        self.prefix_cache = prefix_cache
+        self.pad_token_id = pad_token_id
+        self.eos_token_id = eos_token_id
+        self.max_batch_size = max(1, max_batch_size)
+        self.window = window_ms / 1000
+        self.device = next(model.parameters()).device
+
+        self._queue = queue.Queue()
+        self._active = []       # one dict per batch row
+        self._past = None       # legacy ((key, value), ...) with batch on dim 0
+        self._mask = None       # [batch, cached_len] attention mask
+        self._positions = None  # [batch] position id of the next fed token
+        self._last = None       # [batch] last sampled token, not yet fed
+        self._temps = None      # [batch] sampling temperature per row
+        # Cumulative counters over finished requests (written by the worker only)
+        self.totals = {'requests': 0, 'prompt_tokens': 0, 'prefix_tokens': 0, 'new_tokens': 0,
+                       'finish_eos': 0, 'finish_stop': 0, 'finish_length': 0, 'finish_deadline': 0}
+
+        self._thread = threading.Thread(target=self._run, name='batch-scheduler', daemon=True)
+        self._thread.start()
+
+    def submit(self, ids, max_tokens, temp, on_token=None, prefix_len=0, prefix_tag=None, stop=None, deadline=None):
+        """Queue a prompt (list of token ids or [1, n] tensor) and return a Future for (ids, stats)
+
+        on_token is called from the worker thread with every sampled token id,
+        which lets a caller stream output before the Future resolves.
+        prefix_len/prefix_tag mark the shared prefix for the prefix cache.
+        stop and deadline work as in generation.generate_ids(); tokens that
+        may begin a stop sequence reach on_token only once they cannot.
+        """
+        future = Future()
+        self._queue.put({
+            'prompt': ids[0].tolist() if torch.is_tensor(ids) else list(ids),
+            'max_tokens': max_tokens,
+            'temp': temp,
+            'prefix_len': prefix_len if self.prefix_cache is not None else 0,
+            'prefix_tag': prefix_tag,
+            'prefix_tokens': 0,
+            'tokens': [],
+            'output': [],
+            'matcher': StopMatcher(stop) if stop else None,
+            'deadline': deadline,
+            'on_token': on_token,
+            'future': future,
+            'submitted_at': time.perf_counter(),
+        })
+        return future
+
+    def generate(self, ids, max_tokens, temp):
+        """Blocking helper with the same return value as generation.generate_ids"""
+        return self.submit(ids, max_tokens, temp).result()
+
+    # ------------------------------------------------------------------
+    # Worker thread
+
+    def _run(self):
+        while True:
+            pending = self._collect()
+            try:
+                with torch.no_grad():
+                    if pending:
+                        self._admit(pending)
+                    if self._active:
+                        self._step()
+            except Exception as e:
+                for seq in pending + self._active:
+                    if not seq['future'].done():
+                        seq['future'].set_exception(e)
+                self._reset()
+
+    def _collect(self):
+        """Take as many queued requests as there are free slots"""
+        free = self.max_batch_size - len(self._active)
+        pending = []
+
+        if not self._active:
+            # Idle: block for the first request, then hold the window open
+            pending.append(self._queue.get())
+            deadline = time.perf_counter() + self.window
+            while len(pending) < free:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    pending.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+        else:
+            while len(pending) < free:
+                try:
+                    pending.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+        return [seq for seq in pending if not seq['future'].cancelled()]
+
+    def _admit(self, pending):
+        """Prefill new prompts and merge them into the running batch
+
+        Prompts without a cacheable prefix are prefilled together as one
+        left-padded batch; the others resume one by one from their prefix KV.
+        """
+        now = time.perf_counter()
+        for seq in pending:
+            seq['started_at'] = now
+
+        # Out of time while queued: answer empty rather than prefill
+        admitted = []
+        for seq in pending:
+            if seq['deadline'] is not None and now >= seq['deadline']:
+                self._finish(seq, now, 'deadline')
+            else:
+                admitted.append(seq)
+        pending = admitted
+
+        fresh = [seq for seq in pending if not seq['prefix_len']]
+        if fresh:
+            self._join(fresh, *self._prefill_padded(fresh))
+        for seq in pending:
+            if seq['prefix_len']:
+                self._join([seq], *self._prefill_prefixed(seq))
+
+    def _prefill_padded(self, pending):
+        longest = max(len(seq['prompt']) for seq in pending)
+        input_ids = torch.full((len(pending), longest), self.pad_token_id, dtype=torch.long, device=self.device)
+        mask = torch.zeros((len(pending), longest), dtype=torch.long, device=self.device)
+        for row, seq in enumerate(pending):
+            n = len(seq['prompt'])
+            input_ids[row, longest - n:] = torch.tensor(seq['prompt'], device=self.device)
+            mask[row, longest - n:] = 1
+
+        position_ids = (mask.cumsum(-1) - 1).clamp(min=0)
+        out = self.model(input_ids, attention_mask=mask, position_ids=position_ids, use_cache=True)
+        return out.logits[:, -1, :], cache_to_legacy(out.past_key_values), mask
+
+    def _prefill_prefixed(self, seq):
+        input_ids = torch.tensor([seq['prompt']], dtype=torch.long, device=self.device)
+        out, seq['prefix_tokens'] = self.prefix_cache.prefill(self.model, input_ids, seq['prefix_len'], seq['prefix_tag'])
+        return out.logits[:, -1, :], cache_to_legacy(out.past_key_values), torch.ones_like(input_ids)
+
+    def _join(self, pending, logits, past, mask):
+        """Sample the first token of freshly prefilled rows and append them to the batch"""
+        temps = torch.tensor([seq['temp'] for seq in pending], dtype=logits.dtype, device=self.device)
+        next_ids = self._sample(logits, temps)
+        positions = mask.sum(-1)
+
+        if self._active:
+            past, mask = self._merge(self._past, self._mask, past, mask)
+            positions = torch.cat([self._positions, positions])
+            next_ids = torch.cat([self._last, next_ids])
+            temps = torch.cat([self._temps, temps])
+
+        self._active.extend(pending)
+        self._past, self._mask, self._positions, self._last, self._temps = past, mask, positions, next_ids, temps
+        self._record(len(self._active) - len(pending), next_ids[-len(pending):])
+
+    def _step(self):
+        """Feed every active row its last token and sample the next one"""
+        mask = torch.cat([self._mask, torch.ones_like(self._mask[:, :1])], dim=1)
+        out = self.model(
+            self._last[:, None],
+            past_key_values=cache_from_legacy(self._past),
+            attention_mask=mask,
+            position_ids=self._positions[:, None],
+            use_cache=True,
+        )
+        self._past = cache_to_legacy(out.past_key_values)
+        self._mask = mask
+        self._positions = self._positions + 1
+        self._last = self._sample(out.logits[:, -1, :], self._temps)
+        self._record(0, self._last)
+
+    def _record(self, offset, next_ids):
+        """Append sampled tokens to their sequences and retire finished rows"""
+        now = time.perf_counter()
+        for i, token in enumerate(next_ids.tolist()):
+            seq = self._active[offset + i]
+            seq['tokens'].append(token)
+            if len(seq['tokens']) == 1:
+                seq['first_token_at'] = now
+            self._emit(seq, [token] if seq['matcher'] is None else seq['matcher'].push(token))
+
+        keep = []
+        for row, seq in enumerate(self._active):
+            if seq['future'].cancelled():
+                continue
+            reason = self._finish_reason(seq, now)
+            if reason:
+                self._finish(seq, now, reason)
+            else:
+                keep.append(row)
+
+        if len(keep) == len(self._active):
+            return
+        if not keep:
+            self._reset()
+            return
+
+        index = torch.tensor(keep, device=self.device)
+        self._active = [self._active[row] for row in keep]
+        self._past = tuple((k.index_select(0, index), v.index_select(0, index)) for k, v in self._past)
+        self._mask = self._mask.index_select(0, index)
+        self._positions = self._positions.index_select(0, index)
+        self._last = self._last.index_select(0, index)
+        self._temps = self._temps.index_select(0, index)
+
+        # Drop leading columns that are padding for every remaining row
+        used = self._mask.sum(0).nonzero()
+        start = int(used[0]) if used.numel() else 0
+        if start:
+            self._mask = self._mask[:, start:]
+            self._past = tuple((k[:, :, start:], v[:, :, start:]) for k, v in self._past)
+
+    def _emit(self, seq, tokens):
+        seq['output'].extend(tokens)
+        if seq['on_token'] is not None:
+            try:
+                for token in tokens:
+                    seq['on_token'](token)
+            except Exception:
+                seq['future'].cancel()
+
+    def _finish_reason(self, seq, now):
+        if seq['tokens'][-1] == self.eos_token_id:
+            return 'eos'
+        if seq['matcher'] is not None and seq['matcher'].matched:
+            return 'stop'
+        if len(seq['tokens']) >= seq['max_tokens']:
+            return 'length'
+        if seq['deadline'] is not None and now >= seq['deadline']:
+            return 'deadline'
+        return None
+
+    def _finish(self, seq, now, reason):
+        if seq['matcher'] is not None:
+            self._emit(seq, seq['matcher'].flush())
+        prompt = seq['prompt']
+        ids = torch.tensor([prompt + seq['output']], dtype=torch.long)
+        new_tokens = len(seq['tokens'])
+        first_token_at = seq.get('first_token_at', now)
+        stats = {
+            'prompt_tokens': len(prompt),
+            'prefix_tokens': seq['prefix_tokens'],
+            'new_tokens': new_tokens,
+            'use_cache': True,
+            'queue_ms': (seq['started_at'] - seq['submitted_at']) * 1000,
+            'total_ms': (now - seq['started_at']) * 1000,
+            'first_token_ms': (first_token_at - seq['started_at']) * 1000,
+            'ms_per_token': ((now - first_token_at) * 1000 / (new_tokens - 1)) if new_tokens > 1 else 0.0,
+            'finish_reason': reason,
+        }
+        self.totals['requests'] += 1
+        self.totals['prompt_tokens'] += len(prompt)
+        self.totals['prefix_tokens'] += seq['prefix_tokens']
+        self.totals['new_tokens'] += new_tokens
+        self.totals[f'finish_{reason}'] += 1
+        try:
+            seq['future'].set_result((ids, stats))
+        except InvalidStateError:
+            pass  # cancelled by the caller while finishing
+
+    def _reset(self):
+        self._active = []
+        self._past = self._mask = self._positions = self._last = self._temps = None
+
+    @staticmethod
+    def _sample(logits, temps):
+        probs = F.softmax(logits / temps[:, None], dim=-1)
+        return torch.multinomial(probs, 1)[:, 0]
+
+    @staticmethod
+    def _merge(past_a, mask_a, past_b, mask_b):
+        """Left-pad two batches to the same cached length and stack them"""
+        length = max(mask_a.size(1), mask_b.size(1))
+
+        def pad_kv(x, n):
+            return F.pad(x, (0, 0, length - n, 0)) if length > n else x
+
+        def pad_mask(m):
+            return F.pad(m, (length - m.size(1), 0)) if length > m.size(1) else m
+
+        len_a, len_b = mask_a.size(1), mask_b.size(1)
+        past = tuple(
+            (torch.cat([pad_kv(ka, len_a), pad_kv(kb, len_b)]), torch.cat([pad_kv(va, len_a), pad_kv(vb, len_b)]))
+            for (ka, va), (kb, vb) in zip(past_a, past_b)
+        )
+        return past, torch.cat([pad_mask(mask_a), pad_mask(mask_b)])
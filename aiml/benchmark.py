@@ -0,0 +1,362 @@
+"""
+Benchmark Suite
+Cold start, steady-state rag_generate tokens/sec and /predict latency under load
+
+OpenWeather and SerpAPI are replaced by a local stub_upstream.py --synthetic
+server, so results depend only on this machine and the code under test.
+Results are written as JSON (one file per run) and can be compared with an
+earlier run.
+
+Usage:
+    python benchmark.py [--output benchmarks/] [--compare benchmarks/<earlier>.json]
+                        [--cold-runs 2] [--prompt-tokens 32,128,320] [--repeats 3]
+                        [--concurrency 1,4,8] [--requests 16] [--tokens 150]
+"""
+
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# /predict load mix: every city, with and without a web search keyword
+CITY_NAMES = ['Kolkata', 'Delhi', 'Mumbai', 'Bangalore', 'Chennai', 'Hyderabad',
+              'Siliguri', 'Darjeeling', 'Durgapur', 'Asansol', 'Howrah', 'Malda']
+LOAD_QUERIES = [f'What is the air quality in {c}?' for c in CITY_NAMES] + \
+               [f'Why is pollution high in {c}?' for c in CITY_NAMES[:4]]
+
+FILLER = ' Please take traffic, industry, construction dust, crop burning, humidity and wind into account.'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a list (None when empty)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))]
+
+
+def peak_rss_mb(pid='self'):
+    """Peak resident set size of a process in MB (Linux VmHWM)"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def child_env(stub_url, max_tokens):
+    env = dict(os.environ)
+    env.update({
+        'UPSTREAM_MODE': 'live',
+        'UPSTREAM_STUB_URL': stub_url,
+        'OPENWEATHER_API_KEY': env.get('OPENWEATHER_API_KEY') or 'benchmark',
+        'SERPAPI_KEY': env.get('SERPAPI_KEY') or 'benchmark',
+        # Measure the app, not the quota guards or caches
+        'OPENWEATHER_RATE_PER_MIN': '1000000', 'OPENWEATHER_BURST': '1000',
+        'SERPAPI_RATE_PER_MIN': '1000000', 'SERPAPI_BURST': '1000',
+        'LIVE_REFRESH_INTERVAL': '0',
+        'RESPONSE_CACHE': '0',
+        'QUERY_ROUTER': '0',  # the load mix is mostly data lookups; time generation
+        'MAX_TOKENS': str(max_tokens),
+        'PYTHONUNBUFFERED': '1',
+    })
+    return env
+
+
+# ----------------------------------------------------------------------
+# Child processes
+
+def child_server(port):
+    """Load the model, report startup timings, then serve the Flask app"""
+    import startup
+    import weather_server as ws
+    ws.init_model()
+    print(json.dumps({'ready': startup.report()}), flush=True)
+    ws.app.run(host='127.0.0.1', port=port, debug=False, threaded=True)
+
+
+def child_generate(prompt_tokens, repeats):
+    """Steady-state rag_generate throughput for prompts of roughly each length"""
+    import torch
+    import weather_server as ws
+    ws.init_model()
+
+    results = []
+    for target in prompt_tokens:
+        query = 'What is the air quality in Delhi today?'
+        context, _, _ = ws.retrieve_context(query)
+        while len(ws.encode_prompt(query, context)[0]) < target and len(query) < 4000:
+            query += FILLER
+        actual = len(ws.encode_prompt(query, context)[0])
+
+        ws.rag_generate(query)  # warm-up (also fills the prefix cache)
+        before = dict(ws.scheduler.totals)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            ws.rag_generate(query)
+        elapsed = time.perf_counter() - start
+        tokens = ws.scheduler.totals['new_tokens'] - before['new_tokens']
+
+        results.append({
+            'target_prompt_tokens': target,
+            'prompt_tokens': actual,
+            'calls': repeats,
+            'new_tokens': tokens,
+            'tokens_per_sec': round(tokens / elapsed, 1),
+            'ms_per_call': round(elapsed * 1000 / repeats, 1),
+        })
+
+    print(json.dumps({
+        'generation': results,
+        'peak_rss_mb': peak_rss_mb(),
+        'torch': torch.__version__,
+        'device': str(ws.device),
+        'quantize_int8': ws.QUANTIZE_INT8,
+    }), flush=True)
+
+
+# ----------------------------------------------------------------------
+# Parent
+
+class ServerProcess:
+    """weather_server in a child process, with its output drained in the background"""
+
+    def __init__(self, env):
+        self.port = free_port()
+        self.url = f'http://127.0.0.1:{self.port}'
+        self.ready = None
+        self.output = deque(maxlen=20)
+        self._ready = threading.Event()
+        self.started = time.perf_counter()
+        self.proc = subprocess.Popen([sys.executable, __file__, '--child', 'server', '--port', str(self.port)],
+                                     env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        threading.Thread(target=self._drain, daemon=True).start()
+
+    def _drain(self):
+        for line in self.proc.stdout:
+            self.output.append(line.rstrip())
+            if line.startswith('{"ready"'):
+                self.ready = json.loads(line)['ready']
+                self._ready.set()
+        self._ready.set()
+
+    def wait_ready(self, timeout=600):
+        """Seconds from spawn until the model is loaded and the port answers"""
+        self._ready.wait(timeout)
+        if self.ready is None:
+            raise RuntimeError('server exited before loading the model:\n' + '\n'.join(self.output))
+        model_ready = time.perf_counter() - self.started
+        while True:
+            try:
+                requests.get(f'{self.url}/health', timeout=1)
+                return model_ready, time.perf_counter() - self.started
+            except requests.ConnectionError:
+                if self.proc.poll() is not None:
+                    raise RuntimeError('server exited before opening its port')
+                time.sleep(0.05)
+
+    def predict(self, query, timeout=300):
+        r = requests.post(f'{self.url}/predict', json={'query': query}, timeout=timeout)
+        r.raise_for_status()
+        return r.json()
+
+    def stop(self):
+        rss = peak_rss_mb(self.proc.pid)
+        self.proc.terminate()
+        try:
+            self.proc.wait(10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+        return rss
+
+
+def measure_cold_start(env, runs):
+    """Spawn the server runs times; keep the last one running for the load test"""
+    samples = []
+    server = None
+    for i in range(runs):
+        if server is not None:
+            server.stop()
+        server = ServerProcess(env)
+        model_ready_s, port_ready_s = server.wait_ready()
+        start = time.perf_counter()
+        server.predict('What is the air quality in Delhi?')
+        samples.append({
+            'model_ready_s': round(model_ready_s, 2),
+            'port_ready_s': round(port_ready_s, 2),
+            'first_predict_s': round(port_ready_s + time.perf_counter() - start, 2),
+            'phases_ms': server.ready['phases_ms'],
+        })
+        print(f'   run {i + 1}: first /predict after {samples[-1]["first_predict_s"]} s', file=sys.stderr)
+
+    summary = {k: round(min(s[k] for s in samples), 2) for k in ('model_ready_s', 'port_ready_s', 'first_predict_s')}
+    return {'runs': samples, 'best': summary}, server
+
+
+def measure_predict(server, levels, total):
+    """/predict latency percentiles at each concurrency level"""
+    results = []
+    for level in levels:
+        latencies = []
+        errors = 0
+
+        def one(i):
+            start = time.perf_counter()
+            server.predict(LOAD_QUERIES[i % len(LOAD_QUERIES)])
+            return (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=level) as pool:
+            for future in [pool.submit(one, i) for i in range(total)]:
+                try:
+                    latencies.append(future.result())
+                except Exception:
+                    errors += 1
+        elapsed = time.perf_counter() - start
+
+        results.append({
+            'concurrency': level,
+            'requests': total,
+            'errors': errors,
+            'p50_ms': round(percentile(latencies, 50), 1) if latencies else None,
+            'p95_ms': round(percentile(latencies, 95), 1) if latencies else None,
+            'p99_ms': round(percentile(latencies, 99), 1) if latencies else None,
+            'max_ms': round(max(latencies), 1) if latencies else None,
+            'throughput_rps': round(len(latencies) / elapsed, 2),
+        })
+        print(f'   concurrency {level}: p50 {results[-1]["p50_ms"]} ms, p95 {results[-1]["p95_ms"]} ms', file=sys.stderr)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, previous):
+    """Print relative changes of the headline numbers against an earlier report"""
+    def change(new, old, lower_is_better=True):
+        if not new or not old:
+            return '   n/a'
+        pct = (new - old) / old * 100
+        better = pct < 0 if lower_is_better else pct > 0
+        return f'{pct:+6.1f}% {"✅" if better else "⚠️ "}'
+
+    print(f'\n📊 Compared with {previous.get("timestamp")} ({previous.get("git_commit")})', file=sys.stderr)
+    old, new = previous['cold_start']['best'], report['cold_start']['best']
+    print(f'   cold start first /predict   {new["first_predict_s"]:>8} s   {change(new["first_predict_s"], old["first_predict_s"])}', file=sys.stderr)
+    old_gen = {g['target_prompt_tokens']: g for g in previous['generation']}
+    for g in report['generation']:
+        o = old_gen.get(g['target_prompt_tokens'], {})
+        print(f'   tokens/sec @ {g["prompt_tokens"]:>4} prompt   {g["tokens_per_sec"]:>8}     '
+              f'{change(g["tokens_per_sec"], o.get("tokens_per_sec"), lower_is_better=False)}', file=sys.stderr)
+    old_load = {p['concurrency']: p for p in previous['predict']}
+    for p in report['predict']:
+        o = old_load.get(p['concurrency'], {})
+        for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+            print(f'   /predict {key} @ c={p["concurrency"]:<3}     {p[key]:>8} ms  {change(p[key], o.get(key))}', file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark cold start, generation and /predict latency')
+    parser.add_argument('--output', default=os.path.join(HERE, 'benchmarks'),
+                        help='directory for the JSON report, or a .json file path')
+    parser.add_argument('--compare', help='earlier report to compare against')
+    parser.add_argument('--cold-runs', type=int, default=2, help='server cold starts to time')
+    parser.add_argument('--prompt-tokens', default='32,128,320', help='approximate prompt lengths to generate from')
+    parser.add_argument('--repeats', type=int, default=3, help='rag_generate calls per prompt length')
+    parser.add_argument('--concurrency', default='1,4,8', help='/predict concurrency levels')
+    parser.add_argument('--requests', type=int, default=16, help='/predict requests per concurrency level')
+    parser.add_argument('--tokens', type=int, default=int(os.getenv('MAX_TOKENS', '150')), help='MAX_TOKENS per answer')
+    parser.add_argument('--upstream-latency-ms', default='20-60', help='stub upstream latency, e.g. 50 or 20-60')
+    parser.add_argument('--child', choices=['server', 'generate'], help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    prompt_tokens = [int(n) for n in args.prompt_tokens.split(',')]
+    if args.child == 'server':
+        return child_server(args.port)
+    if args.child == 'generate':
+        return child_generate(prompt_tokens, args.repeats)
+
+    stub_port = free_port()
+    stub = subprocess.Popen([sys.executable, os.path.join(HERE, 'stub_upstream.py'), '--synthetic',
+                             '--store', '', '--port', str(stub_port), '--latency-ms', args.upstream_latency_ms],
+                            cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    env = child_env(f'http://127.0.0.1:{stub_port}', args.tokens)
+    server = None
+
+    try:
+        print('⏱️  Cold start...', file=sys.stderr)
+        cold_start, server = measure_cold_start(env, max(1, args.cold_runs))
+
+        print('⏱️  /predict under load...', file=sys.stderr)
+        predict = measure_predict(server, [int(n) for n in args.concurrency.split(',')], args.requests)
+        server_rss = server.stop()
+        server = None
+
+        print('⏱️  Steady-state rag_generate...', file=sys.stderr)
+        out = subprocess.run([sys.executable, __file__, '--child', 'generate', '--prompt-tokens', args.prompt_tokens,
+                              '--repeats', str(args.repeats)], env=env, capture_output=True, text=True)
+        if out.returncode != 0:
+            raise RuntimeError('generation benchmark failed:\n' + '\n'.join(out.stdout.splitlines()[-20:] + out.stderr.splitlines()[-20:]))
+        generate = json.loads([line for line in out.stdout.splitlines() if line.startswith('{"generation"')][-1])
+    finally:
+        if server is not None:
+            server.stop()
+        stub.terminate()
+
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'git_commit': git_commit(),
+        'host': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+                 'torch': generate['torch'], 'device': generate['device']},
+        'config': {'max_tokens': args.tokens, 'quantize_int8': generate['quantize_int8'],
+                   'batch_max_size': os.getenv('BATCH_MAX_SIZE', '8'), 'upstream_latency_ms': args.upstream_latency_ms},
+        'cold_start': cold_start,
+        'generation': generate['generation'],
+        'predict': predict,
+        'peak_rss_mb': {'server': server_rss, 'generate': generate['peak_rss_mb']},
+    }
+
+    path = args.output
+    if not path.endswith('.json'):
+        os.makedirs(path, exist_ok=True)
+        path = os.path.join(path, f'bench-{datetime.now():%Y%m%d-%H%M%S}.json')
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(json.dumps(report, indent=2))
+    print(f'💾 Wrote {path}', file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
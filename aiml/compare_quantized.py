@@ -0,0 +1,160 @@
+"""
+Quantized Engine Comparison
+Reports tokens/sec, resident memory and output divergence of the int8 engine
+against the fp32 best_model.pt on a fixed prompt set
+
+Usage:
+    python compare_quantized.py [--tokens 64] [--output report.json]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+MODEL_PATH = os.getenv('MODEL_PATH', 'best_model.pt')
+INT8_MODEL_PATH = os.getenv('INT8_MODEL_PATH', 'best_model.int8.pt')
+
+PROMPTS = [
+    '[LIVE DATA: Delhi AQI=299 (Poor), PM2.5=120.0]\\nUser: What is the air quality in Delhi?\\nAssistant:',
+    '[WEATHER: 19.95°C, 73% humidity, haze]\\nUser: What is the weather in Kolkata?\\nAssistant:',
+    'User: Why is pollution increasing in India?\\nAssistant:',
+    'User: How does PM2.5 affect health?\\nAssistant:',
+    '[LIVE DATA: Mumbai AQI=189 (Moderate), PM2.5=78.5]\\nUser: Is it safe to go running in Mumbai today?\\nAssistant:',
+]
+
+
+def rss_mb():
+    """Current resident set size in MB (Linux /proc, falls back to peak RSS)"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def load_engine(engine):
+    from model_loader import load_model
+    return load_model(MODEL_PATH, quantize=(engine == 'int8'), cache_path=INT8_MODEL_PATH)
+
+
+def measure_engine(engine, max_tokens):
+    """Load one engine in this process and time generation on every prompt"""
+    import torch
+    from generation import generate_ids
+
+    torch.set_grad_enabled(False)
+    rss_before = rss_mb()
+    start = time.perf_counter()
+    model, tokenizer, device = load_engine(engine)
+    load_s = time.perf_counter() - start
+    # fp32 weights are mmap'd and only paged in by the first forward pass,
+    # so run one before sampling the loaded RSS
+    generate_ids(model, tokenizer.encode(PROMPTS[0], return_tensors='pt').to(device), 1, 0.8, -1)
+    rss_loaded = rss_mb()
+
+    tokens = 0
+    decode_s = 0.0
+    for i, prompt in enumerate(PROMPTS):
+        ids = tokenizer.encode(prompt, return_tensors='pt').to(device)
+        torch.manual_seed(i)
+        # eos_token_id=-1 disables early stopping so both engines decode the same length
+        _, stats = generate_ids(model, ids, max_tokens, 0.8, -1)
+        tokens += stats['new_tokens']
+        decode_s += stats['total_ms'] / 1000
+
+    return {
+        'engine': engine,
+        'load_s': round(load_s, 2),
+        'tokens_per_sec': round(tokens / decode_s, 1),
+        'rss_mb': round(rss_loaded, 1),
+        'model_rss_mb': round(rss_loaded - rss_before, 1),
+        'peak_rss_mb': round(rss_mb(), 1),
+    }
+
+
+def measure_divergence(max_tokens):
+    """Teacher-force fp32 samples through both engines and compare next-token distributions"""
+    import torch
+    import torch.nn.functional as F
+    from generation import generate_ids
+
+    torch.set_grad_enabled(False)
+    fp32, tokenizer, device = load_engine('fp32')
+    int8, _, _ = load_engine('int8')
+    fp32 = fp32.cpu()
+
+    kl_total = 0.0
+    agree = 0
+    positions = 0
+    max_logit_diff = 0.0
+    for i, prompt in enumerate(PROMPTS):
+        ids = tokenizer.encode(prompt, return_tensors='pt')
+        torch.manual_seed(i)
+        seq, _ = generate_ids(fp32, ids, max_tokens, 0.8, -1)
+        start = ids.size(1) - 1
+
+        logits_a = fp32(seq).logits[0, start:-1]
+        logits_b = int8(seq).logits[0, start:-1]
+        log_p = F.log_softmax(logits_a, dim=-1)
+        log_q = F.log_softmax(logits_b, dim=-1)
+
+        kl_total += F.kl_div(log_q, log_p, log_target=True, reduction='sum').item()
+        agree += (logits_a.argmax(-1) == logits_b.argmax(-1)).sum().item()
+        positions += logits_a.size(0)
+        max_logit_diff = max(max_logit_diff, (logits_a - logits_b).abs().max().item())
+
+    return {
+        'positions': positions,
+        'mean_kl': round(kl_total / positions, 5),
+        'top1_agreement': round(agree / positions, 4),
+        'max_abs_logit_diff': round(max_logit_diff, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the int8 engine against fp32')
+    parser.add_argument('--tokens', type=int, default=64, help='tokens generated per prompt')
+    parser.add_argument('--output', help='also write the report to this JSON file')
+    parser.add_argument('--engine', choices=['fp32', 'int8'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.engine:
+        print(json.dumps(measure_engine(args.engine, args.tokens)))
+        return
+
+    # Each engine runs in its own process so resident memory is not shared
+    engines = {}
+    for engine in ('fp32', 'int8'):
+        print(f'⏱️  Measuring {engine}...', file=sys.stderr)
+        out = subprocess.run([sys.executable, __file__, '--engine', engine, '--tokens', str(args.tokens)],
+                             capture_output=True, text=True, check=True)
+        engines[engine] = json.loads(out.stdout.strip().splitlines()[-1])
+
+    print('⏱️  Measuring divergence...', file=sys.stderr)
+    report = {
+        'prompts': len(PROMPTS),
+        'tokens_per_prompt': args.tokens,
+        'engines': engines,
+        'speedup': round(engines['int8']['tokens_per_sec'] / engines['fp32']['tokens_per_sec'], 2),
+        'divergence': measure_divergence(args.tokens),
+    }
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
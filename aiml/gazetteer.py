@@ -0,0 +1,246 @@
+"""
+City Gazetteer
+Place names loaded from gazetteer.csv, matched in text with Aho-Corasick and indexed by location
+"""
+
+import csv
+import math
+import os
+from collections import deque
+from typing import NamedTuple
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gazetteer.csv')
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+class Place(NamedTuple):
+    key: str        # lower-case name; used for cache keys and live data lookups
+    name: str
+    state: str
+    lat: float
+    lon: float
+    featured: bool  # kept warm by the refresher and listed by default
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance in kilometres"""
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    a = math.sin((p2 - p1) / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _is_word_char(ch):
+    return ch.isalnum() or ch == '_'
+
+
+class _Matcher:
+    """Aho-Corasick automaton over lower-case patterns
+
+    Scanning is one pass over the text whatever the number of patterns.
+    Matches must start and end on word boundaries, so 'puri' does not match
+    inside 'purification'.
+    """
+
+    def __init__(self, patterns):
+        # patterns: {text: value}; node 0 is the root
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [None]  # (length, value) of the longest pattern ending here
+
+        for text, value in patterns.items():
+            node = 0
+            for ch in text:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(None)
+                node = nxt
+            self._out[node] = (len(text), value)
+
+        # Breadth-first fail links; each node also keeps the outputs of its
+        # fail chain as a linked list through _dict_link
+        self._dict_link = [None] * len(self._goto)
+        pending = deque(self._goto[0].values())
+        while pending:
+            node = pending.popleft()
+            for ch, child in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(ch, 0)
+                self._fail[child] = target if target != child else 0
+                f = self._fail[child]
+                self._dict_link[child] = f if self._out[f] is not None else self._dict_link[f]
+                pending.append(child)
+
+    def finditer(self, text):
+        """(start, end, value) for every word-bounded match, in order of end position"""
+        node = 0
+        goto, fail, out, link = self._goto, self._fail, self._out, self._dict_link
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+
+            hit = node if out[node] is not None else link[node]
+            if hit is None or (i + 1 < len(text) and _is_word_char(text[i + 1])):
+                continue
+            while hit is not None:
+                length, value = out[hit]
+                start = i + 1 - length
+                if start == 0 or not _is_word_char(text[start - 1]):
+                    yield start, i + 1, value
+                hit = link[hit]
+
+
+class _GridIndex:
+    """Places bucketed into cell_deg x cell_deg cells for nearest-neighbour search"""
+
+    def __init__(self, places, cell_deg=1.0):
+        self.cell = cell_deg
+        self._places = list(places)
+        self._cells = {}
+        for place in self._places:
+            self._cells.setdefault(self._cell_of(place.lat, place.lon), []).append(place)
+        self._max_ring = int(math.ceil(360 / cell_deg))
+        rows = [r for r, _ in self._cells] or [0]
+        cols = [c for _, c in self._cells] or [0]
+        self._rows, self._cols = (min(rows), max(rows)), (min(cols), max(cols))
+
+    def _cell_of(self, lat, lon):
+        return int(math.floor(lat / self.cell)), int(math.floor(lon / self.cell))
+
+    @staticmethod
+    def _ring(row, col, ring):
+        """Cells exactly ring steps (Chebyshev distance) from (row, col)"""
+        if ring == 0:
+            yield row, col
+            return
+        for c in range(col - ring, col + ring + 1):
+            yield row - ring, c
+            yield row + ring, c
+        for r in range(row - ring + 1, row + ring):
+            yield r, col - ring
+            yield r, col + ring
+
+    def nearest(self, lat, lon):
+        """(place, km) closest to lat/lon, or (None, None) for an empty index"""
+        if not self._cells:
+            return None, None
+        row, col = self._cell_of(lat, lon)
+        best, best_km = None, float('inf')
+        # No ring beyond the farthest occupied cell can hold a place
+        reach = max(row - self._rows[0], self._rows[1] - row, col - self._cols[0], self._cols[1] - col)
+        visited = 0
+
+        for ring in range(min(reach, self._max_ring) + 1):
+            # Far from the places (or near a pole, where the bound below
+            # shrinks to nothing) the rings are mostly empty cells; once
+            # they cost more than a look at every place, do that instead
+            visited += max(1, 8 * ring)
+            if visited > len(self._places):
+                return self._scan(lat, lon)
+            for cell in self._ring(row, col, ring):
+                for place in self._cells.get(cell, ()):
+                    km = haversine_km(lat, lon, place.lat, place.lon)
+                    if km < best_km:
+                        best, best_km = place, km
+
+            # Anything outside this ring is at least ring cells away in
+            # latitude or longitude; stop once that cannot beat the best
+            lat_limit = min(90.0, abs(lat) + (ring + 1) * self.cell)
+            bound = ring * self.cell * KM_PER_DEGREE * math.cos(math.radians(lat_limit))
+            if best is not None and best_km <= bound:
+                break
+
+        return best, best_km
+
+    def _scan(self, lat, lon):
+        """(place, km) closest to lat/lon by checking every place"""
+        best, best_km = None, float('inf')
+        for place in self._places:
+            km = haversine_km(lat, lon, place.lat, place.lon)
+            if km < best_km:
+                best, best_km = place, km
+        return best, best_km
+
+
+class Gazetteer:
+    """Known places with text matching by name or alias and nearest-place lookup
+
+    Names and aliases are matched case-insensitively on word boundaries, and
+    the longest match wins where names overlap ('navi mumbai' over 'mumbai').
+    When two places share a name or alias, the one listed first in the file
+    keeps it.
+    """
+
+    def __init__(self, places, aliases=None):
+        self.places = {}
+        self._names = {}
+        for place in places:
+            if place.key in self.places:
+                continue
+            self.places[place.key] = place
+            self._names.setdefault(place.key, place)
+        for alias, key in (aliases or {}).items():
+            if key in self.places:
+                self._names.setdefault(alias.lower(), self.places[key])
+
+        self._matcher = _Matcher(self._names)
+        self._index = _GridIndex(self.places.values())
+
+    @classmethod
+    def load(cls, path=None):
+        """Read a CSV with columns name, state, lat, lon, featured, aliases ('|'-separated)"""
+        places, aliases = [], {}
+        with open(path or DEFAULT_PATH, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(line for line in f if not line.startswith('#')):
+                key = row['name'].strip().lower()
+                places.append(Place(key, row['name'].strip(), row['state'].strip(), float(row['lat']),
+                                    float(row['lon']), row.get('featured', '').strip() == '1'))
+                for alias in filter(None, (a.strip() for a in (row.get('aliases') or '').split('|'))):
+                    aliases.setdefault(alias.lower(), key)
+        return cls(places, aliases)
+
+    def __len__(self):
+        return len(self.places)
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __iter__(self):
+        return iter(self.places.values())
+
+    def get(self, name):
+        """Place for a name or alias (any case), or None"""
+        return self._names.get(' '.join(str(name).lower().split()))
+
+    def featured(self):
+        """{key: (lat, lon)} of featured places, in file order"""
+        return {p.key: (p.lat, p.lon) for p in self.places.values() if p.featured}
+
+    def find_all(self, text):
+        """Places mentioned in text as (start, end, place), left to right without overlaps
+
+        Positions index into text.lower().
+        """
+        matches = sorted(self._matcher.finditer(text.lower()), key=lambda m: (m[0], -m[1]))
+        found, end = [], 0
+        for start, stop, place in matches:
+            if start >= end:
+                found.append((start, stop, place))
+                end = stop
+        return found
+
+    def find(self, text):
+        """First place mentioned in text, or None"""
+        found = self.find_all(text)
+        return found[0][2] if found else None
+
+    def nearest(self, lat, lon):
+        """(place, distance_km) of the closest known place"""
+        return self._index.nearest(lat, lon)
@@ -0,0 +1,173 @@
+"""
+Token Generation Helpers
+Incremental (KV-cached) sampling loop shared by the CLI, API and Flask server
+"""
+
+import time
+import torch
+import torch.nn.functional as F
+
+
+def cache_to_legacy(past):
+    """Return past_key_values as a tuple of (key, value) pairs per layer"""
+    if hasattr(past, 'to_legacy_cache'):
+        return past.to_legacy_cache()
+    if hasattr(past, 'layers'):
+        return tuple((layer.keys, layer.values) for layer in past.layers)
+    return past
+
+
+def cache_from_legacy(legacy):
+    """Wrap a legacy (key, value) tuple in a DynamicCache when transformers has one"""
+    try:
+        from transformers import DynamicCache
+    except ImportError:
+        return legacy
+    if hasattr(DynamicCache, 'from_legacy_cache'):
+        return DynamicCache.from_legacy_cache(legacy)
+    return DynamicCache(legacy)
+
+
+class StopMatcher:
+    """Watches sampled token IDs for any of several stop sequences
+
+    push() takes one token and returns the tokens that are now safe to emit.
+    Tokens that could be the start of a stop sequence are held back until
+    they either complete it (matched is set and they are dropped) or stop
+    matching (they are released). Each push is a few set lookups.
+    """
+
+    def __init__(self, sequences):
+        # Longest first, so a stop preceded by its separator drops both
+        self.sequences = sorted({tuple(seq) for seq in sequences if seq}, key=len, reverse=True)
+        self._prefixes = {seq[:n] for seq in self.sequences for n in range(1, len(seq))}
+        self.held = []
+        self.matched = None
+
+    def push(self, token):
+        self.held.append(token)
+        for seq in self.sequences:
+            if tuple(self.held[-len(seq):]) == seq:
+                self.matched = seq
+                released, self.held = self.held[:-len(seq)], []
+                return released
+
+        # Keep the longest tail that may still grow into a stop sequence
+        for start in range(len(self.held)):
+            if tuple(self.held[start:]) in self._prefixes:
+                released, self.held = self.held[:start], self.held[start:]
+                return released
+        released, self.held = self.held, []
+        return released
+
+    def flush(self):
+        """Release held tokens when generation ends without a match"""
+        released, self.held = self.held, []
+        return released
+
+
+@torch.no_grad()
+def generate_ids(model, ids, max_tokens, temp, eos_token_id, use_cache=True,
+                 prefix_cache=None, prefix_len=0, prefix_tag=None, stop=None, deadline=None):
+    """Sample up to max_tokens after ids and return (ids, stats)
+
+    With use_cache the prompt is run through the model once and every later
+    step only feeds the newly sampled token together with past_key_values.
+    use_cache=False keeps the old full-sequence recompute so the two paths can
+    be compared. Tokens are written into a preallocated buffer instead of
+    being concatenated on every step.
+
+    Given a PrefixCache, the KV of ids[:, :prefix_len] is taken from (or
+    stored in) it and only the rest of the prompt is prefilled.
+
+    stop is a list of token ID sequences; generation ends as soon as one is
+    sampled and it is left out of the returned ids. deadline is a
+    time.perf_counter() value after which no further token is sampled.
+    stats['finish_reason'] is 'eos', 'stop', 'length' or 'deadline'.
+    """
+    prompt_len = ids.size(1)
+    buf = torch.empty((1, prompt_len + max_tokens), dtype=torch.long, device=ids.device)
+    buf[:, :prompt_len] = ids
+    pos = prompt_len
+    past = None
+    reused = 0
+    matcher = StopMatcher(stop) if stop else None
+    finish_reason = 'length'
+
+    start = time.perf_counter()
+    first_token_at = None
+
+    for _ in range(max_tokens):
+        if deadline is not None and time.perf_counter() >= deadline:
+            finish_reason = 'deadline'
+            break
+
+        if use_cache and past is None and prefix_cache is not None:
+            out, reused = prefix_cache.prefill(model, buf[:, :pos], prefix_len, prefix_tag)
+            past = out.past_key_values
+        elif use_cache:
+            step_ids = buf[:, :pos] if past is None else buf[:, pos - 1:pos]
+            out = model(step_ids, past_key_values=past, use_cache=True)
+            past = out.past_key_values
+        else:
+            out = model(buf[:, :pos])
+
+        logits = out.logits[:, -1, :] / temp
+        probs = F.softmax(logits, dim=-1)
+        next_id = torch.multinomial(probs, 1)
+        buf[:, pos] = next_id[:, 0]
+        pos += 1
+
+        if first_token_at is None:
+            first_token_at = time.perf_counter()
+
+        if next_id.item() == eos_token_id:
+            finish_reason = 'eos'
+            break
+
+        if matcher is not None:
+            matcher.push(next_id.item())
+            if matcher.matched:
+                finish_reason = 'stop'
+                break
+
+    end = time.perf_counter()
+    new_tokens = pos - prompt_len
+    stats = {
+        'prompt_tokens': prompt_len,
+        'prefix_tokens': reused,
+        'new_tokens': new_tokens,
+        'use_cache': use_cache,
+        'total_ms': (end - start) * 1000,
+        'first_token_ms': ((first_token_at or end) - start) * 1000,
+        # Per-token figure excludes the prompt pass so both paths are comparable
+        'ms_per_token': ((end - (first_token_at or end)) * 1000 / (new_tokens - 1)) if new_tokens > 1 else 0.0,
+        'finish_reason': finish_reason,
+    }
+
+    if finish_reason == 'stop':
+        pos -= len(matcher.matched)
+    return buf[:, :pos], stats
+
+
+def compare_decode_paths(model, ids, max_tokens, temp, eos_token_id):
+    """Run the cached and uncached loops on the same prompt and return both stats"""
+    _, cached = generate_ids(model, ids, max_tokens, temp, eos_token_id, use_cache=True)
+    _, uncached = generate_ids(model, ids, max_tokens, temp, eos_token_id, use_cache=False)
+    return {'kv_cache': cached, 'full_recompute': uncached}
+
+
+if __name__ == '__main__':
+    import os
+    import json
+    from model_loader import load_model
+
+    model, tokenizer, device = load_model(os.getenv('MODEL_PATH', 'best_model.pt'),
+                                          quantize=os.getenv('QUANTIZE_INT8', '0') == '1',
+                                          cache_path=os.getenv('INT8_MODEL_PATH', 'best_model.int8.pt'))
+
+    prompt = '[LIVE DATA: Delhi AQI=299 (Poor), PM2.5=120.0]\\nUser: Why is the air so bad in Delhi today?\\nAssistant:'
+    ids = tokenizer.encode(prompt, return_tensors='pt').to(device)
+
+    # eos_token_id=-1 disables early stopping so both paths decode the same length
+    print(json.dumps(compare_decode_paths(model, ids, 150, 0.8, -1), indent=2))
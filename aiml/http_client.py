@@ -0,0 +1,324 @@
+"""
+Upstream HTTP Client
+Pooled keep-alive sessions with per-provider rate limiting, retries and stats
+
+UPSTREAM_MODE selects where responses come from:
+  live    (default) call the real APIs
+  record  call the real APIs and save successful responses to UPSTREAM_STORE
+  replay  answer from UPSTREAM_STORE only, after UPSTREAM_REPLAY_LATENCY_MS
+          ('50' or a '20-80' range); unrecorded requests get a 404
+UPSTREAM_STUB_URL sends live/record traffic to stub_upstream.py instead.
+
+aget() is the asyncio twin of get() for the ASGI server (needs httpx). Both
+share each provider's rate limiter and stats.
+"""
+
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Requests per minute and burst size for each provider. Override with
+# <PROVIDER>_RATE_PER_MIN / <PROVIDER>_BURST in .env (UPSTREAM_MAX_RETRIES for retries)
+PROVIDER_DEFAULTS = {
+    'openweather': {'rate_per_min': 60, 'burst': 10},
+    'serpapi': {'rate_per_min': 30, 'burst': 5},
+}
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+BACKOFF_BASE = 0.5   # seconds; doubled on every retry
+BACKOFF_CAP = 8.0
+
+
+class RateLimited(requests.RequestException):
+    """No rate limit token became available before the request timeout"""
+
+
+class TokenBucket:
+    """Classic token bucket refilled continuously at rate tokens per second"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        """Take one token if available and return 0, else the seconds until one is"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self, max_wait):
+        """Take one token, sleeping up to max_wait seconds; return seconds waited or None"""
+        deadline = time.monotonic() + max_wait
+        waited = 0.0
+        while True:
+            delay = self.try_acquire()
+            if not delay:
+                return waited
+            if time.monotonic() + delay > deadline:
+                return None
+            time.sleep(delay)
+            waited += delay
+
+    async def acquire_async(self, max_wait):
+        """acquire() that waits with asyncio.sleep instead of blocking the thread"""
+        deadline = time.monotonic() + max_wait
+        waited = 0.0
+        while True:
+            delay = self.try_acquire()
+            if not delay:
+                return waited
+            if time.monotonic() + delay > deadline:
+                return None
+            await asyncio.sleep(delay)
+            waited += delay
+
+
+class Provider:
+    """Session, limiter and latency/error counters for one upstream API"""
+
+    def __init__(self, name):
+        defaults = PROVIDER_DEFAULTS.get(name, {'rate_per_min': 60, 'burst': 10})
+        rate_per_min = float(os.getenv(f'{name.upper()}_RATE_PER_MIN', defaults['rate_per_min']))
+        burst = float(os.getenv(f'{name.upper()}_BURST', defaults['burst']))
+
+        self.name = name
+        self.max_retries = int(os.getenv('UPSTREAM_MAX_RETRIES', '2'))
+        self.bucket = TokenBucket(rate_per_min / 60, burst)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._async_client = None  # (event loop, httpx.AsyncClient), created by aget()
+
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=1000)  # seconds, successful round trips
+        self.counters = {'requests': 0, 'errors': 0, 'retries': 0, 'throttled': 0, 'throttle_wait_s': 0.0}
+
+    def count(self, key, amount=1):
+        with self._lock:
+            self.counters[key] += amount
+
+    def async_client(self):
+        """httpx.AsyncClient for the running event loop (clients cannot be shared across loops)"""
+        import httpx
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_client[0] is not loop:
+            limits = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+            self._async_client = (loop, httpx.AsyncClient(limits=limits))
+        return self._async_client[1]
+
+    def record_latency(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            counters = dict(self.counters)
+
+        def pct(p):
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 1) if latencies else None
+
+        return {
+            **counters,
+            'throttle_wait_s': round(counters['throttle_wait_s'], 3),
+            'latency_ms': {'p50': pct(0.50), 'p95': pct(0.95), 'max': pct(1.0), 'samples': len(latencies)},
+        }
+
+
+_providers = {}
+_providers_lock = threading.Lock()
+_upstream = None
+
+
+def _provider(name):
+    # Created lazily so .env has been loaded by the calling script
+    with _providers_lock:
+        if name not in _providers:
+            _providers[name] = Provider(name)
+        return _providers[name]
+
+
+def _upstream_mode():
+    # (mode, store, replay latency, stub URL), read once after .env is loaded
+    global _upstream
+    with _providers_lock:
+        if _upstream is None:
+            from upstream_store import UpstreamStore, parse_latency
+            mode = os.getenv('UPSTREAM_MODE', 'live').lower()
+            if mode not in ('live', 'record', 'replay'):
+                raise ValueError(f'UPSTREAM_MODE must be live, record or replay, not {mode!r}')
+            store = UpstreamStore(os.getenv('UPSTREAM_STORE', 'upstream_store.json.gz')) if mode != 'live' else None
+            _upstream = (mode, store, parse_latency(os.getenv('UPSTREAM_REPLAY_LATENCY_MS', '0')),
+                         os.getenv('UPSTREAM_STUB_URL', '').rstrip('/'))
+        return _upstream
+
+
+def get(provider, url, timeout=10, **kwargs):
+    """GET through the provider's pooled session
+
+    Waits for a rate limit token (at most timeout seconds), then retries
+    connection errors, 429 and 5xx responses with exponential backoff and
+    full jitter, honouring Retry-After. Returns the final requests.Response.
+    In replay mode the response comes from the store without touching the
+    network or the rate limiter.
+    """
+    p = _provider(provider)
+    mode, store, latency, stub_url = _upstream_mode()
+
+    if mode == 'replay':
+        from upstream_store import sleep_latency
+        p.count('requests')
+        start = time.perf_counter()
+        sleep_latency(latency)
+        r = store.response(url)
+        p.record_latency(time.perf_counter() - start)
+        if r.status_code >= 400:
+            p.count('errors')
+        return r
+
+    r = _send(p, provider, _stub_url(url, stub_url), timeout, **kwargs)
+    if mode == 'record':
+        store.record(url, r)
+    return r
+
+
+def _stub_url(url, stub_url):
+    # https://host/path?q is served by the stub server as <stub_url>/host/path?q
+    if not stub_url:
+        return url
+    parts = urlsplit(url)
+    return f'{stub_url}/{parts.netloc}{parts.path}' + (f'?{parts.query}' if parts.query else '')
+
+
+def _send(p, provider, url, timeout, **kwargs):
+    # Rate-limited GET with retries; returns the final requests.Response
+
+    for attempt in range(p.max_retries + 1):
+        waited = p.bucket.acquire(timeout)
+        if waited is None:
+            p.count('throttled')
+            p.count('errors')
+            raise RateLimited(f'{provider} rate limit: no token within {timeout}s')
+        if waited:
+            p.count('throttle_wait_s', waited)
+
+        p.count('requests')
+        start = time.perf_counter()
+        try:
+            r = p.session.get(url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            p.count('errors')
+            if attempt == p.max_retries:
+                raise
+            retry_after = None
+        else:
+            if r.status_code not in RETRY_STATUSES:
+                p.record_latency(time.perf_counter() - start)
+                if r.status_code >= 400:
+                    p.count('errors')
+                return r
+            p.count('errors')
+            if attempt == p.max_retries:
+                return r
+            retry_after = r.headers.get('Retry-After')
+
+        p.count('retries')
+        delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, min(float(retry_after), BACKOFF_CAP))
+        time.sleep(delay)
+
+
+async def aget(provider, url, timeout=10, **kwargs):
+    """Async GET with the same rate limiting, retries, stats and record/replay as get()
+
+    Returns an httpx.Response (or a replayed requests.Response); both have
+    status_code, headers, text and json(). Waiting for a token or a backoff
+    holds no thread.
+    """
+    p = _provider(provider)
+    mode, store, latency, stub_url = _upstream_mode()
+
+    if mode == 'replay':
+        from upstream_store import pick_latency
+        p.count('requests')
+        start = time.perf_counter()
+        await asyncio.sleep(pick_latency(latency))
+        r = store.response(url)
+        p.record_latency(time.perf_counter() - start)
+        if r.status_code >= 400:
+            p.count('errors')
+        return r
+
+    r = await _asend(p, provider, _stub_url(url, stub_url), timeout, **kwargs)
+    if mode == 'record':
+        await asyncio.to_thread(store.record, url, r)
+    return r
+
+
+async def _asend(p, provider, url, timeout, **kwargs):
+    # _send() on the provider's httpx.AsyncClient
+    import httpx
+
+    for attempt in range(p.max_retries + 1):
+        waited = await p.bucket.acquire_async(timeout)
+        if waited is None:
+            p.count('throttled')
+            p.count('errors')
+            raise RateLimited(f'{provider} rate limit: no token within {timeout}s')
+        if waited:
+            p.count('throttle_wait_s', waited)
+
+        p.count('requests')
+        start = time.perf_counter()
+        try:
+            r = await p.async_client().get(url, timeout=timeout, **kwargs)
+        except httpx.TransportError:
+            p.count('errors')
+            if attempt == p.max_retries:
+                raise
+            retry_after = None
+        else:
+            if r.status_code not in RETRY_STATUSES:
+                p.record_latency(time.perf_counter() - start)
+                if r.status_code >= 400:
+                    p.count('errors')
+                return r
+            p.count('errors')
+            if attempt == p.max_retries:
+                return r
+            retry_after = r.headers.get('Retry-After')
+
+        p.count('retries')
+        delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, min(float(retry_after), BACKOFF_CAP))
+        await asyncio.sleep(delay)
+
+
+def stats():
+    """Per-provider request, error, retry, throttle and latency figures"""
+    with _providers_lock:
+        providers = dict(_providers)
+        upstream = _upstream
+    result = {name: p.stats() for name, p in providers.items()}
+    if upstream is not None and upstream[1] is not None:
+        result['store'] = {'mode': upstream[0], 'entries': len(upstream[1]), **upstream[1].stats}
+    return result
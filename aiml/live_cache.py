@@ -0,0 +1,190 @@
+"""
+Live Data Cache
+In-process TTL cache with single-flight fetching for OpenWeather lookups
+"""
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Bounded TTL cache where concurrent misses for one key share a fetch
+
+    Entries expire ttl seconds after they were fetched. When max_entries is
+    exceeded the least recently used entry is evicted. Fetches that return
+    None (upstream error) are handed to every waiting caller but not stored,
+    so the next request tries again.
+
+    on_refresh(key) is called when a newly stored value differs from the one
+    it replaces, so anything derived from the previous value can be dropped.
+    Expired entries stay readable through get(key, stale=True) and
+    get_or_fetch(key, fetch, stale=True) until they are evicted, which lets
+    a background refresher serve its last good value.
+    """
+
+    def __init__(self, ttl=300, max_entries=256, on_refresh=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.on_refresh = on_refresh
+        self._entries = OrderedDict()  # key -> (expires_at, value, fetched_at)
+        self._inflight = {}            # key -> {'event', 'value', 'error'}
+        self._ainflight = {}           # key -> asyncio.Future of (value, error), see aget_or_fetch
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'evictions': 0}
+
+    def get_or_fetch(self, key, fetch, stale=False):
+        """Return the cached value for key, calling fetch() at most once per miss
+
+        With stale=True an expired entry is returned rather than refetched.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (stale or entry[0] > time.monotonic()):
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return entry[1]
+
+            call = self._inflight.get(key)
+            if call is not None:
+                self._stats['coalesced'] += 1
+                leader = False
+            else:
+                call = {'event': threading.Event(), 'value': None, 'error': None}
+                self._inflight[key] = call
+                self._stats['misses'] += 1
+                leader = True
+
+        if not leader:
+            call['event'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['value']
+
+        try:
+            call['value'] = fetch()
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                changed = call['error'] is None and call['value'] is not None and self._store(key, call['value'])
+                del self._inflight[key]
+            call['event'].set()
+
+        if changed and self.on_refresh is not None:
+            self.on_refresh(key)
+
+        return call['value']
+
+    async def aget_or_fetch(self, key, fetch, stale=False):
+        """get_or_fetch() for coroutines: await fetch() at most once per miss
+
+        Callers waiting on another caller's fetch hold no thread. Async and
+        threaded fetches of the same key are not coalesced with each other.
+        If the fetching caller is cancelled, its cancellation is not passed
+        on: the waiters retry and one of them fetches instead.
+        """
+        retry = False
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and (stale or entry[0] > time.monotonic()):
+                    self._entries.move_to_end(key)
+                    if not retry:
+                        self._stats['hits'] += 1
+                    return entry[1]
+
+                waiter = self._ainflight.get(key)
+                if waiter is not None:
+                    if not retry:
+                        self._stats['coalesced'] += 1
+                else:
+                    self._ainflight[key] = asyncio.get_running_loop().create_future()
+                    # A retrying waiter was counted as coalesced; it fetches after all
+                    if retry:
+                        self._stats['coalesced'] -= 1
+                    self._stats['misses'] += 1
+
+            if waiter is None:
+                break
+            value, error = await asyncio.shield(waiter)
+            if isinstance(error, asyncio.CancelledError):
+                retry = True
+                continue
+            if error is not None:
+                raise error
+            return value
+
+        value, error = None, None
+        try:
+            value = await fetch()
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            with self._lock:
+                changed = error is None and value is not None and self._store(key, value)
+                self._ainflight.pop(key).set_result((value, error))
+
+        if changed and self.on_refresh is not None:
+            self.on_refresh(key)
+
+        return value
+
+    def get(self, key, stale=False):
+        """Cached value for key, or None when missing or expired (stale=True: missing only)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (stale or entry[0] > time.monotonic()):
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return entry[1]
+            self._stats['misses'] += 1
+            return None
+
+    def put(self, key, value, fetched_at=None):
+        """Store value for key, replacing any earlier entry
+
+        fetched_at (epoch seconds, default now) is reported by fetched_at();
+        the entry expires ttl seconds from now either way.
+        """
+        with self._lock:
+            changed = self._store(key, value, fetched_at)
+        if changed and self.on_refresh is not None:
+            self.on_refresh(key)
+
+    def fetched_at(self, key):
+        """Wall-clock time (epoch seconds) the cached value for key was stored, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[2] if entry is not None else None
+
+    def invalidate(self, key=None):
+        """Drop one key, or everything when key is None"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self):
+        """Hit/miss counters plus current size"""
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses'] + self._stats['coalesced']
+            return {
+                **self._stats,
+                'size': len(self._entries),
+                'hit_rate': (self._stats['hits'] + self._stats['coalesced']) / lookups if lookups else 0.0,
+            }
+
+    def _store(self, key, value, fetched_at=None):
+        # Returns True when the value differs from the one it replaces
+        previous = self._entries.get(key)
+        self._entries[key] = (time.monotonic() + self.ttl, value, time.time() if fetched_at is None else fetched_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats['evictions'] += 1
+        return previous is None or previous[1] != value
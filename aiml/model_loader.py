@@ -0,0 +1,178 @@
+"""
+Model Loader
+Builds the GPT-2 model and tokenizer used by every entry point
+"""
+
+import contextlib
+import os
+import torch
+import transformers
+from transformers import GPT2Config, GPT2LMHeadModel, GPT2TokenizerFast
+from transformers.pytorch_utils import Conv1D
+
+
+def _silent(*args, **kwargs):
+    pass
+
+
+def _no_init_weights():
+    # Skips the random init of a model we are about to overwrite; the
+    # uninitialised storages are never written, so they never become resident
+    try:
+        from transformers.initialization import no_init_weights
+    except ImportError:
+        try:
+            from transformers.modeling_utils import no_init_weights
+        except ImportError:
+            return contextlib.nullcontext()
+    return no_init_weights()
+
+
+def load_fp32(model_path, device, log=_silent):
+    """GPT-2 with the fine-tuned weights from model_path when present
+
+    The model is built from its config without initialising weights, and
+    best_model.pt is memory-mapped and assigned straight into it. Only one
+    copy of the weights is ever made, and it is file-backed page cache, so
+    several processes on one host share it. Checkpoints in the legacy
+    (non-zip) format cannot be mapped and fall back to a regular load.
+    """
+    if not os.path.exists(model_path):
+        log(f'⚠️  Warning: {model_path} not found. Using base GPT-2.')
+        return GPT2LMHeadModel.from_pretrained('gpt2').to(device).eval()
+
+    log(f'✅ Loading trained model from {model_path}')
+    with _no_init_weights():
+        model = GPT2LMHeadModel(GPT2Config.from_pretrained('gpt2'))
+
+    try:
+        state_dict = torch.load(model_path, map_location='cpu', mmap=True, weights_only=True)
+    except RuntimeError as e:
+        log(f'⚠️  Could not memory-map {model_path} ({e}), loading it into memory')
+        state_dict = torch.load(model_path, map_location='cpu')
+
+    model.load_state_dict(state_dict, assign=True)
+    model.tie_weights()
+
+    return model.to(device).eval()
+
+
+def load_draft(draft_path, device, vocab_size, log=_silent):
+    """Small GPT-2 that proposes tokens for speculative decoding
+
+    draft_path is a saved model directory or hub name (e.g. distilgpt2), or
+    a state dict .pt such as a distilled best_model.pt. The layer count and
+    width of a .pt are read from its weights. The draft must share GPT-2's
+    vocabulary, since its tokens are verified by the main model.
+    """
+    if os.path.isfile(draft_path):
+        log(f'✅ Loading draft model from {draft_path}')
+        try:
+            state_dict = torch.load(draft_path, map_location='cpu', mmap=True, weights_only=True)
+        except RuntimeError:
+            state_dict = torch.load(draft_path, map_location='cpu')
+        n_positions, n_embd = state_dict['transformer.wpe.weight'].shape
+        n_layer = 1 + max(int(key.split('.')[2]) for key in state_dict if key.startswith('transformer.h.'))
+        # Attention heads keep GPT-2's width
+        config = GPT2Config.from_pretrained('gpt2')
+        config.n_head = n_embd // (config.n_embd // config.n_head)
+        config.n_layer, config.n_embd, config.n_positions = n_layer, n_embd, n_positions
+        with _no_init_weights():
+            draft = GPT2LMHeadModel(config)
+        draft.load_state_dict(state_dict, assign=True)
+        draft.tie_weights()
+    else:
+        log(f'✅ Loading draft model {draft_path}')
+        draft = GPT2LMHeadModel.from_pretrained(draft_path)
+
+    if draft.config.vocab_size != vocab_size:
+        raise ValueError(f'Draft model {draft_path} has a vocabulary of {draft.config.vocab_size} tokens, '
+                         f'the model has {vocab_size}')
+
+    return draft.to(device).eval()
+
+
+def conv1d_to_linear(model):
+    """Swap GPT-2's Conv1D projections for equivalent nn.Linear layers
+
+    Conv1D stores its weight as [in, out]; dynamic quantization only rewrites
+    nn.Linear, so the attention and MLP projections have to be converted
+    first or they would stay fp32.
+    """
+    for name, module in list(model.named_modules()):
+        for child_name, child in list(module.named_children()):
+            if isinstance(child, Conv1D):
+                in_features, out_features = child.weight.shape
+                linear = torch.nn.Linear(in_features, out_features)
+                linear.weight.data = child.weight.data.t().contiguous()
+                linear.bias.data = child.bias.data
+                setattr(module, child_name, linear)
+    return model
+
+
+def quantize_int8(model):
+    """Int8 dynamic quantization of every linear layer (weights int8, activations fp32)"""
+    model = conv1d_to_linear(model)
+    # lm_head shares its weight with the token embedding; quantizing it needs
+    # its own copy, the embedding itself stays fp32
+    model.lm_head.weight = torch.nn.Parameter(model.lm_head.weight.detach().clone())
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def _cache_key(model_path):
+    # Rebuild when the fine-tuned weights or the torch/transformers versions change
+    if os.path.exists(model_path):
+        st = os.stat(model_path)
+        source = f'{st.st_size}-{int(st.st_mtime)}'
+    else:
+        source = 'base-gpt2'
+    return f'{source}-torch{torch.__version__}-transformers{transformers.__version__}'
+
+
+def load_int8(model_path, cache_path, log=_silent):
+    """Int8 model, loaded from cache_path or quantized from fp32 and cached there"""
+    key = _cache_key(model_path)
+
+    if cache_path and os.path.exists(cache_path):
+        try:
+            cached = torch.load(cache_path, map_location='cpu', weights_only=False)
+            if cached.get('key') == key:
+                log(f'✅ Loading int8 model from {cache_path}')
+                return cached['model'].eval()
+            log(f'♻️  {cache_path} is stale, re-quantizing')
+        except Exception as e:
+            log(f'⚠️  Could not read {cache_path} ({e}), re-quantizing')
+
+    log('📦 Quantizing linear layers to int8...')
+    model = quantize_int8(load_fp32(model_path, 'cpu', log)).eval()
+
+    if cache_path:
+        tmp_path = f'{cache_path}.tmp'
+        torch.save({'key': key, 'model': model}, tmp_path)
+        os.replace(tmp_path, cache_path)
+        log(f'💾 Cached int8 model at {cache_path}')
+
+    return model
+
+
+def load_model(model_path, quantize=False, cache_path=None, log=_silent):
+    """Return (model, tokenizer, device)
+
+    quantize=True selects the int8 dynamic-quantized engine, which only runs
+    on CPU; on a CUDA host it is ignored and the fp32 model is used.
+    """
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    log(f'📦 Device: {device}')
+
+    log('📦 Loading GPT-2 model and tokenizer...')
+    tokenizer = GPT2TokenizerFast.from_pretrained('gpt2')
+    tokenizer.pad_token = tokenizer.eos_token
+
+    if quantize and device == 'cpu':
+        model = load_int8(model_path, cache_path, log)
+    else:
+        if quantize:
+            log('⚠️  Int8 quantization is CPU-only, using fp32 on CUDA')
+        model = load_fp32(model_path, device, log)
+
+    return model, tokenizer, device
@@ -0,0 +1,101 @@
+"""
+Prefix KV Cache
+Reuses the past_key_values of shared prompt prefixes (a city's live-data lines)
+"""
+
+import threading
+from collections import OrderedDict
+
+from generation import cache_from_legacy, cache_to_legacy
+
+
+def _nbytes(past):
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in past)
+
+
+class PrefixCache:
+    """LRU of prefix past_key_values, keyed by the exact prefix token IDs
+
+    Entries are bounded by max_bytes of key/value tensors; the least recently
+    used ones are evicted first. Each entry carries a tag (the city) so all
+    prefixes built from one city's live data can be dropped when that data is
+    refreshed. Stored tensors are never written to: the model's cache
+    concatenates new steps into fresh tensors.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # tuple(prefix ids) -> (tag, past, nbytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0, 'reused_tokens': 0}
+
+    def get(self, prefix):
+        """Legacy past_key_values for prefix, or None"""
+        key = tuple(prefix)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            self._stats['reused_tokens'] += len(key)
+            return entry[1]
+
+    def put(self, prefix, past, tag=None):
+        """Store a batch-1 legacy past_key_values for prefix"""
+        key = tuple(prefix)
+        nbytes = _nbytes(past)
+        if nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._entries[key] = (tag, past, nbytes)
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes:
+                _, (_, _, dropped) = self._entries.popitem(last=False)
+                self._bytes -= dropped
+                self._stats['evictions'] += 1
+
+    def invalidate(self, tag=None):
+        """Drop every prefix with this tag, or everything when tag is None"""
+        with self._lock:
+            keys = [key for key, entry in self._entries.items() if tag is None or entry[0] == tag]
+            for key in keys:
+                self._bytes -= self._entries.pop(key)[2]
+            self._stats['invalidations'] += len(keys)
+
+    def prefill(self, model, ids, prefix_len, tag=None):
+        """Run a [1, n] prompt through model, reusing the KV of ids[:, :prefix_len]
+
+        On a miss the prefix is run on its own and stored before the rest of
+        the prompt is fed on top of it. Returns (model output, reused tokens).
+        """
+        if prefix_len <= 0 or prefix_len >= ids.size(1):
+            return model(ids, use_cache=True), 0
+
+        prefix = ids[0, :prefix_len].tolist()
+        past = self.get(prefix)
+        reused = prefix_len if past is not None else 0
+        if past is None:
+            past = cache_to_legacy(model(ids[:, :prefix_len], use_cache=True).past_key_values)
+            self.put(prefix, past, tag)
+
+        out = model(ids[:, prefix_len:], past_key_values=cache_from_legacy(past), use_cache=True)
+        return out, reused
+
+    def stats(self):
+        """Hit/miss counters plus current size"""
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return {
+                **self._stats,
+                'entries': len(self._entries),
+                'mb': round(self._bytes / 2 ** 20, 2),
+                'max_mb': round(self.max_bytes / 2 ** 20, 2),
+                'hit_rate': self._stats['hits'] / lookups if lookups else 0.0,
+            }
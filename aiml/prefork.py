@@ -0,0 +1,334 @@
+"""
+Pre-fork Server
+Loads the model once, then forks weather_server.py workers that share its weights and listening socket
+"""
+
+import argparse
+import gc
+import json
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+from dotenv import load_dotenv
+from flask import jsonify
+
+# Worker health files are rewritten, and live data refreshed by the other
+# workers picked up, this often; a worker silent for three intervals is
+# reported as not alive
+HEARTBEAT_INTERVAL = 1.0
+# A worker that dies sooner than this after starting is restarted after a pause
+MIN_UPTIME = 5.0
+
+
+def default_workers():
+    return max(1, min(4, (os.cpu_count() or 1) // 2))
+
+
+def worker_cpus(index, threads):
+    """CPUs worker index is pinned to: threads consecutive cores, wrapping around"""
+    available = sorted(os.sched_getaffinity(0))
+    return {available[(index * threads + i) % len(available)] for i in range(threads)}
+
+
+def write_json(path, data):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def read_json(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SharedLiveData:
+    """Refreshed live data passed between workers through files in path
+
+    Each worker's refresher puts its share of the lookups here; put() stores
+    the value in the worker's own live cache and writes it out, and sync()
+    copies values written by the other workers into this worker's cache.
+    """
+
+    def __init__(self, cache, path):
+        self.cache = cache
+        self.path = path
+        self._seen = {}  # file name -> mtime_ns already copied
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def _name(key):
+        return '--'.join(key).replace(' ', '_').replace(os.sep, '_') + '.json'
+
+    def put(self, key, value):
+        fetched_at = time.time()
+        self.cache.put(key, value, fetched_at=fetched_at)
+        path = os.path.join(self.path, self._name(key))
+        write_json(path, {'key': list(key), 'value': value, 'fetched_at': fetched_at})
+        self._seen[self._name(key)] = os.stat(path).st_mtime_ns
+
+    def sync(self):
+        """Copy values the other workers refreshed since the last call"""
+        for entry in os.scandir(self.path):
+            if not entry.name.endswith('.json'):
+                continue
+            mtime = entry.stat().st_mtime_ns
+            if self._seen.get(entry.name) == mtime:
+                continue
+            data = read_json(entry.path)
+            if data is None:
+                continue
+            self._seen[entry.name] = mtime
+            self.cache.put(tuple(data['key']), data['value'], fetched_at=data['fetched_at'])
+
+
+class Worker:
+    """One forked server process: pinned torch threads, its own batching thread and caches"""
+
+    def __init__(self, ws, index, count, sock, state_dir, threads, pin):
+        self.ws = ws
+        self.index = index
+        self.count = count
+        self.sock = sock
+        self.state_dir = state_dir
+        self.threads = threads
+        self.cpus = worker_cpus(index, threads) if pin and hasattr(os, 'sched_setaffinity') else None
+        self.started_at = time.time()
+        self.shared = None
+
+    def run(self):
+        import torch
+        from werkzeug.serving import make_server
+
+        if self.cpus:
+            os.sched_setaffinity(0, self.cpus)
+        torch.set_num_threads(self.threads)
+
+        ws = self.ws
+        ws.init_model()
+        # Each worker refreshes its share of the lookups and picks up the
+        # rest from the others, so every worker's cache stays warm at the
+        # upstream cost of a single refresher
+        if ws.LIVE_REFRESH_INTERVAL > 0 and ws.OPENWEATHER_API_KEY:
+            self.shared = SharedLiveData(ws.live_cache, os.path.join(self.state_dir, 'live'))
+            ws.start_refresher(cache=self.shared, share=(self.index, self.count))
+
+        ws.app.view_functions['health'] = self.health
+        threading.Thread(target=self._heartbeat, name='worker-heartbeat', daemon=True).start()
+
+        server = make_server('0.0.0.0', self.sock.getsockname()[1], ws.app, threaded=True, fd=self.sock.fileno())
+        print(f'👷 Worker {self.index} (pid {os.getpid()}) serving with {self.threads} torch threads'
+              + (f' on CPUs {sorted(self.cpus)}' if self.cpus else ''))
+        server.serve_forever()
+
+    def status(self):
+        """This worker's entry in /health workers"""
+        import torch
+
+        ws = self.ws
+        return {
+            'worker': self.index,
+            'pid': os.getpid(),
+            'started_at': ws.iso_time(self.started_at),
+            'heartbeat_at': time.time(),
+            'model_loaded': ws.model is not None,
+            'torch_threads': torch.get_num_threads(),
+            'cpus': sorted(self.cpus) if self.cpus else None,
+            'requests': int(ws.REQUESTS.total()),
+            'in_flight': int(ws.IN_FLIGHT.total()),
+            'batching': dict(ws.scheduler.totals) if ws.scheduler is not None else None,
+            'refresh_keys': len(ws.refresher.own) if ws.refresher is not None else 0,
+        }
+
+    def _heartbeat(self):
+        path = os.path.join(self.state_dir, f'worker-{self.index}.json')
+        while True:
+            try:
+                write_json(path, self.status())
+                if self.shared is not None:
+                    self.shared.sync()
+            except OSError as e:
+                print(f'⚠️  Worker {self.index} heartbeat failed: {e}')
+            time.sleep(HEARTBEAT_INTERVAL)
+
+    def health(self):
+        """weather_server /health plus the state of every worker"""
+        report = self.ws.health_report()
+        report['worker'] = self.index
+        report['workers'] = workers_health(self.state_dir)
+        return jsonify(report)
+
+
+def workers_health(state_dir):
+    """Last heartbeat of every worker with liveness and restart counts from the supervisor"""
+    supervisor = read_json(os.path.join(state_dir, 'supervisor.json')) or {'workers': {}}
+    now = time.time()
+    workers = []
+    for index, info in sorted(supervisor['workers'].items(), key=lambda item: int(item[0])):
+        status = read_json(os.path.join(state_dir, f'worker-{index}.json')) or {'worker': int(index)}
+        if status.get('pid') != info['pid']:
+            # The replacement has not reported yet
+            status = {'worker': int(index), 'pid': info['pid']}
+        heartbeat = status.pop('heartbeat_at', None)
+        status['alive'] = (heartbeat is not None and now - heartbeat < 3 * HEARTBEAT_INTERVAL
+                           and pid_alive(info['pid']))
+        status['heartbeat_age_s'] = round(now - heartbeat, 1) if heartbeat is not None else None
+        status['restarts'] = info['restarts']
+        status['last_exit'] = info['last_exit']
+        workers.append(status)
+    return workers
+
+
+class Supervisor:
+    """Forks the workers, restarts any that die and stops them all on SIGINT/SIGTERM"""
+
+    def __init__(self, ws, sock, workers, threads, pin):
+        self.ws = ws
+        self.sock = sock
+        self.count = workers
+        self.threads = threads
+        self.pin = pin
+        self.state_dir = tempfile.mkdtemp(prefix='aerosense-workers-')
+        self.workers = {}  # index -> {'pid', 'started', 'restarts', 'last_exit'}
+
+    def spawn(self, index):
+        info = self.workers.setdefault(index, {'pid': None, 'started': 0, 'restarts': 0, 'last_exit': None})
+        # Unflushed output would be printed again by the child
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 0
+            try:
+                Worker(self.ws, index, self.count, self.sock, self.state_dir, self.threads, self.pin).run()
+            except BaseException as e:
+                print(f'❌ Worker {index} failed: {e}')
+                code = 1
+            finally:
+                os._exit(code)
+
+        info['pid'] = pid
+        info['started'] = time.monotonic()
+        self.save()
+
+    def save(self):
+        write_json(os.path.join(self.state_dir, 'supervisor.json'), {
+            'workers': {str(i): {k: info[k] for k in ('pid', 'restarts', 'last_exit')} for i, info in self.workers.items()}
+        })
+
+    def run(self):
+        def stop(signum, frame):
+            raise SystemExit(0)
+
+        signal.signal(signal.SIGTERM, stop)
+        try:
+            for index in range(self.count):
+                self.spawn(index)
+            self.supervise()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            self.stop()
+
+    def supervise(self):
+        while True:
+            pid, status = os.wait()
+            index = next((i for i, info in self.workers.items() if info['pid'] == pid), None)
+            if index is None:
+                continue
+
+            info = self.workers[index]
+            code = os.waitstatus_to_exitcode(status)
+            info['last_exit'] = f'signal {-code}' if code < 0 else f'exit {code}'
+            info['restarts'] += 1
+            print(f'⚠️  Worker {index} (pid {pid}) died ({info["last_exit"]}), restarting')
+            if time.monotonic() - info['started'] < MIN_UPTIME:
+                time.sleep(MIN_UPTIME)
+            self.spawn(index)
+
+    def stop(self):
+        pids = [info['pid'] for info in self.workers.values()]
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in pids:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        shutil.rmtree(self.state_dir, ignore_errors=True)
+        print('👋 All workers stopped')
+
+
+def split_rate_limits(workers):
+    """Give each worker its share of the upstream quotas (the token buckets are per process)"""
+    for provider, rate, burst in (('OPENWEATHER', '60', '10'), ('SERPAPI', '30', '5')):
+        per_min = float(os.getenv(f'{provider}_RATE_PER_MIN', rate))
+        os.environ[f'{provider}_RATE_PER_MIN'] = str(per_min / workers)
+        os.environ[f'{provider}_BURST'] = str(max(1.0, float(os.getenv(f'{provider}_BURST', burst)) / workers))
+
+
+def main():
+    # Before anything reads the environment: split_rate_limits() sets the
+    # quota variables, which load_dotenv() would then no longer override
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='Serve weather_server.py from several pre-forked processes')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('SERVER_WORKERS', '0')) or default_workers())
+    parser.add_argument('--threads-per-worker', type=int, default=int(os.getenv('TORCH_THREADS_PER_WORKER', '0')),
+                        help='torch intra-op threads per worker (default: CPUs / workers)')
+    parser.add_argument('--pin-cpus', action='store_true', default=os.getenv('PIN_WORKER_CPUS', '0') == '1',
+                        help='pin each worker to its own cores')
+    parser.add_argument('--port', type=int, default=5001)
+    args = parser.parse_args()
+
+    threads = args.threads_per_worker or max(1, (os.cpu_count() or 1) // args.workers)
+    split_rate_limits(args.workers)
+    # Tokenizers and torch must not start thread pools before the fork
+    os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')
+
+    import torch
+    if torch.cuda.is_available():
+        parser.error('pre-fork serving is CPU-only (CUDA cannot be used across fork); run weather_server.py')
+    torch.set_num_threads(1)
+
+    import weather_server as ws
+
+    ws.load_weights()
+    # Keep the garbage collector from writing to the parent's objects in
+    # every worker, which would copy their pages
+    gc.collect()
+    gc.freeze()
+
+    # Every worker accepts from this one socket. Non-blocking, so a worker
+    # that loses the race for a connection goes back to waiting
+    sock = socket.create_server(('0.0.0.0', args.port), backlog=1024)
+    sock.setblocking(False)
+    sock.set_inheritable(True)
+    print(f'🚀 Starting {args.workers} workers on http://localhost:{args.port} ({threads} torch threads each)')
+    Supervisor(ws, sock, args.workers, threads, args.pin_cpus).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Live Data Refresher
+Background thread that keeps live data cache entries warm
+"""
+
+import threading
+import time
+
+
+class Refresher:
+    """Re-fetches a fixed set of cache keys on an interval
+
+    jobs maps cache keys to fetch functions. A warm-up pass runs the fetches
+    back to back (the HTTP client's rate limiter still applies) so the cache
+    fills soon after startup. After that the fetches are spaced evenly over
+    interval seconds, so every key is refreshed once per interval at a steady,
+    low request rate. A fetch that fails or returns None leaves the previous
+    value in the cache, so readers passing stale=True to cache.get() or
+    cache.get_or_fetch() keep getting the last known good value.
+
+    With share=(index, count) only every count-th key starting at index is
+    fetched, so count processes can split one set of jobs between them.
+    jobs still lists every key.
+    """
+
+    def __init__(self, cache, jobs, interval, log=print, share=None):
+        self.cache = cache
+        self.jobs = dict(jobs)
+        index, count = share or (0, 1)
+        self.share = share
+        self.own = [key for i, key in enumerate(self.jobs) if i % count == index]
+        self.interval = interval
+        self.log = log
+        self.passes = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._status = {key: {'refreshes': 0, 'failures': 0, 'last_ok': None, 'last_error': None} for key in self.own}
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='live-refresher', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def refresh(self, key):
+        """Fetch one key now; returns True when the cache was updated"""
+        try:
+            value = self.jobs[key]()
+            error = None if value is not None else 'no data'
+        except Exception as e:
+            value, error = None, str(e)
+
+        with self._lock:
+            status = self._status[key]
+            status['last_error'] = error
+            if value is None:
+                status['failures'] += 1
+            else:
+                status['refreshes'] += 1
+                status['last_ok'] = time.time()
+
+        if value is None:
+            return False
+        self.cache.put(key, value)
+        return True
+
+    def stats(self):
+        """Pass count, keys whose last refresh failed and per-key counters"""
+        with self._lock:
+            status = {'/'.join(key) if isinstance(key, tuple) else str(key): dict(s) for key, s in self._status.items()}
+        return {
+            'interval_s': self.interval,
+            'passes': self.passes,
+            'keys': len(self.own),
+            'share': list(self.share) if self.share else None,
+            'failing': sorted(name for name, s in status.items() if s['last_error']),
+            'status': status,
+        }
+
+    def _run(self):
+        if not self.own:
+            return
+        self._pass(spacing=0)
+        spacing = self.interval / len(self.own)
+        while not self._stop.is_set():
+            self._pass(spacing)
+
+    def _pass(self, spacing):
+        started = time.monotonic()
+        failed = 0
+        for i, key in enumerate(self.own):
+            if spacing and self._stop.wait(max(0.0, started + (i + 1) * spacing - time.monotonic())):
+                return
+            failed += not self.refresh(key)
+
+        self.passes += 1
+        if self.passes == 1:
+            self.log(f'🔄 Live data warmed for {len(self.own) - failed}/{len(self.own)} lookups')
+        elif failed:
+            self.log(f'⚠️  Live data refresh: {failed}/{len(self.own)} lookups failed, serving last known values')
@@ -0,0 +1,70 @@
+"""
+Concurrent Retrieval
+Runs the AQI, weather and web search lookups in parallel under one deadline
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# Shared by every request; lookups that miss the deadline keep running here
+# and still fill the live data cache for the next request
+_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='retrieval')
+
+# Async lookups past their deadline, referenced until they finish
+_background = set()
+
+
+def fetch_all(tasks, deadline):
+    """Run {name: fn} concurrently and return (results, sources)
+
+    results holds the value of every task that finished within deadline
+    seconds without raising. sources maps each task name to 'ok', 'empty'
+    (returned None), 'error' or 'timeout'.
+    """
+    futures = {name: _executor.submit(fn) for name, fn in tasks.items()}
+    done, _ = wait(futures.values(), timeout=deadline)
+
+    results = {}
+    sources = {}
+    for name, future in futures.items():
+        if future not in done:
+            sources[name] = 'timeout'
+        elif future.exception() is not None:
+            sources[name] = 'error'
+        elif future.result() is None:
+            sources[name] = 'empty'
+        else:
+            results[name] = future.result()
+            sources[name] = 'ok'
+
+    return results, sources
+
+
+async def afetch_all(coros, deadline):
+    """fetch_all() for {name: coroutine}, run as tasks on the current event loop
+
+    Tasks that miss the deadline are not cancelled, so they still fill the
+    live data cache for the next request.
+    """
+    tasks = {name: asyncio.ensure_future(coro) for name, coro in coros.items()}
+    if not tasks:
+        return {}, {}
+    done, pending = await asyncio.wait(tasks.values(), timeout=deadline)
+    for task in pending:
+        _background.add(task)
+        task.add_done_callback(_background.discard)
+
+    results = {}
+    sources = {}
+    for name, task in tasks.items():
+        if task not in done:
+            sources[name] = 'timeout'
+        elif task.exception() is not None:
+            sources[name] = 'error'
+        elif task.result() is None:
+            sources[name] = 'empty'
+        else:
+            results[name] = task.result()
+            sources[name] = 'ok'
+
+    return results, sources
@@ -0,0 +1,169 @@
+"""
+Query Router
+Answers data-only questions from live data and sends the rest to the model
+"""
+
+import json
+import re
+import threading
+import time
+from datetime import datetime
+
+DATA = 'data'          # current AQI / weather for a city: templated answer
+FORECAST = 'forecast'  # day-by-day forecast summary
+OPEN = 'open'          # everything else: RAG generation
+
+FORECAST_KEYWORDS = ['forecast', 'next days', 'future', 'tomorrow', 'week', 'coming days', 'predict', 'prediction']
+# Questions that need an explanation rather than a number (the web search
+# keywords, minus the forecast ones, plus advice-style questions)
+OPEN_KEYWORDS = ['news', 'latest', 'research', 'study', 'why', 'how', 'cause', 'causes', 'effect', 'effects', 'climate',
+                 'should', 'safe', 'explain', 'compare', 'vs', 'versus', 'reduce', 'tips', 'health', 'history']
+AQI_KEYWORDS = ['aqi', 'air quality', 'air', 'pollution', 'polluted', 'smog', 'pm2.5', 'pm 2.5', 'pm10', 'pm25']
+WEATHER_KEYWORDS = ['weather', 'temperature', 'temp', 'humidity', 'humid', 'hot', 'cold', 'conditions']
+
+# Longer questions usually ask for more than a reading
+MAX_DATA_WORDS = 12
+
+# CPCB health impact statement per AQI category
+HEALTH_IMPACT = {
+    'Good': 'Minimal impact.',
+    'Satisfactory': 'May cause minor breathing discomfort to sensitive people.',
+    'Moderate': 'May cause breathing discomfort to people with lung disease, asthma and heart disease, children and older adults.',
+    'Poor': 'May cause breathing discomfort to most people on prolonged exposure.',
+    'Very Poor': 'May cause respiratory illness on prolonged exposure.',
+    'Severe': 'May cause respiratory effects even on healthy people, and serious health impacts on people with lung or heart disease.',
+}
+
+POLLUTANT_NAMES = {'pm2_5': ('PM2.5', 'pm25'), 'pm10': ('PM10', 'pm10'), 'no2': ('NO₂', 'no2'),
+                   'o3': ('O₃', 'o3'), 'co': ('CO', 'co'), 'so2': ('SO₂', 'so2'), 'nh3': ('NH₃', None)}
+
+
+def _pattern(keywords):
+    # Word-bounded, so 'how' does not fire on 'show' nor 'air' on 'chair'
+    return re.compile(r'(?<!\w)(' + '|'.join(re.escape(kw) for kw in sorted(keywords, key=len, reverse=True)) + r')(?!\w)')
+
+
+_FORECAST = _pattern(FORECAST_KEYWORDS)
+_OPEN = _pattern(OPEN_KEYWORDS)
+_AQI = _pattern(AQI_KEYWORDS)
+_WEATHER = _pattern(WEATHER_KEYWORDS)
+
+
+def classify(query, city):
+    """(route, reason, wants) for a query and the city detected in it (or None)
+
+    wants lists the live data a DATA route should answer with ('aqi',
+    'weather'). Forecast keywords win, then open-question keywords; a short
+    question naming a city and asking for AQI or weather is a data lookup.
+    """
+    text = query.lower()
+
+    if not city:
+        return OPEN, 'no city', []
+
+    match = _FORECAST.search(text)
+    if match:
+        return FORECAST, f'forecast keyword "{match.group()}"', []
+
+    match = _OPEN.search(text)
+    if match:
+        return OPEN, f'open keyword "{match.group()}"', []
+
+    wants = [kind for kind, pattern in (('aqi', _AQI), ('weather', _WEATHER)) if pattern.search(text)]
+    if not wants:
+        return OPEN, 'no data keyword', []
+
+    if len(text.split()) > MAX_DATA_WORDS:
+        return OPEN, f'longer than {MAX_DATA_WORDS} words', []
+
+    return DATA, f'asks for {" and ".join(wants)}', wants
+
+
+def data_answer(city, live_data, wants):
+    """Templated answer from live data, or None when a requested reading is missing"""
+    aqi = live_data.get('aqi')
+    weather = live_data.get('weather')
+    if ('aqi' in wants and not aqi) or ('weather' in wants and not weather):
+        return None
+
+    sentences = []
+    if 'aqi' in wants:
+        name, key = POLLUTANT_NAMES.get(aqi.get('dominant'), (None, None))
+        sentence = f'The current AQI in {city} is {aqi["aqi"]} ({aqi["category"]})'
+        if name and key and aqi.get(key):
+            sentence += f', driven mainly by {name} at {aqi[key]:.1f} μg/m³'
+        sentences.append(sentence + '.')
+        sentences.append(HEALTH_IMPACT.get(aqi['category'], ''))
+
+    if 'weather' in wants:
+        sentences.append(f'It is {weather["temp"]}°C in {city} with {weather["humidity"]}% humidity and {weather["desc"]}.')
+
+    return ' '.join(s for s in sentences if s)
+
+
+def daily_forecast(forecast, days=5):
+    """3-hourly forecast entries averaged per day: [{date, temp, humidity, desc}]
+
+    desc is the mid-day entry's description.
+    """
+    by_day = {}
+    for item in forecast:
+        by_day.setdefault(item['date'].split()[0], []).append(item)
+
+    return [{
+        'date': date,
+        'temp': round(sum(item['temp'] for item in items) / len(items), 1),
+        'humidity': round(sum(item['humidity'] for item in items) / len(items)),
+        'desc': items[len(items) // 2]['desc'],
+    } for date, items in list(by_day.items())[:days]]
+
+
+def forecast_answer(city, daily):
+    """Short chat answer for a daily_forecast() list"""
+    low, high = min(day['temp'] for day in daily), max(day['temp'] for day in daily)
+    span = f'{low:.1f}°C' if low == high else f'{low:.1f}–{high:.1f}°C'
+    days = '; '.join(f'{datetime.strptime(day["date"], "%Y-%m-%d").strftime("%a %d %b")} {day["temp"]:.1f}°C, {day["desc"]}'
+                     for day in daily)
+    return f'Over the next {len(daily)} days {city} averages {span}. {days}.'
+
+
+class DecisionLog:
+    """Logs every routing decision as a line of text and, optionally, JSON
+
+    With a path, each decision is appended as one JSON object per line so
+    the share of queries that skipped generation can be measured offline.
+    """
+
+    def __init__(self, path=None, log=print):
+        self.path = path
+        self.log = log
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, query, city, route, reason, generated, started_at):
+        """Log one decision; generated says whether the model ran after all"""
+        ms = (time.perf_counter() - started_at) * 1000
+        with self._lock:
+            key = f'{route}:{"generated" if generated else "skipped"}'
+            self.counts[key] = self.counts.get(key, 0) + 1
+            if self.path:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps({
+                        'ts': round(time.time(), 3),
+                        'route': route,
+                        'reason': reason,
+                        'city': city,
+                        'generated': generated,
+                        'ms': round(ms, 1),
+                        'words': len(query.split()),
+                    }) + '\n')
+
+        outcome = 'generated' if generated else f'answered in {ms:.0f} ms without generation'
+        self.log(f'🧭 Route: {route} ({reason}) → {outcome}')
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self.counts)
+        total = sum(counts.values())
+        skipped = sum(n for key, n in counts.items() if key.endswith(':skipped'))
+        return {'decisions': counts, 'skipped_generation': skipped, 'skip_rate': skipped / total if total else 0.0}
@@ -0,0 +1,286 @@
+"""
+Speculative Decoding
+A small draft model proposes tokens that GPT-2 then verifies in a single forward pass
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+
+import torch
+import torch.nn.functional as F
+
+from generation import StopMatcher, cache_to_legacy, cache_from_legacy
+
+
+def crop_cache(past, length):
+    """past_key_values cut back to its first length positions"""
+    return cache_from_legacy(tuple((k[:, :, :length], v[:, :, :length]) for k, v in cache_to_legacy(past)))
+
+
+def verify(p, q, drafted):
+    """Accept or reject drafted tokens by rejection sampling
+
+    p holds the model's distributions ([k + 1, vocab], one row per drafted
+    token plus one for the token after them) and q the draft's ([k, vocab]).
+    Drafted token i is kept with probability min(1, p_i(x) / q_i(x)); the
+    first rejected one is replaced by a sample from max(0, p_i - q_i), and
+    when all are kept one more is sampled from p_k. Every returned token is
+    distributed exactly as if sampled from p alone.
+
+    Returns (tokens, number of drafted tokens accepted).
+    """
+    k = len(drafted)
+    if k:
+        rows = torch.arange(k, device=p.device)
+        x = torch.tensor(drafted, device=p.device)
+        ratio = p[rows, x] / q[rows, x]
+        rejected = (torch.rand(k, device=p.device) >= ratio).nonzero()
+        if len(rejected):
+            n = rejected[0].item()
+            residual = (p[n] - q[n]).clamp_(min=0)
+            if residual.sum() <= 0:
+                residual = p[n]
+            return drafted[:n] + [torch.multinomial(residual, 1).item()], n
+
+    return drafted + [torch.multinomial(p[k], 1).item()], k
+
+
+@torch.no_grad()
+def generate_speculative(model, ids, max_tokens, temp, eos_token_id, draft, draft_tokens=4,
+                         prefix_cache=None, prefix_len=0, prefix_tag=None, stop=None, deadline=None,
+                         on_token=None, cancelled=None):
+    """Sample up to max_tokens after ids with draft proposals; returns (ids, stats) like generate_ids()
+
+    The first token comes from the model's own prefill (through the prefix
+    cache when given). After that, each round the draft samples up to
+    draft_tokens tokens one by one and the model scores all of them in one
+    pass, keeping the accepted ones plus one token of its own. Both models
+    keep KV caches, cut back to the accepted tokens after every round.
+
+    stop and deadline work as in generate_ids(). on_token is called with
+    every token once it is released by the stop matcher, and cancelled (a
+    callable, polled once per round) ends generation early. stats adds
+    drafted_tokens, accepted_tokens, acceptance_rate and target_passes.
+    """
+    prompt = ids[0].tolist()
+    device = ids.device
+    tokens = list(prompt)
+    output = []
+    matcher = StopMatcher(stop) if stop else None
+    finish_reason = 'length'
+
+    target_past = draft_past = None
+    target_len = draft_len = 0  # tokens already in each model's KV cache
+    drafted = accepted = passes = reused = 0
+
+    start = time.perf_counter()
+    first_token_at = None
+
+    def emit(released):
+        output.extend(released)
+        if on_token is not None:
+            for token in released:
+                on_token(token)
+
+    while len(tokens) - len(prompt) < max_tokens:
+        if deadline is not None and time.perf_counter() >= deadline:
+            finish_reason = 'deadline'
+            break
+        if cancelled is not None and cancelled():
+            break
+
+        if target_past is None:
+            if prefix_cache is not None:
+                out, reused = prefix_cache.prefill(model, ids, prefix_len, prefix_tag)
+            else:
+                out = model(ids, use_cache=True)
+            passes += 1
+            target_past, target_len = out.past_key_values, len(tokens)
+            new = [torch.multinomial(F.softmax(out.logits[0, -1] / temp, dim=-1), 1).item()]
+        else:
+            # Never propose past max_tokens: the round adds up to k + 1 tokens
+            k = min(draft_tokens, max_tokens - (len(tokens) - len(prompt)) - 1)
+            proposal, q = [], []
+            feed = tokens[draft_len:]
+            for _ in range(k):
+                out = draft(torch.tensor([feed], device=device), past_key_values=draft_past, use_cache=True)
+                draft_past = out.past_key_values
+                draft_len += len(feed)
+                probs = F.softmax(out.logits[0, -1] / temp, dim=-1)
+                proposal.append(torch.multinomial(probs, 1).item())
+                q.append(probs)
+                feed = proposal[-1:]
+
+            # The model has yet to see the last sampled token, then the proposal
+            out = model(torch.tensor([tokens[target_len:] + proposal], device=device),
+                        past_key_values=target_past, use_cache=True)
+            passes += 1
+            p = F.softmax(out.logits[0, -(k + 1):] / temp, dim=-1)
+            new, n = verify(p, torch.stack(q) if q else None, proposal)
+            drafted += k
+            accepted += n
+
+            # Keep the KV of accepted tokens only; the model's own token is fed next round
+            target_len = len(tokens) + n
+            target_past = crop_cache(out.past_key_values, target_len)
+            if draft_len > target_len:
+                draft_past, draft_len = crop_cache(draft_past, target_len), target_len
+
+        if first_token_at is None:
+            first_token_at = time.perf_counter()
+
+        for token in new:
+            tokens.append(token)
+            emit(matcher.push(token) if matcher is not None else [token])
+            if token == eos_token_id:
+                finish_reason = 'eos'
+                break
+            if matcher is not None and matcher.matched:
+                finish_reason = 'stop'
+                break
+        if finish_reason in ('eos', 'stop'):
+            break
+
+    if matcher is not None and not matcher.matched:
+        emit(matcher.flush())
+
+    end = time.perf_counter()
+    new_tokens = len(tokens) - len(prompt)
+    stats = {
+        'prompt_tokens': len(prompt),
+        'prefix_tokens': reused,
+        'new_tokens': new_tokens,
+        'use_cache': True,
+        'total_ms': (end - start) * 1000,
+        'first_token_ms': ((first_token_at or end) - start) * 1000,
+        'ms_per_token': ((end - (first_token_at or end)) * 1000 / (new_tokens - 1)) if new_tokens > 1 else 0.0,
+        'finish_reason': finish_reason,
+        'drafted_tokens': drafted,
+        'accepted_tokens': accepted,
+        'acceptance_rate': accepted / drafted if drafted else 0.0,
+        'target_passes': passes,
+    }
+
+    return torch.tensor([prompt + output], dtype=torch.long, device=device), stats
+
+
+class SpeculativeScheduler:
+    """Serves requests one at a time with generate_speculative()
+
+    A drop-in for BatchScheduler (same submit(), generate() and totals), so
+    the Flask and ASGI servers stream, cancel and report it unchanged.
+    Speculation shortens each request but does not batch: concurrent
+    requests queue behind each other.
+    """
+
+    def __init__(self, model, draft, eos_token_id, draft_tokens=4, prefix_cache=None):
+        self.model = model
+        self.draft = draft
+        self.eos_token_id = eos_token_id
+        self.draft_tokens = max(1, draft_tokens)
+        self.prefix_cache = prefix_cache
+        self.device = next(model.parameters()).device
+
+        self._queue = queue.Queue()
+        # Cumulative counters over finished requests (written by the worker only)
+        self.totals = {'requests': 0, 'prompt_tokens': 0, 'prefix_tokens': 0, 'new_tokens': 0,
+                       'finish_eos': 0, 'finish_stop': 0, 'finish_length': 0, 'finish_deadline': 0,
+                       'drafted_tokens': 0, 'accepted_tokens': 0, 'target_passes': 0}
+
+        self._thread = threading.Thread(target=self._run, name='speculative-decoder', daemon=True)
+        self._thread.start()
+
+    def submit(self, ids, max_tokens, temp, on_token=None, prefix_len=0, prefix_tag=None, stop=None, deadline=None):
+        """Queue a prompt and return a Future for (ids, stats); see BatchScheduler.submit()"""
+        future = Future()
+        self._queue.put({
+            'prompt': ids[0].tolist() if torch.is_tensor(ids) else list(ids),
+            'max_tokens': max_tokens,
+            'temp': temp,
+            'prefix_len': prefix_len,
+            'prefix_tag': prefix_tag,
+            'stop': stop,
+            'deadline': deadline,
+            'on_token': on_token,
+            'future': future,
+            'submitted_at': time.perf_counter(),
+        })
+        return future
+
+    def generate(self, ids, max_tokens, temp):
+        """Blocking helper with the same return value as generation.generate_ids"""
+        return self.submit(ids, max_tokens, temp).result()
+
+    def acceptance_rate(self):
+        drafted = self.totals['drafted_tokens']
+        return self.totals['accepted_tokens'] / drafted if drafted else 0.0
+
+    def _run(self):
+        while True:
+            req = self._queue.get()
+            future = req['future']
+            if future.cancelled():
+                continue
+
+            started_at = time.perf_counter()
+            try:
+                ids, stats = generate_speculative(
+                    self.model, torch.tensor([req['prompt']], device=self.device), req['max_tokens'], req['temp'],
+                    self.eos_token_id, self.draft, self.draft_tokens, prefix_cache=self.prefix_cache,
+                    prefix_len=req['prefix_len'], prefix_tag=req['prefix_tag'], stop=req['stop'],
+                    deadline=req['deadline'], on_token=self._on_token(req), cancelled=future.cancelled)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                continue
+
+            if future.cancelled():
+                continue
+            stats['queue_ms'] = (started_at - req['submitted_at']) * 1000
+            self._count(stats)
+            try:
+                future.set_result((ids, stats))
+            except InvalidStateError:
+                pass
+
+    @staticmethod
+    def _on_token(req):
+        if req['on_token'] is None:
+            return None
+
+        def on_token(token):
+            try:
+                req['on_token'](token)
+            except Exception:
+                req['future'].cancel()
+
+        return on_token
+
+    def _count(self, stats):
+        self.totals['requests'] += 1
+        self.totals[f'finish_{stats["finish_reason"]}'] += 1
+        for key in ('prompt_tokens', 'prefix_tokens', 'new_tokens', 'drafted_tokens', 'accepted_tokens', 'target_passes'):
+            self.totals[key] += stats[key]
+
+
+if __name__ == '__main__':
+    import os
+    import json
+    from generation import generate_ids
+    from model_loader import load_model, load_draft
+
+    model, tokenizer, device = load_model(os.getenv('MODEL_PATH', 'best_model.pt'),
+                                          quantize=os.getenv('QUANTIZE_INT8', '0') == '1',
+                                          cache_path=os.getenv('INT8_MODEL_PATH', 'best_model.int8.pt'))
+    draft = load_draft(os.getenv('DRAFT_MODEL_PATH') or 'distilgpt2', device, model.config.vocab_size)
+    draft_tokens = int(os.getenv('SPECULATIVE_TOKENS', '4'))
+
+    prompt = '[LIVE DATA: Delhi AQI=299 (Poor), PM2.5=120.0]\\nUser: Why is the air so bad in Delhi today?\\nAssistant:'
+    ids = tokenizer.encode(prompt, return_tensors='pt').to(device)
+
+    # eos_token_id=-1 disables early stopping so both engines decode the same length
+    _, plain = generate_ids(model, ids, 150, 0.8, -1)
+    _, speculative = generate_speculative(model, ids, 150, 0.8, -1, draft, draft_tokens)
+    print(json.dumps({'sampling': plain, 'speculative': speculative}, indent=2))
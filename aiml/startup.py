@@ -0,0 +1,42 @@
+"""
+Startup Timing
+Records how long each startup phase took so code paths can be compared
+"""
+
+import time
+from contextlib import contextmanager
+
+# Import this module first so _T0 is as close to process start as possible
+_T0 = time.perf_counter()
+_phases = {}
+_path = None
+
+
+@contextmanager
+def phase(name):
+    """Time a block and record it under name (milliseconds)"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phases[name] = round((time.perf_counter() - start) * 1000, 1)
+
+
+def mark(name):
+    """Record the time elapsed since startup under name (milliseconds)"""
+    _phases[name] = round((time.perf_counter() - _T0) * 1000, 1)
+
+
+def set_path(name):
+    """Name the code path this process took, e.g. 'forecast' or 'generate'"""
+    global _path
+    _path = name
+
+
+def report(path=None):
+    """Timings recorded so far for the code path taken"""
+    return {
+        'path': path or _path,
+        'phases_ms': dict(_phases),
+        'total_ms': round((time.perf_counter() - _T0) * 1000, 1),
+    }
@@ -0,0 +1,73 @@
+"""
+Stub Upstream Server
+Serves recorded OpenWeather/SerpAPI responses over HTTP for offline runs and load tests
+
+Record a store first (UPSTREAM_MODE=record), then start the stub and point
+the server at it with UPSTREAM_STUB_URL=http://127.0.0.1:8765:
+
+    python stub_upstream.py [--store upstream_store.json.gz] [--port 8765] [--latency-ms 20-80]
+
+A request for /<host>/<path>?<query> is answered with the response recorded
+for https://<host>/<path>?<query>, or 404 when there is none. With
+--synthetic no recording is needed: unrecorded requests get made-up but
+well-formed OpenWeather/SerpAPI payloads.
+"""
+
+import argparse
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from upstream_store import UpstreamStore, parse_latency, sleep_latency
+
+
+def make_handler(store, latency, verbose=False):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive, like the real APIs
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            sleep_latency(latency)
+            r = store.response(f'https:/{self.path}')
+            self.send_response(r.status_code)
+            self.send_header('Content-Type', r.headers['Content-Type'])
+            self.send_header('Content-Length', str(len(r.content)))
+            self.end_headers()
+            self.wfile.write(r.content)
+
+        def log_message(self, format, *args):
+            if verbose:
+                super().log_message(format, *args)
+
+    return StubHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve recorded upstream responses')
+    parser.add_argument('--store', default=os.getenv('UPSTREAM_STORE', 'upstream_store.json.gz'))
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency-ms', default=os.getenv('UPSTREAM_REPLAY_LATENCY_MS', '0'),
+                        help="injected latency per request, e.g. 50 or 20-80")
+    parser.add_argument('--synthetic', action='store_true', help='answer unrecorded requests with synthetic data')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    args = parser.parse_args()
+
+    if not args.synthetic and not os.path.exists(args.store):
+        parser.error(f'{args.store} not found; record one with UPSTREAM_MODE=record first, or use --synthetic')
+
+    store = UpstreamStore(args.store, synthetic=args.synthetic)
+    # Load tests open hundreds of connections at once; the default backlog is 5
+    ThreadingHTTPServer.request_queue_size = 1024
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(store, parse_latency(args.latency_ms), args.verbose))
+    server.daemon_threads = True
+    print(f'🧪 Serving {len(store)} recorded responses on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f'📊 {store.stats}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Tests for weather_server.py live data lookups
+Run with: python -m pytest test_weather_server.py
+"""
+
+import time
+
+import pytest
+
+import weather_server as ws
+from live_cache import TTLCache
+from refresher import Refresher
+
+TTL = 0.05
+
+
+@pytest.fixture
+def live(monkeypatch):
+    """A short-TTL live cache, a refresher for the featured cities (not started) and counted AQI fetches"""
+    cache = TTLCache(ttl=TTL)
+    jobs = {(city, 'aqi'): lambda: None for city in ws.CITIES}
+    calls = []
+
+    def fetch_live_aqi(city):
+        calls.append(city)
+        return {'aqi': len(calls)}
+
+    monkeypatch.setattr(ws, 'live_cache', cache)
+    monkeypatch.setattr(ws, 'refresher', Refresher(cache, jobs, 60))
+    monkeypatch.setattr(ws, 'fetch_live_aqi', fetch_live_aqi)
+    return calls
+
+
+def test_non_featured_place_is_refetched_after_ttl(live):
+    place = next(p for p in ws.GAZETTEER if not p.featured)
+
+    assert ws.get_live_aqi(place.key) == {'aqi': 1}
+    assert ws.get_live_aqi(place.key) == {'aqi': 1}
+    time.sleep(TTL * 2)
+    assert ws.get_live_aqi(place.key) == {'aqi': 2}
+    assert live == [place.key, place.key]
+
+
+def test_featured_city_serves_last_refreshed_value(live):
+    city = next(iter(ws.CITIES))
+
+    assert ws.get_live_aqi(city) == {'aqi': 1}
+    time.sleep(TTL * 2)
+    assert ws.get_live_aqi(city) == {'aqi': 1}
+    assert live == [city]
+
+
+def test_forecast_is_refetched_after_ttl(live, monkeypatch):
+    city = next(iter(ws.CITIES))
+    calls = []
+
+    def fetch_weather_forecast(city, days):
+        calls.append(city)
+        return [{'date': '2026-10-17 12:00:00', 'temp': 30.0 + len(calls), 'humidity': 40, 'desc': 'clear sky', 'wind': 2.0}]
+
+    monkeypatch.setattr(ws, 'fetch_weather_forecast', fetch_weather_forecast)
+
+    assert ws.get_weather_forecast(city)[0]['temp'] == 31.0
+    time.sleep(TTL * 2)
+    assert ws.get_weather_forecast(city)[0]['temp'] == 32.0
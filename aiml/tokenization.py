@@ -0,0 +1,197 @@
+"""
+Prompt Tokenization
+Cached token IDs for the RAG prompt template and incremental response decoding
+"""
+
+import threading
+from collections import OrderedDict
+
+# The prompt joins its pieces with a literal backslash-n ('\\n'), and GPT-2's
+# pre-tokenizer merges that trailing 'n' into the next word ('nUser',
+# 'nAssistant'). The pieces below are therefore cut just before each 'n',
+# where a pre-token boundary is guaranteed, so concatenating their cached IDs
+# gives exactly what tokenizer.encode(full_prompt) would:
+#
+#   [LIVE DATA: ...]\ | n | [WEATHER: ...]\ | nUser: | <space + user text>\ | nAssistant:
+SEP = '\\n'
+
+# Context lines that depend only on a city's live data, not on the question.
+# A leading run of these is the prompt prefix whose KV cache can be shared.
+SHARED_LINES = ('[LIVE DATA:', '[WEATHER:')
+
+
+def stop_token_ids(tokenizer, stops):
+    """Token ID sequences to stop generation at for each stop string
+
+    BPE tokenizes a string differently after a space or a line break, so
+    each stop is also encoded behind ' ', a newline and the prompt's SEP.
+    Matching the longer forms drops the separator along with the stop.
+    """
+    sequences = []
+    for stop in stops:
+        for before in ('', ' ', '\n', SEP):
+            ids = tokenizer.encode(before + stop)
+            if ids not in sequences:
+                sequences.append(ids)
+    return sequences
+
+
+def generation_options(data):
+    """(stop, deadline_ms) from a request body's "stop" and "deadlineMs", None when absent
+
+    Raises ValueError for malformed values.
+    """
+    stop = data.get('stop')
+    if isinstance(stop, str):
+        stop = [stop]
+    if stop is not None and (not isinstance(stop, list) or len(stop) > 8
+                             or not all(isinstance(s, str) and 0 < len(s) <= 64 for s in stop)):
+        raise ValueError('stop must be a string or a list of at most 8 non-empty strings of up to 64 characters')
+
+    deadline_ms = data.get('deadlineMs')
+    if deadline_ms is not None and (isinstance(deadline_ms, bool) or not isinstance(deadline_ms, (int, float))
+                                    or deadline_ms <= 0):
+        raise ValueError('deadlineMs must be a positive number')
+
+    return stop, deadline_ms
+
+
+class PromptEncoder:
+    """Encodes '{context}User: {prompt}\\nAssistant:' with only the user text tokenized per call
+
+    Context lines ('[LIVE DATA: ...]\\n', '[WEATHER: ...]\\n', ...) are cached
+    by their exact text in a bounded LRU, so a city's line is tokenized once
+    until its live data changes.
+    """
+
+    def __init__(self, tokenizer, max_lines=1024):
+        self.tokenizer = tokenizer
+        self.max_lines = max_lines
+        self.head = tokenizer.encode('User:')
+        self.head_after_context = tokenizer.encode('nUser:')
+        self.line_sep = tokenizer.encode('n')
+        self.tail = tokenizer.encode('nAssistant:')
+        self._lines = OrderedDict()
+        self._stops = {}
+        self._lock = threading.Lock()
+        self.stats = {'line_hits': 0, 'line_misses': 0, 'fallbacks': 0}
+
+    def line_ids(self, body):
+        """Token IDs for one context line without its trailing 'n'"""
+        with self._lock:
+            ids = self._lines.get(body)
+            if ids is not None:
+                self._lines.move_to_end(body)
+                self.stats['line_hits'] += 1
+                return ids
+
+        ids = self.tokenizer.encode(body)
+        with self._lock:
+            self.stats['line_misses'] += 1
+            self._lines[body] = ids
+            while len(self._lines) > self.max_lines:
+                self._lines.popitem(last=False)
+        return ids
+
+    def stop_ids(self, stops):
+        """stop_token_ids() for a list of stop strings, cached by the list"""
+        key = tuple(stops)
+        with self._lock:
+            ids = self._stops.get(key)
+        if ids is None:
+            ids = stop_token_ids(self.tokenizer, key)
+            with self._lock:
+                # Per-request stop lists are not worth an LRU; keep the first few
+                if len(self._stops) < 256:
+                    self._stops[key] = ids
+        return ids
+
+    def encode(self, context, prompt):
+        """Token IDs for the full RAG prompt as a list"""
+        return self.encode_with_prefix(context, prompt)[0]
+
+    def encode_with_prefix(self, context, prompt):
+        """(ids, prefix_len) where ids[:prefix_len] is the shared city-context prefix
+
+        prefix_len covers the leading SHARED_LINES up to their final backslash
+        and is 0 when there is no such line.
+        """
+        lines = context.split(SEP)[:-1] if context else []
+
+        # Lines must be bracketed for the cut points to be safe; anything else
+        # (e.g. a web snippet containing a literal '\n') is encoded in one go
+        if context and (not context.endswith(SEP) or any(not (l.startswith('[') and l.endswith(']')) for l in lines)):
+            self.stats['fallbacks'] += 1
+            return self.tokenizer.encode(f'{context}User: {prompt}{SEP}Assistant:'), 0
+
+        ids = []
+        prefix_len = 0
+        shared = True
+        for i, line in enumerate(lines):
+            if i:
+                ids += self.line_sep
+            ids += self.line_ids(line + '\\')
+            shared = shared and line.startswith(SHARED_LINES)
+            if shared:
+                prefix_len = len(ids)
+
+        ids += self.head_after_context if lines else self.head
+        ids += self.tokenizer.encode(f' {prompt}\\')
+        ids += self.tail
+        return ids, prefix_len
+
+
+class IncrementalDecoder:
+    """Turns generated token IDs into text a few tokens at a time
+
+    Only the tokens since the last emitted boundary are re-decoded on each
+    push, and text is held back while it ends in an incomplete multi-byte
+    character.
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.ids = []
+        self.text = ''
+        self._prefix = 0  # start of the window re-decoded for context
+        self._read = 0    # end of the part already emitted
+
+    def push(self, token_id):
+        """Add one token and return the newly completed text (may be '')"""
+        self.ids.append(token_id)
+        prefix_text = self._decode(self._prefix, self._read)
+        new_text = self._decode(self._prefix, len(self.ids))
+
+        if len(new_text) > len(prefix_text) and not new_text.endswith('\ufffd'):
+            delta = new_text[len(prefix_text):]
+            self._prefix = self._read
+            self._read = len(self.ids)
+            self.text += delta
+            return delta
+        return ''
+
+    def flush(self):
+        """Emit whatever is still held back, even if incomplete"""
+        if self._read == len(self.ids):
+            return ''
+        prefix_text = self._decode(self._prefix, self._read)
+        delta = self._decode(self._prefix, len(self.ids))[len(prefix_text):]
+        self._prefix = self._read = len(self.ids)
+        self.text += delta
+        return delta
+
+    def response(self):
+        """Final answer: text after the last 'Assistant:' turn, stripped"""
+        self.flush()
+        return self.text.split('Assistant:')[-1].strip()
+
+    def _decode(self, start, end):
+        return self.tokenizer.decode(self.ids[start:end], skip_special_tokens=True)
+
+
+def decode_response(tokenizer, token_ids):
+    """Decode only the generated tokens into the final answer"""
+    decoder = IncrementalDecoder(tokenizer)
+    for token_id in token_ids:
+        decoder.push(token_id)
+    return decoder.response()
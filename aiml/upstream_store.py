@@ -0,0 +1,148 @@
+"""
+Upstream Response Store
+Recorded OpenWeather/SerpAPI responses for offline replay and load testing
+"""
+
+import gzip
+import json
+import os
+import random
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import requests
+
+# Query parameters that carry credentials; they are left out of the keys so
+# a store recorded with one API key replays with any other (or none)
+SECRET_PARAMS = {'appid', 'api_key', 'apikey', 'key', 'token'}
+
+
+def request_key(url):
+    """Store key for a URL: host, path and sorted query without secrets"""
+    parts = urlsplit(url)
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k.lower() not in SECRET_PARAMS)
+    return f'{parts.netloc}{parts.path}?{urlencode(query)}'
+
+
+def parse_latency(spec):
+    """'50' -> (50, 50); '20-80' -> (20, 80) milliseconds"""
+    low, _, high = str(spec or '0').partition('-')
+    return float(low), float(high or low)
+
+
+def pick_latency(latency_ms):
+    """Random delay in seconds within a (low, high) millisecond range"""
+    low, high = latency_ms
+    return random.uniform(low, high) / 1000 if high > 0 else 0.0
+
+
+def sleep_latency(latency_ms):
+    """Sleep for a random time within a (low, high) millisecond range"""
+    delay = pick_latency(latency_ms)
+    if delay:
+        time.sleep(delay)
+
+
+def synthetic_entry(url):
+    """Plausible made-up response for a known OpenWeather/SerpAPI endpoint, or None
+
+    Values are derived from the request key, so a given city always gets the
+    same readings. Used by the stub server for benchmarks without a recording.
+    """
+    key = request_key(url)
+    rng = random.Random(key)
+    path = urlsplit(url).path
+
+    def weather():
+        return {
+            'main': {'temp': round(rng.uniform(15, 38), 2), 'feels_like': round(rng.uniform(15, 40), 2),
+                     'humidity': rng.randint(30, 95), 'pressure': rng.randint(995, 1020)},
+            'weather': [{'description': rng.choice(['haze', 'clear sky', 'mist', 'scattered clouds', 'light rain'])}],
+            'wind': {'speed': round(rng.uniform(0.5, 8), 2)},
+        }
+
+    if path.endswith('/air_pollution'):
+        components = {'co': rng.uniform(300, 3000), 'no': rng.uniform(0, 20), 'no2': rng.uniform(5, 90),
+                      'o3': rng.uniform(10, 120), 'so2': rng.uniform(2, 40), 'pm2_5': rng.uniform(10, 250),
+                      'pm10': rng.uniform(20, 350), 'nh3': rng.uniform(1, 30)}
+        body = {'list': [{'main': {'aqi': rng.randint(1, 5)}, 'components': {k: round(v, 2) for k, v in components.items()}}]}
+    elif path.endswith('/forecast'):
+        body = {'list': [{**weather(), 'dt_txt': f'2024-01-{1 + i // 8:02d} {3 * (i % 8):02d}:00:00'} for i in range(40)]}
+    elif path.endswith('/weather'):
+        body = weather()
+    elif 'serpapi' in key:
+        body = {'organic_results': [
+            {'title': f'Air quality report {i + 1}', 'link': f'https://example.org/{i}',
+             'snippet': 'Stubble burning, vehicle exhaust and winter inversions keep PM2.5 levels high across north India.'}
+            for i in range(3)
+        ]}
+    else:
+        return None
+
+    return {'status': 200, 'content_type': 'application/json', 'body': json.dumps(body)}
+
+
+class UpstreamStore:
+    """Gzipped JSON file of {key: {'status', 'content_type', 'body'}}
+
+    Only successful responses are recorded. Writes replace the file
+    atomically, so a replaying process never sees a half-written store.
+    With synthetic=True, requests that were never recorded are answered
+    with synthetic_entry() instead of a 404.
+    """
+
+    def __init__(self, path, synthetic=False):
+        self.path = path
+        self.synthetic = synthetic
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.stats = {'recorded': 0, 'replayed': 0, 'misses': 0}
+        if path and os.path.exists(path):
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                self._entries = json.load(f)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, url):
+        """Recorded entry for url, or None"""
+        entry = self._entries.get(request_key(url))
+        with self._lock:
+            self.stats['replayed' if entry else 'misses'] += 1
+        if entry is None and self.synthetic:
+            entry = synthetic_entry(url)
+        return entry
+
+    def record(self, url, response):
+        """Save a successful requests or httpx response for url and rewrite the file"""
+        if response.status_code != 200:
+            return
+        entry = {
+            'status': response.status_code,
+            'content_type': response.headers.get('Content-Type', 'application/json'),
+            'body': response.text,
+        }
+        with self._lock:
+            self._entries[request_key(url)] = entry
+            self.stats['recorded'] += 1
+            tmp_path = f'{self.path}.tmp'
+            with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+                json.dump(self._entries, f, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+
+    def response(self, url):
+        """requests.Response replayed from the store (404 when not recorded)"""
+        entry = self.get(url)
+        r = requests.Response()
+        r.url = url
+        r.encoding = 'utf-8'
+        if entry is None:
+            r.status_code = 404
+            r.headers['Content-Type'] = 'application/json'
+            r._content = json.dumps({'error': f'not recorded: {request_key(url)}'}).encode()
+        else:
+            r.status_code = entry['status']
+            r.headers['Content-Type'] = entry['content_type']
+            r._content = entry['body'].encode('utf-8')
+        return r
@@ -3,16 +3,21 @@ Weather Prediction CLI using Fine-tuned GPT-2 Model
 Supports RAG with live OpenWeather API and internet search
 """
 
-import torch
-import torch.nn.functional as F
-from transformers import GPT2LMHeadModel, GPT2Tokenizer
-import requests
+import startup
 import os
+import functools
+import time
 from dotenv import load_dotenv
+import http_client
+from live_cache import TTLCache
+from aqi import aqi_from_components
+from gazetteer import Gazetteer
+from retrieval import fetch_all
 from datetime import datetime, timedelta
 
 # Load environment variables
 load_dotenv()
+startup.mark('imports')
 
 # Configuration
 OPENWEATHER_API_KEY = os.getenv('OPENWEATHER_API_KEY')
@@ -21,85 +26,90 @@ MODEL_PATH = os.getenv('MODEL_PATH', 'best_model.pt')
 MAX_LENGTH = int(os.getenv('MAX_LENGTH', '256'))
 TEMPERATURE = float(os.getenv('TEMPERATURE', '0.8'))
 MAX_TOKENS = int(os.getenv('MAX_TOKENS', '150'))
+STOP_SEQUENCES = [s for s in os.getenv('STOP_SEQUENCES', 'User:').split('|') if s]
+DEADLINE_MS = float(os.getenv('DEADLINE_MS', '0'))
+DRAFT_MODEL_PATH = os.getenv('DRAFT_MODEL_PATH', '')
+SPECULATIVE_TOKENS = int(os.getenv('SPECULATIVE_TOKENS', '4'))
+LIVE_CACHE_TTL = float(os.getenv('LIVE_CACHE_TTL', '300'))
+LIVE_CACHE_SIZE = int(os.getenv('LIVE_CACHE_SIZE', '256'))
+RETRIEVAL_DEADLINE = float(os.getenv('RETRIEVAL_DEADLINE', '8'))
+PREFIX_CACHE_MB = float(os.getenv('PREFIX_CACHE_MB', '64'))
+STARTUP_REPORT = os.getenv('STARTUP_REPORT', '0') == '1'
+QUANTIZE_INT8 = os.getenv('QUANTIZE_INT8', '0') == '1'
+INT8_MODEL_PATH = os.getenv('INT8_MODEL_PATH', 'best_model.int8.pt')
 
-# Indian cities with coordinates
-CITIES = {
-    'kolkata': (22.57, 88.36),
-    'delhi': (28.61, 77.21),
-    'mumbai': (19.08, 72.88),
-    'bangalore': (12.97, 77.59),
-    'chennai': (13.08, 80.27),
-    'hyderabad': (17.38, 78.49),
-    'siliguri': (26.73, 88.40),
-    'darjeeling': (27.04, 88.27),
-    'durgapur': (23.52, 87.31),
-    'asansol': (23.67, 86.95),
-    'howrah': (22.59, 88.26),
-    'malda': (25.01, 88.14),
-}
-
-# Device configuration
-device = 'cuda' if torch.cuda.is_available() else 'cpu'
-print(f'🔧 Device: {device}')
-
-# Load model and tokenizer
-print('📦 Loading GPT-2 model and tokenizer...')
-tokenizer = GPT2Tokenizer.from_pretrained('gpt2')
-tokenizer.pad_token = tokenizer.eos_token
-model = GPT2LMHeadModel.from_pretrained('gpt2').to(device)
-
-# Load trained weights
-if os.path.exists(MODEL_PATH):
-    print(f'✅ Loading trained model from {MODEL_PATH}')
-    model.load_state_dict(torch.load(MODEL_PATH, map_location=device))
-else:
-    print(f'⚠️  Warning: {MODEL_PATH} not found. Using base GPT-2.')
-
-model.eval()
+# Known places from gazetteer.csv (or GAZETTEER_PATH), matched by name or
+# alias. CITIES holds the featured ones that are listed and kept warm
+GAZETTEER = Gazetteer.load(os.getenv('GAZETTEER_PATH'))
+CITIES = GAZETTEER.featured()
+
+# Shared cache for OpenWeather lookups, keyed by (city, endpoint). A refresh
+# drops the city's cached prompt prefixes, which embed the old values
+live_cache = TTLCache(ttl=LIVE_CACHE_TTL, max_entries=LIVE_CACHE_SIZE,
+                      on_refresh=lambda key: invalidate_prefixes(key[0]))
+
+# Model and tokenizer (loaded by init_model on the first AI query)
+device = None
+model = None
+tokenizer = None
+prompt_encoder = None
+prefix_cache = None
+draft = None
+
+
+def invalidate_prefixes(city):
+    """Drop cached prompt-prefix KV built from a city's previous live data"""
+    if prefix_cache is not None:
+        prefix_cache.invalidate(city)
+
+
+def init_model():
+    """Load GPT-2 on first use so forecast-only sessions start instantly"""
+    global device, model, tokenizer, prompt_encoder, prefix_cache, draft
+    
+    if model is not None:
+        return
+    
+    with startup.phase('import_torch'):
+        from model_loader import load_model, load_draft
+        from tokenization import PromptEncoder
+        from prefix_cache import PrefixCache
+    
+    with startup.phase('load_model'):
+        model, tokenizer, device = load_model(MODEL_PATH, quantize=QUANTIZE_INT8,
+                                              cache_path=INT8_MODEL_PATH, log=print)
+        prompt_encoder = PromptEncoder(tokenizer)
+        prefix_cache = PrefixCache(int(PREFIX_CACHE_MB * 2 ** 20)) if PREFIX_CACHE_MB > 0 else None
+    
+    if DRAFT_MODEL_PATH:
+        with startup.phase('load_draft'):
+            draft = load_draft(DRAFT_MODEL_PATH, device, model.config.vocab_size, log=print)
+    
+    if STARTUP_REPORT:
+        print(f'⏱️  {startup.report("generate")}')
 
 
 def get_live_aqi(city):
+    """Fetch LIVE AQI from OpenWeather API (cached for LIVE_CACHE_TTL seconds)"""
+    place = GAZETTEER.get(city)
+    if place is None:
+        return None
+    
+    return live_cache.get_or_fetch((place.key, 'aqi'), lambda: fetch_live_aqi(place.key))
+
+
+def fetch_live_aqi(city):
     """Fetch LIVE AQI from OpenWeather API"""
-    if city.lower() not in CITIES:
+    place = GAZETTEER.get(city)
+    if place is None:
         return None
     
-    lat, lon = CITIES[city.lower()]
     try:
-        url = f'http://api.openweathermap.org/data/2.5/air_pollution?lat={lat}&lon={lon}&appid={OPENWEATHER_API_KEY}'
-        r = requests.get(url, timeout=10)
+        url = f'http://api.openweathermap.org/data/2.5/air_pollution?lat={place.lat}&lon={place.lon}&appid={OPENWEATHER_API_KEY}'
+        r = http_client.get('openweather', url, timeout=10)
         
         if r.status_code == 200:
-            data = r.json()['list'][0]['components']
-            pm25 = data.get('pm2_5', 0)
-            
-            # India AQI calculation
-            breakpoints = [
-                (0, 30, 0, 50),
-                (31, 60, 51, 100),
-                (61, 90, 101, 200),
-                (91, 120, 201, 300),
-                (121, 250, 301, 400),
-                (251, 500, 401, 500)
-            ]
-            
-            aqi = 500
-            for c_lo, c_hi, i_lo, i_hi in breakpoints:
-                if c_lo <= pm25 <= c_hi:
-                    aqi = int(((i_hi - i_lo) / (c_hi - c_lo)) * (pm25 - c_lo) + i_lo)
-                    break
-            
-            categories = ['Good', 'Satisfactory', 'Moderate', 'Poor', 'Very Poor', 'Severe']
-            cat_idx = min(aqi // 50, 5)
-            category = categories[cat_idx]
-            
-            return {
-                'aqi': aqi,
-                'category': category,
-                'pm25': pm25,
-                'pm10': data.get('pm10', 0),
-                'co': data.get('co', 0),
-                'no2': data.get('no2', 0),
-            }
+            return aqi_from_components(r.json()['list'][0]['components'])
     except Exception as e:
         print(f'Error fetching AQI: {e}')
     
@@ -107,14 +117,23 @@ def get_live_aqi(city):
 
 
 def get_live_weather(city):
+    """Fetch LIVE weather from OpenWeather API (cached for LIVE_CACHE_TTL seconds)"""
+    place = GAZETTEER.get(city)
+    if place is None:
+        return None
+    
+    return live_cache.get_or_fetch((place.key, 'weather'), lambda: fetch_live_weather(place.key))
+
+
+def fetch_live_weather(city):
     """Fetch LIVE weather from OpenWeather API"""
-    if city.lower() not in CITIES:
+    place = GAZETTEER.get(city)
+    if place is None:
         return None
     
-    lat, lon = CITIES[city.lower()]
     try:
-        url = f'http://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={OPENWEATHER_API_KEY}&units=metric'
-        r = requests.get(url, timeout=10)
+        url = f'http://api.openweathermap.org/data/2.5/weather?lat={place.lat}&lon={place.lon}&appid={OPENWEATHER_API_KEY}&units=metric'
+        r = http_client.get('openweather', url, timeout=10)
         
         if r.status_code == 200:
             data = r.json()
@@ -133,14 +152,23 @@ def get_live_weather(city):
 
 
 def get_weather_forecast(city, days=5):
+    """Fetch 5-day weather forecast (cached for LIVE_CACHE_TTL seconds)"""
+    place = GAZETTEER.get(city)
+    if place is None:
+        return None
+    
+    return live_cache.get_or_fetch((place.key, 'forecast', days), lambda: fetch_weather_forecast(place.key, days))
+
+
+def fetch_weather_forecast(city, days=5):
     """Fetch 5-day weather forecast"""
-    if city.lower() not in CITIES:
+    place = GAZETTEER.get(city)
+    if place is None:
         return None
     
-    lat, lon = CITIES[city.lower()]
     try:
-        url = f'http://api.openweathermap.org/data/2.5/forecast?lat={lat}&lon={lon}&appid={OPENWEATHER_API_KEY}&units=metric'
-        r = requests.get(url, timeout=10)
+        url = f'http://api.openweathermap.org/data/2.5/forecast?lat={place.lat}&lon={place.lon}&appid={OPENWEATHER_API_KEY}&units=metric'
+        r = http_client.get('openweather', url, timeout=10)
         
         if r.status_code == 200:
             data = r.json()
@@ -166,7 +194,7 @@ def search_internet(query):
     """Search the internet using SerpAPI"""
     try:
         url = f'https://serpapi.com/search.json?q={query}&api_key={SERPAPI_KEY}'
-        r = requests.get(url, timeout=15)
+        r = http_client.get('serpapi', url, timeout=15)
         
         if r.status_code == 200:
             data = r.json()
@@ -183,52 +211,61 @@ def search_internet(query):
     return None
 
 
-@torch.no_grad()
 def rag_generate(prompt, max_tokens=MAX_TOKENS, temp=TEMPERATURE):
     """Generate response with RAG (Retrieval-Augmented Generation)"""
-    model.eval()
+    init_model()
+    import torch
+    from generation import generate_ids
+    from tokenization import decode_response
+    
     context = ''
     
-    # 1. Extract city and get LIVE data
-    detected_city = None
-    for city in CITIES:
-        if city in prompt.lower():
-            detected_city = city
-            aqi = get_live_aqi(city)
-            weather = get_live_weather(city)
-            
-            if aqi:
-                context += f'[LIVE DATA: {city.title()} AQI={aqi["aqi"]} ({aqi["category"]}), PM2.5={aqi["pm25"]:.1f}]\\n'
-            
-            if weather:
-                context += f'[WEATHER: {weather["temp"]}°C, {weather["humidity"]}% humidity, {weather["desc"]}]\\n'
-            break
+    # 1. Extract city for LIVE data
+    place = GAZETTEER.find(prompt)
+    detected_city = place.key if place else None
+    tasks = {}
+    if detected_city:
+        tasks['aqi'] = lambda: get_live_aqi(detected_city)
+        tasks['weather'] = lambda: get_live_weather(detected_city)
     
     # 2. Search internet if needed
     search_keywords = ['news', 'latest', 'research', 'study', 'why', 'how', 'cause', 'effect', 'climate', 'forecast', 'future', 'predict']
     if any(kw in prompt.lower() for kw in search_keywords):
-        results = search_internet(prompt + ' India environment')
-        if results:
-            context += f'[WEB SEARCH: {results[0]["snippet"][:150]}]\\n'
+        tasks['web_search'] = lambda: search_internet(prompt + ' India environment')
     
-    # 3. Generate with context
-    full_prompt = f'{context}User: {prompt}\\nAssistant:' if context else f'User: {prompt}\\nAssistant:'
-    ids = tokenizer.encode(full_prompt, return_tensors='pt').to(device)
-    
-    if ids.size(1) > 400:
-        ids = ids[:, -400:]
-    
-    for _ in range(max_tokens):
-        out = model(ids)
-        logits = out.logits[:, -1, :] / temp
-        probs = F.softmax(logits, dim=-1)
-        next_id = torch.multinomial(probs, 1)
-        ids = torch.cat([ids, next_id], dim=1)
+    # Run the lookups in parallel; generate with whatever arrived in time
+    results, sources = fetch_all(tasks, RETRIEVAL_DEADLINE)
+    
+    if detected_city:
+        aqi = results.get('aqi')
+        weather = results.get('weather')
         
-        if next_id.item() == tokenizer.eos_token_id:
-            break
+        if aqi:
+            context += f'[LIVE DATA: {detected_city.title()} AQI={aqi["aqi"]} ({aqi["category"]}), PM2.5={aqi["pm25"]:.1f}]\\n'
+        
+        if weather:
+            context += f'[WEATHER: {weather["temp"]}°C, {weather["humidity"]}% humidity, {weather["desc"]}]\\n'
+    
+    if results.get('web_search'):
+        context += f'[WEB SEARCH: {results["web_search"][0]["snippet"][:150]}]\\n'
+    
+    # 3. Generate with context
+    ids, prefix_len = prompt_encoder.encode_with_prefix(context, prompt)
+    if len(ids) > 400:
+        ids, prefix_len = ids[-400:], 0
+    prompt_len = len(ids)
+    
+    generate = generate_ids
+    if draft is not None:
+        from speculative import generate_speculative
+        generate = functools.partial(generate_speculative, draft=draft, draft_tokens=SPECULATIVE_TOKENS)
+    
+    deadline = time.perf_counter() + DEADLINE_MS / 1000 if DEADLINE_MS > 0 else None
+    ids, stats = generate(model, torch.tensor([ids], device=device), max_tokens, temp, tokenizer.eos_token_id,
+                          prefix_cache=prefix_cache, prefix_len=prefix_len, prefix_tag=detected_city,
+                          stop=prompt_encoder.stop_ids(STOP_SEQUENCES), deadline=deadline)
     
-    response = tokenizer.decode(ids[0], skip_special_tokens=True).split('Assistant:')[-1].strip()
+    response = decode_response(tokenizer, ids[0, prompt_len:].tolist())
     
     return response, detected_city
 
@@ -313,7 +350,7 @@ def main():
     print('  • Ask general questions: "Why is pollution high in Delhi?"')
     print('  • Type "quit" to exit')
     print()
-    print(f'Available cities: {", ".join(CITIES.keys())}')
+    print(f'Available cities: {", ".join(CITIES.keys())} and {len(GAZETTEER) - len(CITIES)} more')
     print('=' * 70)
     print()
     
@@ -333,11 +370,8 @@ def main():
             wants_forecast = any(kw in query.lower() for kw in forecast_keywords)
             
             # Detect city
-            detected_city = None
-            for city in CITIES:
-                if city in query.lower():
-                    detected_city = city
-                    break
+            place = GAZETTEER.find(query)
+            detected_city = place.key if place else None
             
             if wants_forecast and detected_city:
                 # Provide formatted forecast
@@ -3,17 +3,23 @@ Weather Prediction API - Non-Interactive Version
 Designed to be called from Next.js backend via child process
 """
 
-import torch
-import torch.nn.functional as F
-from transformers import GPT2LMHeadModel, GPT2Tokenizer
-import requests
+import startup
 import os
+import functools
 import sys
 import json
+import time
 from dotenv import load_dotenv
+import http_client
+from live_cache import TTLCache
+from aqi import aqi_from_components
+from gazetteer import Gazetteer
+from retrieval import fetch_all
+from router import classify, data_answer, DecisionLog, DATA, FORECAST, OPEN
 
 # Load environment variables
 load_dotenv()
+startup.mark('imports')
 
 # Configuration
 OPENWEATHER_API_KEY = os.getenv('OPENWEATHER_API_KEY')
@@ -21,89 +27,95 @@ SERPAPI_KEY = os.getenv('SERPAPI_KEY')
 MODEL_PATH = os.getenv('MODEL_PATH', 'best_model.pt')
 TEMPERATURE = float(os.getenv('TEMPERATURE', '0.8'))
 MAX_TOKENS = int(os.getenv('MAX_TOKENS', '150'))
+STOP_SEQUENCES = [s for s in os.getenv('STOP_SEQUENCES', 'User:').split('|') if s]
+DEADLINE_MS = float(os.getenv('DEADLINE_MS', '0'))
+DRAFT_MODEL_PATH = os.getenv('DRAFT_MODEL_PATH', '')
+SPECULATIVE_TOKENS = int(os.getenv('SPECULATIVE_TOKENS', '4'))
+LIVE_CACHE_TTL = float(os.getenv('LIVE_CACHE_TTL', '300'))
+LIVE_CACHE_SIZE = int(os.getenv('LIVE_CACHE_SIZE', '256'))
+RETRIEVAL_DEADLINE = float(os.getenv('RETRIEVAL_DEADLINE', '8'))
+PREFIX_CACHE_MB = float(os.getenv('PREFIX_CACHE_MB', '64'))
+STARTUP_REPORT = os.getenv('STARTUP_REPORT', '0') == '1'
+QUANTIZE_INT8 = os.getenv('QUANTIZE_INT8', '0') == '1'
+INT8_MODEL_PATH = os.getenv('INT8_MODEL_PATH', 'best_model.int8.pt')
+QUERY_ROUTER = os.getenv('QUERY_ROUTER', '1') == '1'
+ROUTER_LOG = os.getenv('ROUTER_LOG')
 
-# Indian cities with coordinates
-CITIES = {
-    'kolkata': (22.57, 88.36),
-    'delhi': (28.61, 77.21),
-    'mumbai': (19.08, 72.88),
-    'bangalore': (12.97, 77.59),
-    'chennai': (13.08, 80.27),
-    'hyderabad': (17.38, 78.49),
-    'siliguri': (26.73, 88.40),
-    'darjeeling': (27.04, 88.27),
-    'durgapur': (23.52, 87.31),
-    'asansol': (23.67, 86.95),
-    'howrah': (22.59, 88.26),
-    'malda': (25.01, 88.14),
-}
+# Known places from gazetteer.csv (or GAZETTEER_PATH), matched by name or
+# alias. CITIES holds the featured ones that are listed and kept warm
+GAZETTEER = Gazetteer.load(os.getenv('GAZETTEER_PATH'))
+CITIES = GAZETTEER.featured()
+
+# Shared cache for OpenWeather lookups, keyed by (city, endpoint). A refresh
+# drops the city's cached prompt prefixes, which embed the old values
+live_cache = TTLCache(ttl=LIVE_CACHE_TTL, max_entries=LIVE_CACHE_SIZE,
+                      on_refresh=lambda key: invalidate_prefixes(key[0]))
+
+# Routing decisions go to stderr; stdout carries the JSON output
+router_log = DecisionLog(ROUTER_LOG, log=lambda message: print(message, file=sys.stderr))
 
 # Global model cache (loaded once)
 _model = None
 _tokenizer = None
 _device = None
+_prompt_encoder = None
+_prefix_cache = None
+_draft = None
+
+
+def invalidate_prefixes(city):
+    """Drop cached prompt-prefix KV built from a city's previous live data"""
+    if _prefix_cache is not None:
+        _prefix_cache.invalidate(city)
 
 
 def init_model():
-    """Initialize model (singleton pattern)"""
-    global _model, _tokenizer, _device
+    """Initialize model (singleton pattern)
+
+    torch and transformers are imported here rather than at module level so
+    forecast queries, which never touch the model, start without them.
+    """
+    global _model, _tokenizer, _device, _prompt_encoder, _prefix_cache, _draft
     
     if _model is not None:
         return
     
-    _device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    
-    _tokenizer = GPT2Tokenizer.from_pretrained('gpt2')
-    _tokenizer.pad_token = _tokenizer.eos_token
-    _model = GPT2LMHeadModel.from_pretrained('gpt2').to(_device)
+    with startup.phase('import_torch'):
+        from model_loader import load_model, load_draft
+        from tokenization import PromptEncoder
+        from prefix_cache import PrefixCache
     
-    # Load trained weights if available
-    if os.path.exists(MODEL_PATH):
-        _model.load_state_dict(torch.load(MODEL_PATH, map_location=_device))
+    with startup.phase('load_model'):
+        _model, _tokenizer, _device = load_model(MODEL_PATH, quantize=QUANTIZE_INT8, cache_path=INT8_MODEL_PATH)
+        _prompt_encoder = PromptEncoder(_tokenizer)
+        _prefix_cache = PrefixCache(int(PREFIX_CACHE_MB * 2 ** 20)) if PREFIX_CACHE_MB > 0 else None
     
-    _model.eval()
+    if DRAFT_MODEL_PATH:
+        with startup.phase('load_draft'):
+            _draft = load_draft(DRAFT_MODEL_PATH, _device, _model.config.vocab_size)
 
 
 def get_live_aqi(city):
+    """Fetch LIVE AQI from OpenWeather API (cached for LIVE_CACHE_TTL seconds)"""
+    place = GAZETTEER.get(city)
+    if place is None:
+        return None
+    
+    return live_cache.get_or_fetch((place.key, 'aqi'), lambda: fetch_live_aqi(place.key))
+
+
+def fetch_live_aqi(city):
     """Fetch LIVE AQI from OpenWeather API"""
-    if city.lower() not in CITIES:
+    place = GAZETTEER.get(city)
+    if place is None:
         return None
     
-    lat, lon = CITIES[city.lower()]
     try:
-        url = f'http://api.openweathermap.org/data/2.5/air_pollution?lat={lat}&lon={lon}&appid={OPENWEATHER_API_KEY}'
-        r = requests.get(url, timeout=10)
+        url = f'http://api.openweathermap.org/data/2.5/air_pollution?lat={place.lat}&lon={place.lon}&appid={OPENWEATHER_API_KEY}'
+        r = http_client.get('openweather', url, timeout=10)
         
         if r.status_code == 200:
-            data = r.json()['list'][0]['components']
-            pm25 = data.get('pm2_5', 0)
-            
-            # India AQI calculation
-            breakpoints = [
-                (0, 30, 0, 50),
-                (31, 60, 51, 100),
-                (61, 90, 101, 200),
-                (91, 120, 201, 300),
-                (121, 250, 301, 400),
-                (251, 500, 401, 500)
-            ]
-            
-            aqi = 500
-            for c_lo, c_hi, i_lo, i_hi in breakpoints:
-                if c_lo <= pm25 <= c_hi:
-                    aqi = int(((i_hi - i_lo) / (c_hi - c_lo)) * (pm25 - c_lo) + i_lo)
-                    break
-            
-            categories = ['Good', 'Satisfactory', 'Moderate', 'Poor', 'Very Poor', 'Severe']
-            cat_idx = min(aqi // 50, 5)
-            category = categories[cat_idx]
-            
-            return {
-                'aqi': aqi,
-                'category': category,
-                'pm25': pm25,
-                'pm10': data.get('pm10', 0),
-            }
+            return aqi_from_components(r.json()['list'][0]['components'])
     except:
         pass
     
@@ -111,14 +123,23 @@ def get_live_aqi(city):
 
 
 def get_live_weather(city):
+    """Fetch LIVE weather from OpenWeather API (cached for LIVE_CACHE_TTL seconds)"""
+    place = GAZETTEER.get(city)
+    if place is None:
+        return None
+    
+    return live_cache.get_or_fetch((place.key, 'weather'), lambda: fetch_live_weather(place.key))
+
+
+def fetch_live_weather(city):
     """Fetch LIVE weather from OpenWeather API"""
-    if city.lower() not in CITIES:
+    place = GAZETTEER.get(city)
+    if place is None:
         return None
     
-    lat, lon = CITIES[city.lower()]
     try:
-        url = f'http://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={OPENWEATHER_API_KEY}&units=metric'
-        r = requests.get(url, timeout=10)
+        url = f'http://api.openweathermap.org/data/2.5/weather?lat={place.lat}&lon={place.lon}&appid={OPENWEATHER_API_KEY}&units=metric'
+        r = http_client.get('openweather', url, timeout=10)
         
         if r.status_code == 200:
             data = r.json()
@@ -137,7 +158,7 @@ def search_internet(query):
     """Search the internet using SerpAPI"""
     try:
         url = f'https://serpapi.com/search.json?q={query}&api_key={SERPAPI_KEY}'
-        r = requests.get(url, timeout=15)
+        r = http_client.get('serpapi', url, timeout=15)
         
         if r.status_code == 200:
             data = r.json()
@@ -154,77 +175,98 @@ def search_internet(query):
     return None
 
 
-@torch.no_grad()
-def rag_generate(prompt, max_tokens=MAX_TOKENS, temp=TEMPERATURE):
-    """Generate response with RAG"""
+def rag_generate(prompt, max_tokens=MAX_TOKENS, temp=TEMPERATURE, stop=None, deadline_ms=None, started_at=None):
+    """Generate response with RAG
+
+    stop overrides STOP_SEQUENCES and deadline_ms DEADLINE_MS (counted from
+    started_at, a time.perf_counter() value). Returns (response, live_data,
+    sources, finish_reason).
+    """
     init_model()
+    import torch
+    from generation import generate_ids
+    from tokenization import decode_response
     
     context = ''
-    detected_city = None
-    
-    # 1. Extract city and get LIVE data
-    for city in CITIES:
-        if city in prompt.lower():
-            detected_city = city
-            aqi = get_live_aqi(city)
-            weather = get_live_weather(city)
-            
-            if aqi:
-                context += f'[LIVE DATA: {city.title()} AQI={aqi["aqi"]} ({aqi["category"]}), PM2.5={aqi["pm25"]:.1f}]\\n'
-            
-            if weather:
-                context += f'[WEATHER: {weather["temp"]}°C, {weather["humidity"]}% humidity, {weather["desc"]}]\\n'
-            break
+    
+    # 1. Extract city for LIVE data
+    place = GAZETTEER.find(prompt)
+    detected_city = place.key if place else None
+    tasks = {}
+    if detected_city:
+        tasks['aqi'] = lambda: get_live_aqi(detected_city)
+        tasks['weather'] = lambda: get_live_weather(detected_city)
     
     # 2. Search internet if needed
     search_keywords = ['news', 'latest', 'research', 'study', 'why', 'how', 'cause', 'effect', 'climate', 'forecast', 'future']
     if any(kw in prompt.lower() for kw in search_keywords):
-        results = search_internet(prompt + ' India environment')
-        if results:
-            context += f'[WEB SEARCH: {results[0]["snippet"][:150]}]\\n'
+        tasks['web_search'] = lambda: search_internet(prompt + ' India environment')
     
-    # 3. Generate with context
-    full_prompt = f'{context}User: {prompt}\\nAssistant:' if context else f'User: {prompt}\\nAssistant:'
-    ids = _tokenizer.encode(full_prompt, return_tensors='pt').to(_device)
-    
-    if ids.size(1) > 400:
-        ids = ids[:, -400:]
-    
-    for _ in range(max_tokens):
-        out = _model(ids)
-        logits = out.logits[:, -1, :] / temp
-        probs = F.softmax(logits, dim=-1)
-        next_id = torch.multinomial(probs, 1)
-        ids = torch.cat([ids, next_id], dim=1)
+    # Run the lookups in parallel; generate with whatever arrived in time
+    results, sources = fetch_all(tasks, RETRIEVAL_DEADLINE)
+    
+    if detected_city:
+        aqi = results.get('aqi')
+        weather = results.get('weather')
+        
+        if aqi:
+            context += f'[LIVE DATA: {detected_city.title()} AQI={aqi["aqi"]} ({aqi["category"]}), PM2.5={aqi["pm25"]:.1f}]\\n'
         
-        if next_id.item() == _tokenizer.eos_token_id:
-            break
+        if weather:
+            context += f'[WEATHER: {weather["temp"]}°C, {weather["humidity"]}% humidity, {weather["desc"]}]\\n'
+    
+    if results.get('web_search'):
+        context += f'[WEB SEARCH: {results["web_search"][0]["snippet"][:150]}]\\n'
+    
+    # 3. Generate with context
+    ids, prefix_len = _prompt_encoder.encode_with_prefix(context, prompt)
+    if len(ids) > 400:
+        ids, prefix_len = ids[-400:], 0
+    prompt_len = len(ids)
+    
+    generate = generate_ids
+    if _draft is not None:
+        from speculative import generate_speculative
+        generate = functools.partial(generate_speculative, draft=_draft, draft_tokens=SPECULATIVE_TOKENS)
     
-    response = _tokenizer.decode(ids[0], skip_special_tokens=True).split('Assistant:')[-1].strip()
+    budget = DEADLINE_MS if deadline_ms is None else deadline_ms
+    deadline = (started_at or time.perf_counter()) + budget / 1000 if budget > 0 else None
+    ids, stats = generate(_model, torch.tensor([ids], device=_device), max_tokens, temp, _tokenizer.eos_token_id,
+                          prefix_cache=_prefix_cache, prefix_len=prefix_len, prefix_tag=detected_city,
+                          stop=_prompt_encoder.stop_ids(STOP_SEQUENCES if stop is None else stop), deadline=deadline)
     
-    # Get live data for detected city
+    response = decode_response(_tokenizer, ids[0, prompt_len:].tolist())
+    
+    # Live data for detected city (reuse the lookups from the retrieval stage)
     live_data = {}
     if detected_city:
-        aqi = get_live_aqi(detected_city)
-        weather = get_live_weather(detected_city)
-        if aqi:
-            live_data['aqi'] = aqi
-        if weather:
-            live_data['weather'] = weather
+        if results.get('aqi'):
+            live_data['aqi'] = results['aqi']
+        if results.get('weather'):
+            live_data['weather'] = results['weather']
         live_data['city'] = detected_city.title()
     
-    return response, live_data
+    return response, live_data, sources, stats['finish_reason']
 
 
 def get_weather_forecast(city, days=5):
+    """Fetch 5-day weather forecast (cached for LIVE_CACHE_TTL seconds)"""
+    place = GAZETTEER.get(city)
+    if place is None:
+        return None
+    
+    return live_cache.get_or_fetch((place.key, 'forecast', days), lambda: fetch_weather_forecast(place.key, days))
+
+
+def fetch_weather_forecast(city, days=5):
     """Fetch 5-day weather forecast"""
-    if city.lower() not in CITIES:
+    place = GAZETTEER.get(city)
+    if place is None:
         return None
     
-    lat, lon = CITIES[city.lower()]
     try:
-        url = f'http://api.openweathermap.org/data/2.5/forecast?lat={lat}&lon={lon}&appid={OPENWEATHER_API_KEY}&units=metric'
-        r = requests.get(url, timeout=10)
+        url = f'http://api.openweathermap.org/data/2.5/forecast?lat={place.lat}&lon={place.lon}&appid={OPENWEATHER_API_KEY}&units=metric'
+        r = http_client.get('openweather', url, timeout=10)
         
         if r.status_code == 200:
             data = r.json()
@@ -306,66 +348,207 @@ def format_weather_output(city, forecast_data, aqi_data, weather_data):
     return '\n'.join(output)
 
 
+def data_lookup(city, wants):
+    """Templated answer for a data-only question, or None if live data is missing"""
+    results, sources = fetch_all({
+        'aqi': lambda: get_live_aqi(city),
+        'weather': lambda: get_live_weather(city),
+    }, RETRIEVAL_DEADLINE)
+    
+    live_data = {'city': city.title()}
+    live_data.update({kind: results[kind] for kind in ('aqi', 'weather') if results.get(kind)})
+    
+    response = data_answer(city.title(), live_data, wants)
+    if response is None:
+        return None
+    
+    return {
+        'success': True,
+        'response': response + format_live_data(live_data),
+        'liveData': live_data,
+        'sources': sources
+    }
+
+
+def format_live_data(live_data):
+    """Live data display appended to an answer"""
+    text = ''
+    if 'aqi' in live_data:
+        aqi_data = live_data['aqi']
+        text += f"\n\n📊 LIVE DATA ({live_data['city']}):"
+        text += f"\n🔴 AQI: {aqi_data['aqi']} ({aqi_data['category']})"
+        text += f"\n💨 PM2.5: {aqi_data['pm25']:.1f} μg/m³"
+    
+    if 'weather' in live_data:
+        weather_data = live_data['weather']
+        text += f"\n🌡️  Weather: {weather_data['temp']}°C, {weather_data['humidity']}% humidity"
+    
+    return text
+
+
+def answer(query, stop=None, deadline_ms=None):
+    """Answer one query and return the JSON-serialisable output dict
+
+    stop and deadline_ms only apply when the model runs (see rag_generate()).
+    """
+    started_at = time.perf_counter()
+    
+    # Detect city and route: data lookups and forecasts skip the model
+    place = GAZETTEER.find(query)
+    detected_city = place.key if place else None
+    route, reason, wants = classify(query, detected_city)
+    if route == DATA and not QUERY_ROUTER:
+        route, reason = OPEN, 'data fast path off'
+    
+    if route == DATA:
+        startup.set_path('data')
+        with startup.phase('fetch'):
+            output = data_lookup(detected_city, wants)
+        if output is not None:
+            router_log.record(query, detected_city, route, reason, False, started_at)
+            output['route'] = route
+            output['finishReason'] = None
+            return output
+        reason += ', live data missing'
+    
+    if route == FORECAST:
+        startup.set_path('forecast')
+        with startup.phase('fetch'):
+            results, _ = fetch_all({
+                'forecast': lambda: get_weather_forecast(detected_city, days=5),
+                'aqi': lambda: get_live_aqi(detected_city),
+                'weather': lambda: get_live_weather(detected_city),
+            }, RETRIEVAL_DEADLINE)
+        forecast = results.get('forecast')
+        aqi = results.get('aqi')
+        weather = results.get('weather')
+        
+        response = format_weather_output(detected_city.title(), forecast, aqi, weather)
+        router_log.record(query, detected_city, route, reason, False, started_at)
+        
+        return {
+            'success': True,
+            'response': response,
+            'liveData': {
+                'city': detected_city.title(),
+                'aqi': aqi,
+                'weather': weather
+            },
+            'route': route,
+            'finishReason': None
+        }
+    
+    # Use AI to generate response
+    router_log.record(query, detected_city, route, reason, True, started_at)
+    startup.set_path('generate')
+    response, live_data, sources, finish_reason = rag_generate(query, stop=stop, deadline_ms=deadline_ms,
+                                                               started_at=started_at)
+    
+    # Add live data display
+    if live_data:
+        response += format_live_data(live_data)
+    
+    return {
+        'success': True,
+        'response': response,
+        'liveData': live_data,
+        'sources': sources,
+        'route': OPEN,
+        'finishReason': finish_reason
+    }
+
+
+def handle_line(line):
+    """Handle one newline-delimited JSON request from a worker's parent
+
+    Requests look like {"query": "...", "id": ...}; the optional id is echoed
+    back so a parent can match responses to requests. "stop" and
+    "deadlineMs" are accepted as by the Flask server's /predict.
+    """
+    try:
+        req = json.loads(line)
+    except ValueError as e:
+        return {'error': f'Invalid JSON: {e}', 'success': False}
+    
+    query = req.get('query', '') if isinstance(req, dict) else ''
+    if not query:
+        output = {'error': 'No query provided', 'success': False}
+    else:
+        try:
+            from tokenization import generation_options
+            output = answer(query, *generation_options(req))
+        except Exception as e:
+            output = {'error': str(e), 'success': False}
+    
+    if isinstance(req, dict) and 'id' in req:
+        output['id'] = req['id']
+    return output
+
+
+def serve_stdio():
+    """Persistent worker: one JSON request per stdin line, one JSON response per stdout line"""
+    init_model()
+    print(json.dumps({'ready': True, 'pid': os.getpid(), 'startup': startup.report('model_load')}), flush=True)
+    
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        print(json.dumps(handle_line(line)), flush=True)
+
+
+def serve_socket(path):
+    """Persistent worker listening on a Unix socket with the same line protocol"""
+    import socketserver
+    
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                self.wfile.write((json.dumps(handle_line(line)) + '\n').encode())
+                self.wfile.flush()
+    
+    init_model()
+    if os.path.exists(path):
+        os.unlink(path)
+    
+    with socketserver.ThreadingUnixStreamServer(path, Handler) as server:
+        print(json.dumps({'ready': True, 'pid': os.getpid(), 'socket': path}), flush=True)
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(path)
+
+
 def main():
-    """Main function - called from command line"""
+    """Main function - called from command line
+
+    python weather_predict_api.py "<query>"          answer one query and exit
+    python weather_predict_api.py --serve            persistent worker on stdin/stdout
+    python weather_predict_api.py --socket <path>    persistent worker on a Unix socket
+    """
     if len(sys.argv) < 2:
         print(json.dumps({'error': 'No query provided'}))
         sys.exit(1)
     
+    if sys.argv[1] == '--serve':
+        serve_stdio()
+        return
+    
+    if sys.argv[1] == '--socket':
+        if len(sys.argv) < 3:
+            print(json.dumps({'error': 'No socket path provided', 'success': False}))
+            sys.exit(1)
+        serve_socket(sys.argv[2])
+        return
+    
     query = sys.argv[1]
     
     try:
-        # Check if user wants formatted forecast
-        forecast_keywords = ['forecast', 'next days', 'future', 'tomorrow', 'week', 'coming days', 'predict', 'prediction']
-        wants_forecast = any(kw in query.lower() for kw in forecast_keywords)
-        
-        # Detect city
-        detected_city = None
-        for city in CITIES:
-            if city in query.lower():
-                detected_city = city
-                break
-        
-        # If wants forecast and city detected, provide formatted forecast
-        if wants_forecast and detected_city:
-            forecast = get_weather_forecast(detected_city, days=5)
-            aqi = get_live_aqi(detected_city)
-            weather = get_live_weather(detected_city)
-            
-            response = format_weather_output(detected_city.title(), forecast, aqi, weather)
-            
-            output = {
-                'success': True,
-                'response': response,
-                'liveData': {
-                    'city': detected_city.title(),
-                    'aqi': aqi,
-                    'weather': weather
-                }
-            }
-        else:
-            # Use AI to generate response
-            response, live_data = rag_generate(query)
-            
-            # Add live data display
-            if live_data:
-                if 'aqi' in live_data:
-                    aqi_data = live_data['aqi']
-                    response += f"\n\n📊 LIVE DATA ({live_data['city']}):"
-                    response += f"\n🔴 AQI: {aqi_data['aqi']} ({aqi_data['category']})"
-                    response += f"\n💨 PM2.5: {aqi_data['pm25']:.1f} μg/m³"
-                
-                if 'weather' in live_data:
-                    weather_data = live_data['weather']
-                    response += f"\n🌡️  Weather: {weather_data['temp']}°C, {weather_data['humidity']}% humidity"
-            
-            output = {
-                'success': True,
-                'response': response,
-                'liveData': live_data
-            }
-        
+        output = answer(query)
         print(json.dumps(output))
+        if STARTUP_REPORT:
+            print(json.dumps(startup.report()), file=sys.stderr)
         sys.exit(0)
         
     except Exception as e:
@@ -375,4 +558,3 @@ def main():
 
 if __name__ == '__main__':
     main()
-
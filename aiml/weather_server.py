@@ -3,17 +3,30 @@ Weather Prediction Flask Server
 Persistent server that loads model once and keeps it in memory
 """
 
-import torch
-import torch.nn.functional as F
-from transformers import GPT2LMHeadModel, GPT2Tokenizer
-import requests
+import startup
 import os
+import re
+import json
+import hashlib
+import functools
+import queue
+import threading
+import time
+from datetime import datetime, timezone
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify
+import http_client
+from live_cache import TTLCache
+from aqi import aqi_from_components
+from gazetteer import Gazetteer
+from retrieval import fetch_all
+from router import classify, daily_forecast, data_answer, DecisionLog, forecast_answer, DATA, FORECAST, OPEN
+from metrics import Registry, TOKEN_BUCKETS, CONTENT_TYPE
+from flask import Flask, Response, request, jsonify, stream_with_context, g
 from flask_cors import CORS
 
 # Load environment variables
 load_dotenv()
+startup.mark('imports')
 
 # Configuration
 OPENWEATHER_API_KEY = os.getenv('OPENWEATHER_API_KEY')
@@ -21,94 +34,191 @@ SERPAPI_KEY = os.getenv('SERPAPI_KEY')
 MODEL_PATH = os.getenv('MODEL_PATH', 'best_model.pt')
 TEMPERATURE = float(os.getenv('TEMPERATURE', '0.8'))
 MAX_TOKENS = int(os.getenv('MAX_TOKENS', '150'))
+LIVE_CACHE_TTL = float(os.getenv('LIVE_CACHE_TTL', '300'))
+LIVE_CACHE_SIZE = int(os.getenv('LIVE_CACHE_SIZE', '256'))
+LIVE_REFRESH_INTERVAL = float(os.getenv('LIVE_REFRESH_INTERVAL', '240'))
+RETRIEVAL_DEADLINE = float(os.getenv('RETRIEVAL_DEADLINE', '8'))
+BATCH_MAX_SIZE = int(os.getenv('BATCH_MAX_SIZE', '8'))
+BATCH_WINDOW_MS = float(os.getenv('BATCH_WINDOW_MS', '10'))
+PREFIX_CACHE_MB = float(os.getenv('PREFIX_CACHE_MB', '64'))
+RESPONSE_CACHE = os.getenv('RESPONSE_CACHE', '0') == '1'
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', '600'))
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '1024'))
+PRELOAD_MODEL = os.getenv('PRELOAD_MODEL', '1') == '1'
+QUANTIZE_INT8 = os.getenv('QUANTIZE_INT8', '0') == '1'
+INT8_MODEL_PATH = os.getenv('INT8_MODEL_PATH', 'best_model.int8.pt')
+QUERY_ROUTER = os.getenv('QUERY_ROUTER', '1') == '1'
+ROUTER_LOG = os.getenv('ROUTER_LOG')
+# '|'-separated; the model tends to invent a follow-up 'User:' turn
+STOP_SEQUENCES = [s for s in os.getenv('STOP_SEQUENCES', 'User:').split('|') if s]
+DEADLINE_MS = float(os.getenv('DEADLINE_MS', '0'))
+# Set to serve generations with speculative decoding instead of batching
+DRAFT_MODEL_PATH = os.getenv('DRAFT_MODEL_PATH', '')
+SPECULATIVE_TOKENS = int(os.getenv('SPECULATIVE_TOKENS', '4'))
 
-# Indian cities with coordinates
-CITIES = {
-    'kolkata': (22.57, 88.36),
-    'delhi': (28.61, 77.21),
-    'mumbai': (19.08, 72.88),
-    'bangalore': (12.97, 77.59),
-    'chennai': (13.08, 80.27),
-    'hyderabad': (17.38, 78.49),
-    'siliguri': (26.73, 88.40),
-    'darjeeling': (27.04, 88.27),
-    'durgapur': (23.52, 87.31),
-    'asansol': (23.67, 86.95),
-    'howrah': (22.59, 88.26),
-    'malda': (25.01, 88.14),
-}
+# Known places from gazetteer.csv (or GAZETTEER_PATH), matched by name or
+# alias. CITIES holds the featured ones that are listed and kept warm
+GAZETTEER = Gazetteer.load(os.getenv('GAZETTEER_PATH'))
+CITIES = GAZETTEER.featured()
+
+# Shared cache for OpenWeather lookups, keyed by (city, endpoint). A refresh
+# drops the city's cached prompt prefixes, which embed the old values
+live_cache = TTLCache(ttl=LIVE_CACHE_TTL, max_entries=LIVE_CACHE_SIZE,
+                      on_refresh=lambda key: invalidate_prefixes(key[0]))
+
+# Background refresher for every city's AQI and weather (started in __main__)
+refresher = None
+
+# Opt-in cache of generated answers, keyed by response_key()
+response_cache = TTLCache(ttl=RESPONSE_CACHE_TTL, max_entries=RESPONSE_CACHE_SIZE) if RESPONSE_CACHE else None
+
+# Routing decisions for the data-lookup / forecast fast paths
+router_log = DecisionLog(ROUTER_LOG)
+
+# Prometheus metrics served at /metrics
+metrics = Registry()
+REQUESTS = metrics.counter('aerosense_requests_total', 'HTTP requests by endpoint and status', ['endpoint', 'status'])
+REQUEST_SECONDS = metrics.histogram('aerosense_request_duration_seconds', 'HTTP request latency by endpoint', ['endpoint'])
+IN_FLIGHT = metrics.gauge('aerosense_requests_in_flight', 'HTTP requests being handled', ['endpoint'])
+STAGE_SECONDS = metrics.histogram('aerosense_stage_duration_seconds', 'Time spent in each stage of a prediction', ['stage'])
+PROMPT_TOKENS = metrics.histogram('aerosense_prompt_tokens', 'Prompt tokens per generation', buckets=TOKEN_BUCKETS)
+GENERATED_TOKENS = metrics.histogram('aerosense_generated_tokens', 'Tokens generated per request', buckets=TOKEN_BUCKETS)
+ROUTES = metrics.counter('aerosense_route_decisions_total', 'Query router decisions and whether the model ran', ['route', 'generated'])
+FINISHES = metrics.counter('aerosense_generation_finish_total', 'Generations by why they stopped', ['reason'])
+DRAFT_TOKENS = metrics.counter('aerosense_draft_tokens_total', 'Speculative draft tokens proposed and accepted', ['outcome'])
+CACHE_HITS = metrics.counter('aerosense_cache_hits_total', 'Cache lookups answered from the cache', ['cache'])
+CACHE_MISSES = metrics.counter('aerosense_cache_misses_total', 'Cache lookups that had to compute the value', ['cache'])
+CACHE_HIT_RATIO = metrics.gauge('aerosense_cache_hit_ratio', 'Hits over lookups since startup', ['cache'])
+CACHE_ENTRIES = metrics.gauge('aerosense_cache_entries', 'Entries currently cached', ['cache'])
 
 # Flask app
 app = Flask(__name__)
 CORS(app)
 
-# Global model (loaded once at startup)
+# Global model (loaded once by init_model on first use)
 device = None
 model = None
 tokenizer = None
+scheduler = None
+prompt_encoder = None
+prefix_cache = None
+_weights = None
+_draft = None
+_init_lock = threading.Lock()
 
 print('🔧 Initializing Weather Prediction Server...')
 
-# Load model at startup
-device = 'cuda' if torch.cuda.is_available() else 'cpu'
-print(f'📦 Device: {device}')
 
-print('📦 Loading GPT-2 model and tokenizer...')
-tokenizer = GPT2Tokenizer.from_pretrained('gpt2')
-tokenizer.pad_token = tokenizer.eos_token
-model = GPT2LMHeadModel.from_pretrained('gpt2').to(device)
+def invalidate_prefixes(city):
+    """Drop cached prompt-prefix KV built from a city's previous live data"""
+    if prefix_cache is not None:
+        prefix_cache.invalidate(city)
+
 
-# Load trained weights if available
-if os.path.exists(MODEL_PATH):
-    print(f'✅ Loading trained model from {MODEL_PATH}')
-    model.load_state_dict(torch.load(MODEL_PATH, map_location=device))
-else:
-    print(f'⚠️  Warning: {MODEL_PATH} not found. Using base GPT-2.')
+def load_weights():
+    """(model, tokenizer, device), loaded once per process, plus the draft model when configured
 
-model.eval()
-print('✅ Model loaded successfully!')
+    prefork.py calls this in the parent before forking, so the workers'
+    init_model() starts from weights they share copy-on-write.
+    """
+    global _weights, _draft
+    
+    if _weights is None:
+        with startup.phase('import_torch'):
+            from model_loader import load_model, load_draft
+        
+        with startup.phase('load_model'):
+            weights = load_model(MODEL_PATH, quantize=QUANTIZE_INT8, cache_path=INT8_MODEL_PATH, log=print)
+        
+        if DRAFT_MODEL_PATH:
+            with startup.phase('load_draft'):
+                _draft = load_draft(DRAFT_MODEL_PATH, weights[2], weights[0].config.vocab_size, log=print)
+        _weights = weights
+    
+    return _weights
+
+
+def init_model():
+    """Import torch/transformers and load the model on first use (thread-safe)"""
+    global device, model, tokenizer, scheduler, prompt_encoder, prefix_cache
+    
+    if scheduler is not None:
+        return
+    
+    with _init_lock:
+        if scheduler is not None:
+            return
+        
+        _model, _tokenizer, _device = load_weights()
+        from batching import BatchScheduler
+        from speculative import SpeculativeScheduler
+        from tokenization import PromptEncoder
+        from prefix_cache import PrefixCache
+        
+        _prefix_cache = PrefixCache(int(PREFIX_CACHE_MB * 2 ** 20)) if PREFIX_CACHE_MB > 0 else None
+        if _draft is not None:
+            _scheduler = SpeculativeScheduler(_model, _draft, _tokenizer.eos_token_id, SPECULATIVE_TOKENS,
+                                              prefix_cache=_prefix_cache)
+            print(f'📦 Speculative decoding with {DRAFT_MODEL_PATH} ({SPECULATIVE_TOKENS} draft tokens per pass)')
+        else:
+            # Concurrent /predict requests share the model through one batching thread
+            _scheduler = BatchScheduler(_model, _tokenizer.pad_token_id, _tokenizer.eos_token_id,
+                                        max_batch_size=BATCH_MAX_SIZE, window_ms=BATCH_WINDOW_MS,
+                                        prefix_cache=_prefix_cache)
+            print(f'📦 Batching up to {BATCH_MAX_SIZE} requests ({BATCH_WINDOW_MS:g} ms window)')
+        
+        device, model, tokenizer = _device, _model, _tokenizer
+        prompt_encoder = PromptEncoder(_tokenizer)
+        prefix_cache = _prefix_cache
+        scheduler = _scheduler
+        print(f'✅ Model loaded successfully! {json.dumps(startup.report("model_load"))}')
+
+
+def refreshed(key):
+    """True when the background refresher keeps key warm"""
+    return refresher is not None and key in refresher.jobs
+
+
+def cached_live(key, fetch):
+    """Live data lookup through the cache
+
+    The refresher owns the featured cities' entries, so for those the last
+    refreshed value is returned even if a refresh has since failed, and
+    OpenWeather is only called here when a city has no value yet. Every
+    other place expires after LIVE_CACHE_TTL as usual.
+    """
+    return live_cache.get_or_fetch(key, fetch, stale=refreshed(key))
 
 
 def get_live_aqi(city):
+    """Fetch LIVE AQI from OpenWeather API (cached for LIVE_CACHE_TTL seconds)"""
+    place = GAZETTEER.get(city)
+    if place is None:
+        return None
+    
+    return cached_live((place.key, 'aqi'), lambda: fetch_live_aqi(place.key))
+
+
+def aqi_url(place):
+    return f'http://api.openweathermap.org/data/2.5/air_pollution?lat={place.lat}&lon={place.lon}&appid={OPENWEATHER_API_KEY}'
+
+
+def parse_aqi(data):
+    return aqi_from_components(data['list'][0]['components'])
+
+
+def fetch_live_aqi(city):
     """Fetch LIVE AQI from OpenWeather API"""
-    if city.lower() not in CITIES:
+    place = GAZETTEER.get(city)
+    if place is None:
         return None
     
-    lat, lon = CITIES[city.lower()]
     try:
-        url = f'http://api.openweathermap.org/data/2.5/air_pollution?lat={lat}&lon={lon}&appid={OPENWEATHER_API_KEY}'
-        r = requests.get(url, timeout=10)
+        with STAGE_SECONDS.time(stage='openweather_aqi'):
+            r = http_client.get('openweather', aqi_url(place), timeout=10)
         
         if r.status_code == 200:
-            data = r.json()['list'][0]['components']
-            pm25 = data.get('pm2_5', 0)
-            
-            # India AQI calculation
-            breakpoints = [
-                (0, 30, 0, 50),
-                (31, 60, 51, 100),
-                (61, 90, 101, 200),
-                (91, 120, 201, 300),
-                (121, 250, 301, 400),
-                (251, 500, 401, 500)
-            ]
-            
-            aqi = 500
-            for c_lo, c_hi, i_lo, i_hi in breakpoints:
-                if c_lo <= pm25 <= c_hi:
-                    aqi = int(((i_hi - i_lo) / (c_hi - c_lo)) * (pm25 - c_lo) + i_lo)
-                    break
-            
-            categories = ['Good', 'Satisfactory', 'Moderate', 'Poor', 'Very Poor', 'Severe']
-            cat_idx = min(aqi // 50, 5)
-            category = categories[cat_idx]
-            
-            return {
-                'aqi': aqi,
-                'category': category,
-                'pm25': pm25,
-                'pm10': data.get('pm10', 0),
-            }
+            return parse_aqi(r.json())
     except:
         pass
     
@@ -116,107 +226,405 @@ def get_live_aqi(city):
 
 
 def get_live_weather(city):
+    """Fetch LIVE weather from OpenWeather API (cached for LIVE_CACHE_TTL seconds)"""
+    place = GAZETTEER.get(city)
+    if place is None:
+        return None
+    
+    return cached_live((place.key, 'weather'), lambda: fetch_live_weather(place.key))
+
+
+def weather_url(place):
+    return f'http://api.openweathermap.org/data/2.5/weather?lat={place.lat}&lon={place.lon}&appid={OPENWEATHER_API_KEY}&units=metric'
+
+
+def parse_weather(data):
+    return {
+        'temp': data['main']['temp'],
+        'humidity': data['main']['humidity'],
+        'desc': data['weather'][0]['description'],
+    }
+
+
+def fetch_live_weather(city):
     """Fetch LIVE weather from OpenWeather API"""
-    if city.lower() not in CITIES:
+    place = GAZETTEER.get(city)
+    if place is None:
         return None
     
-    lat, lon = CITIES[city.lower()]
     try:
-        url = f'http://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={OPENWEATHER_API_KEY}&units=metric'
-        r = requests.get(url, timeout=10)
+        with STAGE_SECONDS.time(stage='openweather_weather'):
+            r = http_client.get('openweather', weather_url(place), timeout=10)
         
         if r.status_code == 200:
-            data = r.json()
-            return {
-                'temp': data['main']['temp'],
-                'humidity': data['main']['humidity'],
-                'desc': data['weather'][0]['description'],
-            }
+            return parse_weather(r.json())
     except:
         pass
     
     return None
 
 
+def search_url(query):
+    return f'https://serpapi.com/search.json?q={query}&api_key={SERPAPI_KEY}'
+
+
+def parse_search(data):
+    results = []
+    for item in data.get('organic_results', [])[:3]:
+        results.append({
+            'title': item.get('title', ''),
+            'snippet': item.get('snippet', '')
+        })
+    return results
+
+
 def search_internet(query):
     """Search the internet using SerpAPI"""
     try:
-        url = f'https://serpapi.com/search.json?q={query}&api_key={SERPAPI_KEY}'
-        r = requests.get(url, timeout=15)
+        with STAGE_SECONDS.time(stage='serpapi'):
+            r = http_client.get('serpapi', search_url(query), timeout=15)
         
         if r.status_code == 200:
-            data = r.json()
-            results = []
-            for item in data.get('organic_results', [])[:3]:
-                results.append({
-                    'title': item.get('title', ''),
-                    'snippet': item.get('snippet', '')
-                })
-            return results
+            return parse_search(r.json())
     except:
         pass
     
     return None
 
 
-@torch.no_grad()
-def rag_generate(prompt, max_tokens=MAX_TOKENS, temp=TEMPERATURE):
-    """Generate response with RAG"""
-    context = ''
-    detected_city = None
+def get_weather_forecast(city, days=5):
+    """Fetch 5-day weather forecast (cached for LIVE_CACHE_TTL seconds)"""
+    place = GAZETTEER.get(city)
+    if place is None:
+        return None
     
-    # 1. Extract city and get LIVE data
-    for city in CITIES:
-        if city in prompt.lower():
-            detected_city = city
-            aqi = get_live_aqi(city)
-            weather = get_live_weather(city)
-            
-            if aqi:
-                context += f'[LIVE DATA: {city.title()} AQI={aqi["aqi"]} ({aqi["category"]}), PM2.5={aqi["pm25"]:.1f}]\\n'
-            
-            if weather:
-                context += f'[WEATHER: {weather["temp"]}°C, {weather["humidity"]}% humidity, {weather["desc"]}]\\n'
-            break
+    # Not refreshed in the background, so never served past its TTL
+    return live_cache.get_or_fetch((place.key, 'forecast', days), lambda: fetch_weather_forecast(place.key, days))
+
+
+def forecast_url(place):
+    return f'http://api.openweathermap.org/data/2.5/forecast?lat={place.lat}&lon={place.lon}&appid={OPENWEATHER_API_KEY}&units=metric'
+
+
+def parse_forecast(data, days=5):
+    forecasts = []
+    
+    for item in data['list'][:days * 8]:  # 8 entries per day (3-hour intervals)
+        forecasts.append({
+            'date': item['dt_txt'],
+            'temp': item['main']['temp'],
+            'humidity': item['main']['humidity'],
+            'desc': item['weather'][0]['description'],
+            'wind': item['wind']['speed'],
+        })
+    
+    return forecasts
+
+
+def fetch_weather_forecast(city, days=5):
+    """Fetch 5-day weather forecast"""
+    place = GAZETTEER.get(city)
+    if place is None:
+        return None
+    
+    try:
+        with STAGE_SECONDS.time(stage='openweather_forecast'):
+            r = http_client.get('openweather', forecast_url(place), timeout=10)
+        
+        if r.status_code == 200:
+            return parse_forecast(r.json(), days)
+    except:
+        pass
+    
+    return None
+
+
+# Lookups a fast answer or RAG context can ask for, by name
+LOOKUPS = {
+    'aqi': get_live_aqi,
+    'weather': get_live_weather,
+    'forecast': get_weather_forecast,
+    'web_search': search_internet,
+}
+
+
+def plan_route(query):
+    """(city, route, reason, wants, lookups) for a query
+
+    lookups maps the live data needed for a fast answer to the city to look
+    it up for, and is empty when the query goes to the model.
+    """
+    place = GAZETTEER.find(query)
+    city = place.key if place else None
+    route, reason, wants = classify(query, city)
+    if route == DATA and not QUERY_ROUTER:
+        route, reason = OPEN, 'data fast path off'
+    
+    lookups = {}
+    if route in (DATA, FORECAST):
+        lookups = {'aqi': city, 'weather': city}
+        if route == FORECAST:
+            lookups['forecast'] = city
+    
+    return city, route, reason, wants, lookups
+
+
+def finish_route(query, plan, results, sources, started_at):
+    """Build the fast answer from the lookup results and log the decision
+
+    Returns (response, live_data, sources, route, forecast), or None when
+    the query goes to the model. forecast is the daily_forecast() list for
+    forecast answers and None otherwise.
+    """
+    city, route, reason, wants, lookups = plan
+    response = forecast = None
+    
+    if lookups:
+        live_data = {'city': city.title()}
+        live_data.update({kind: results[kind] for kind in ('aqi', 'weather') if results.get(kind)})
+        
+        if route == DATA:
+            response = data_answer(city.title(), live_data, wants)
+            if response is not None:
+                response = format_live_data(response, live_data)
+        elif results.get('forecast'):
+            forecast = daily_forecast(results['forecast'])
+            response = format_live_data(forecast_answer(city.title(), forecast), live_data)
+        
+        if response is None:
+            reason += ', live data missing'
+    
+    generated = response is None
+    router_log.record(query, city, route, reason, generated, started_at)
+    ROUTES.inc(route=route, generated=str(generated).lower())
+    
+    return None if generated else (response, live_data, sources, route, forecast)
+
+
+def fast_answer(query):
+    """Answer data lookups and forecasts without running the model
+
+    Returns (response, live_data, sources, route, forecast), or None when the
+    query is an open question or live data for the answer is missing.
+    QUERY_ROUTER=0 sends data lookups to the model. Every decision is logged
+    by router_log.
+    """
+    started_at = time.perf_counter()
+    plan = plan_route(query)
+    results, sources = run_lookups(plan[-1]) if plan[-1] else ({}, {})
+    return finish_route(query, plan, results, sources, started_at)
+
+
+def run_lookups(lookups):
+    """fetch_all() over {name: argument} for the LOOKUPS functions"""
+    tasks = {name: functools.partial(LOOKUPS[name], arg) for name, arg in lookups.items()}
+    with STAGE_SECONDS.time(stage='retrieval'):
+        return fetch_all(tasks, RETRIEVAL_DEADLINE)
+
+
+def plan_retrieval(prompt):
+    """(city, lookups) for the RAG context of a prompt
+
+    city is the place mentioned in the prompt (or None) and lookups maps
+    each of 'aqi', 'weather' and 'web_search' that applies to its argument.
+    """
+    lookups = {}
+    
+    # 1. Extract city for LIVE data
+    place = GAZETTEER.find(prompt)
+    detected_city = place.key if place else None
+    if detected_city:
+        lookups['aqi'] = detected_city
+        lookups['weather'] = detected_city
     
     # 2. Search internet if needed
     search_keywords = ['news', 'latest', 'research', 'study', 'why', 'how', 'cause', 'effect', 'climate', 'forecast', 'future']
     if any(kw in prompt.lower() for kw in search_keywords):
-        results = search_internet(prompt + ' India environment')
-        if results:
-            context += f'[WEB SEARCH: {results[0]["snippet"][:150]}]\\n'
-    
-    # 3. Generate with context
-    full_prompt = f'{context}User: {prompt}\\nAssistant:' if context else f'User: {prompt}\\nAssistant:'
-    ids = tokenizer.encode(full_prompt, return_tensors='pt').to(device)
-    
-    if ids.size(1) > 400:
-        ids = ids[:, -400:]
-    
-    for _ in range(max_tokens):
-        out = model(ids)
-        logits = out.logits[:, -1, :] / temp
-        probs = F.softmax(logits, dim=-1)
-        next_id = torch.multinomial(probs, 1)
-        ids = torch.cat([ids, next_id], dim=1)
-        
-        if next_id.item() == tokenizer.eos_token_id:
-            break
-    
-    response = tokenizer.decode(ids[0], skip_special_tokens=True).split('Assistant:')[-1].strip()
+        lookups['web_search'] = prompt + ' India environment'
     
-    # Get live data for detected city
+    return detected_city, lookups
+
+
+def build_context(detected_city, results, sources):
+    """(context, live_data) from the retrieval results; see retrieve_context()"""
+    context = ''
     live_data = {}
+    
     if detected_city:
-        aqi = get_live_aqi(detected_city)
-        weather = get_live_weather(detected_city)
+        aqi = results.get('aqi')
+        weather = results.get('weather')
+        
         if aqi:
+            context += f'[LIVE DATA: {detected_city.title()} AQI={aqi["aqi"]} ({aqi["category"]}), PM2.5={aqi["pm25"]:.1f}]\\n'
             live_data['aqi'] = aqi
+        
         if weather:
+            context += f'[WEATHER: {weather["temp"]}°C, {weather["humidity"]}% humidity, {weather["desc"]}]\\n'
             live_data['weather'] = weather
         live_data['city'] = detected_city.title()
     
-    return response, live_data
+    if results.get('web_search'):
+        context += f'[WEB SEARCH: {results["web_search"][0]["snippet"][:150]}]\\n'
+    
+    timed_out = [name for name, status in sources.items() if status == 'timeout']
+    if timed_out:
+        print(f'⏱️  Retrieval deadline hit, generating without: {", ".join(timed_out)}')
+    
+    return context, live_data
+
+
+def retrieve_context(prompt):
+    """Look up live data and web results for a prompt
+
+    The lookups run in parallel and generation waits at most
+    RETRIEVAL_DEADLINE seconds for them. Returns (context, live_data, sources)
+    where context is the bracketed prompt prefix, live_data is the block
+    returned to the client as liveData and sources reports each lookup's
+    status ('ok', 'empty', 'error' or 'timeout').
+    """
+    detected_city, lookups = plan_retrieval(prompt)
+    results, sources = run_lookups(lookups)
+    context, live_data = build_context(detected_city, results, sources)
+    
+    return context, live_data, sources
+
+
+def encode_prompt(prompt, context):
+    """(ids, prefix_len) for the RAG prompt, keeping the last 400 tokens"""
+    init_model()
+    with STAGE_SECONDS.time(stage='tokenize'):
+        ids, prefix_len = prompt_encoder.encode_with_prefix(context, prompt)
+    
+    if len(ids) > 400:
+        # Truncation cuts into the shared prefix, so it cannot be reused
+        return ids[-400:], 0
+    
+    return ids, prefix_len
+
+
+def response_key(prompt, context, live_data):
+    """Response cache key: (normalized query, city, live data stamp)
+
+    The stamp is a hash of the context the answer was generated from, so a
+    cached answer is only reused while the live data (and web snippet) it
+    quoted are unchanged.
+    """
+    normalized = ' '.join(re.sub(r'[^\w\s]', ' ', prompt.lower()).split())
+    stamp = hashlib.sha1(context.encode()).hexdigest()[:12]
+    return normalized, live_data.get('city', '').lower(), stamp
+
+
+def generate_response(prompt, context, live_data, max_tokens=MAX_TOKENS, temp=TEMPERATURE, stop=None, deadline=None):
+    """Run the model on the RAG prompt and return (answer text, finish reason)
+
+    stop is a list of stop strings (STOP_SEQUENCES when None) and deadline a
+    time.perf_counter() value after which generation ends early.
+    """
+    from tokenization import IncrementalDecoder
+    
+    ids, prefix_len = encode_prompt(prompt, context)
+    
+    # Decode while the batch runs so the text is ready when the last token lands
+    decoder = IncrementalDecoder(tokenizer)
+    detokenize = [0.0]
+    
+    def on_token(token):
+        start = time.perf_counter()
+        decoder.push(token)
+        detokenize[0] += time.perf_counter() - start
+    
+    _, stats = scheduler.submit(ids, max_tokens, temp, on_token=on_token, prefix_len=prefix_len,
+                                prefix_tag=live_data.get('city', '').lower(),
+                                stop=prompt_encoder.stop_ids(STOP_SEQUENCES if stop is None else stop),
+                                deadline=deadline).result()
+    observe_generation(stats, detokenize[0])
+    print(f'⚡ Generated {stats["new_tokens"]} tokens ({stats["ms_per_token"]:.1f} ms/token, queued {stats["queue_ms"]:.0f} ms, '
+          f'{stats["prefix_tokens"]} prefix tokens reused, {stats["finish_reason"]})')
+    
+    return decoder.response(), stats['finish_reason']
+
+
+def observe_generation(stats, detokenize_s):
+    """Record a finished generation's stage timings and token counts"""
+    STAGE_SECONDS.observe(stats['queue_ms'] / 1000, stage='queue')
+    STAGE_SECONDS.observe(stats['first_token_ms'] / 1000, stage='prefill')
+    STAGE_SECONDS.observe((stats['total_ms'] - stats['first_token_ms']) / 1000, stage='decode')
+    STAGE_SECONDS.observe(detokenize_s, stage='detokenize')
+    PROMPT_TOKENS.observe(stats['prompt_tokens'])
+    GENERATED_TOKENS.observe(stats['new_tokens'])
+    FINISHES.inc(reason=stats['finish_reason'])
+    if 'drafted_tokens' in stats:
+        DRAFT_TOKENS.inc(stats['drafted_tokens'], outcome='drafted')
+        DRAFT_TOKENS.inc(stats['accepted_tokens'], outcome='accepted')
+
+
+def rag_generate(prompt, max_tokens=MAX_TOKENS, temp=TEMPERATURE, bypass_cache=False, stop=None, deadline_ms=None,
+                 started_at=None):
+    """Generate response with RAG
+
+    Returns (response, live_data, sources, cached, finish_reason). With
+    RESPONSE_CACHE on, a repeat of the query against the same live data
+    reuses the earlier answer (finish_reason None); bypass_cache forces a
+    fresh one (which then replaces it).
+
+    stop overrides STOP_SEQUENCES and deadline_ms DEADLINE_MS; the budget
+    counts from started_at (time.perf_counter(), default now). Requests
+    with either are neither answered from nor stored in the cache, and an
+    answer cut short by the deadline is not kept.
+    """
+    deadline = generation_deadline(deadline_ms, started_at)
+    context, live_data, sources = retrieve_context(prompt)
+    
+    if response_cache is None or stop is not None or deadline_ms is not None:
+        response, finish_reason = generate_response(prompt, context, live_data, max_tokens, temp, stop, deadline)
+        return response, live_data, sources, False, finish_reason
+    
+    key = response_key(prompt, context, live_data)
+    if bypass_cache:
+        response_cache.invalidate(key)
+    
+    finished = []
+    
+    def fetch():
+        response, finish_reason = generate_response(prompt, context, live_data, max_tokens, temp, deadline=deadline)
+        finished.append(finish_reason)
+        return response
+    
+    # Identical queries arriving together share one generation
+    response = response_cache.get_or_fetch(key, fetch)
+    if finished == ['deadline']:
+        response_cache.invalidate(key)
+    
+    return response, live_data, sources, not finished, finished[0] if finished else None
+
+
+def generation_deadline(deadline_ms, started_at=None):
+    """time.perf_counter() value when the budget (deadline_ms or DEADLINE_MS) runs out, or None"""
+    budget = DEADLINE_MS if deadline_ms is None else deadline_ms
+    if budget <= 0:
+        return None
+    return (time.perf_counter() if started_at is None else started_at) + budget / 1000
+
+
+def wants_fresh(data):
+    """Per-request response cache bypass: {"bypassCache": true} or Cache-Control: no-cache"""
+    return bool(data.get('bypassCache')) or 'no-cache' in request.headers.get('Cache-Control', '')
+
+
+def format_live_data(response, live_data):
+    """Append the live data display to a generated response"""
+    if live_data:
+        if 'aqi' in live_data:
+            aqi_data = live_data['aqi']
+            response += f"\n\n📊 LIVE DATA ({live_data['city']}):"
+            response += f"\n🔴 AQI: {aqi_data['aqi']} ({aqi_data['category']})"
+            response += f"\n💨 PM2.5: {aqi_data['pm25']:.1f} μg/m³"
+        
+        if 'weather' in live_data:
+            weather_data = live_data['weather']
+            response += f"\n🌡️  Weather: {weather_data['temp']}°C, {weather_data['humidity']}% humidity"
+    
+    return response
 
 
 @app.route('/predict', methods=['POST'])
@@ -229,38 +637,365 @@ def predict():
         if not query:
             return jsonify({'error': 'No query provided', 'success': False}), 400
         
-        # Generate response
-        response, live_data = rag_generate(query)
+        from tokenization import generation_options
+        
+        try:
+            stop, deadline_ms = generation_options(data)
+        except ValueError as e:
+            return jsonify({'error': str(e), 'success': False}), 400
+        
+        # Data lookups and forecasts are answered from live data alone
+        fast = fast_answer(query)
+        if fast is not None:
+            response, live_data, sources, route, forecast = fast
+            cached = False
+            finish_reason = None
+        else:
+            response, live_data, sources, cached, finish_reason = rag_generate(
+                query, bypass_cache=wants_fresh(data), stop=stop, deadline_ms=deadline_ms, started_at=g.started_at)
+            response = format_live_data(response, live_data)
+            route = OPEN
+            forecast = None
+        
+        with STAGE_SECONDS.time(stage='serialize'):
+            return jsonify({
+                'success': True,
+                'response': response,
+                'liveData': live_data,
+                'sources': sources,
+                'cached': cached,
+                'route': route,
+                'forecast': forecast,
+                'finishReason': finish_reason
+            })
+        
+    except Exception as e:
+        print(f'❌ Error: {e}')
+        return jsonify({'error': str(e), 'success': False}), 500
+
+
+@app.route('/predict/stream', methods=['POST'])
+def predict_stream():
+    """Streaming prediction endpoint
+
+    Responds with newline-delimited JSON events:
+      {"type": "liveData", "liveData": {...}, "sources": {...}}   once the lookups finish
+      {"type": "token", "text": "..."}          for every decoded text increment
+      {"type": "done", "success": true, "response": "...", "liveData": {...}, "cached": false, "route": "open",
+       "forecast": null, "finishReason": "eos"}
+      {"type": "error", "success": false, "error": "..."}
+    The final "done" event carries the same response as /predict. A cached
+    answer, data lookup or forecast arrives as a single token event.
+    "stop" and "deadlineMs" work as for /predict.
+    """
+    data = request.json or {}
+    query = data.get('query', '')
+    
+    if not query:
+        return jsonify({'error': 'No query provided', 'success': False}), 400
+    
+    from tokenization import generation_options
+    
+    try:
+        stop, deadline_ms = generation_options(data)
+    except ValueError as e:
+        return jsonify({'error': str(e), 'success': False}), 400
+    
+    bypass_cache = wants_fresh(data)
+    custom = stop is not None or deadline_ms is not None
+    deadline = generation_deadline(deadline_ms, g.started_at)
+    
+    def events():
+        from tokenization import IncrementalDecoder
         
-        # Add live data display
-        if live_data:
-            if 'aqi' in live_data:
-                aqi_data = live_data['aqi']
-                response += f"\n\n📊 LIVE DATA ({live_data['city']}):"
-                response += f"\n🔴 AQI: {aqi_data['aqi']} ({aqi_data['category']})"
-                response += f"\n💨 PM2.5: {aqi_data['pm25']:.1f} μg/m³"
+        future = None
+        try:
+            fast = fast_answer(query)
+            if fast is not None:
+                response, live_data, sources, route, forecast = fast
+                yield json.dumps({'type': 'liveData', 'liveData': live_data, 'sources': sources}) + '\n'
+                yield json.dumps({'type': 'token', 'text': response}) + '\n'
+                yield json.dumps({
+                    'type': 'done',
+                    'success': True,
+                    'response': response,
+                    'liveData': live_data,
+                    'sources': sources,
+                    'cached': False,
+                    'route': route,
+                    'forecast': forecast,
+                    'finishReason': None
+                }) + '\n'
+                return
+            
+            context, live_data, sources = retrieve_context(query)
+            yield json.dumps({'type': 'liveData', 'liveData': live_data, 'sources': sources}) + '\n'
+            
+            key = response_key(query, context, live_data) if response_cache is not None and not custom else None
+            response = response_cache.get(key) if key and not bypass_cache else None
+            if response is not None:
+                yield json.dumps({'type': 'token', 'text': response}) + '\n'
+                yield json.dumps({
+                    'type': 'done',
+                    'success': True,
+                    'response': format_live_data(response, live_data),
+                    'liveData': live_data,
+                    'sources': sources,
+                    'cached': True,
+                    'route': OPEN,
+                    'forecast': None,
+                    'finishReason': None
+                }) + '\n'
+                return
+            
+            ids, prefix_len = encode_prompt(query, context)
+            tokens = queue.Queue()
+            future = scheduler.submit(ids, MAX_TOKENS, TEMPERATURE, on_token=tokens.put, prefix_len=prefix_len,
+                                      prefix_tag=live_data.get('city', '').lower(),
+                                      stop=prompt_encoder.stop_ids(STOP_SEQUENCES if stop is None else stop),
+                                      deadline=deadline)
+            future.add_done_callback(lambda _: tokens.put(None))
             
-            if 'weather' in live_data:
-                weather_data = live_data['weather']
-                response += f"\n🌡️  Weather: {weather_data['temp']}°C, {weather_data['humidity']}% humidity"
+            decoder = IncrementalDecoder(tokenizer)
+            detokenize = 0.0
+            sent = False
+            while True:
+                token = tokens.get()
+                if token is None:
+                    break
+                start = time.perf_counter()
+                text = decoder.push(token)
+                detokenize += time.perf_counter() - start
+                if not sent:
+                    text = text.lstrip()
+                if text:
+                    yield json.dumps({'type': 'token', 'text': text}) + '\n'
+                    sent = True
+            
+            _, stats = future.result()
+            observe_generation(stats, detokenize)
+            print(f'⚡ Streamed {stats["new_tokens"]} tokens ({stats["ms_per_token"]:.1f} ms/token, '
+                  f'queued {stats["queue_ms"]:.0f} ms, {stats["finish_reason"]})')
+            response = decoder.response()
+            if key and stats['finish_reason'] != 'deadline':
+                response_cache.put(key, response)
+            
+            yield json.dumps({
+                'type': 'done',
+                'success': True,
+                'response': format_live_data(response, live_data),
+                'liveData': live_data,
+                'sources': sources,
+                'cached': False,
+                'route': OPEN,
+                'forecast': None,
+                'finishReason': stats['finish_reason']
+            }) + '\n'
+        
+        except Exception as e:
+            print(f'❌ Error: {e}')
+            yield json.dumps({'type': 'error', 'error': str(e), 'success': False}) + '\n'
         
-        return jsonify({
+        finally:
+            # Client went away (GeneratorExit) or we finished: free the batch slot
+            if future is not None:
+                future.cancel()
+    
+    g.stream_pending = True
+    return Response(stream_with_context(events()), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def start_refresher(cache=None, share=None):
+    """Keep AQI and weather for every city in CITIES warm in the background
+
+    Refreshed values go to cache (default live_cache; anything with put()).
+    share is passed on to Refresher to refresh only part of the lookups.
+    """
+    global refresher
+    
+    from refresher import Refresher
+    
+    jobs = {}
+    for city in CITIES:
+        jobs[(city, 'aqi')] = lambda city=city: fetch_live_aqi(city)
+        jobs[(city, 'weather')] = lambda city=city: fetch_live_weather(city)
+    
+    refresher = Refresher(live_cache if cache is None else cache, jobs, LIVE_REFRESH_INTERVAL, share=share).start()
+    print(f'🔄 Refreshing {len(refresher.own)}/{len(jobs)} live data lookups every {LIVE_REFRESH_INTERVAL:g} s')
+
+
+def iso_time(epoch):
+    """ISO-8601 UTC timestamp for epoch seconds (None stays None)"""
+    return datetime.fromtimestamp(epoch, timezone.utc).isoformat(timespec='seconds') if epoch else None
+
+
+def snapshot_lookups(cities):
+    """{'city:kind': (kind, city)} lookups for city_snapshot()"""
+    return {f'{city}:{kind}': (kind, city) for city in cities for kind in ('aqi', 'weather')}
+
+
+def city_snapshot(cities):
+    """Current AQI and weather for several cities, fetched concurrently
+
+    Every lookup goes through the live data cache, so fresh entries are
+    answered without an upstream call. Returns {city: {...}} with each
+    city's readings, the lookup status and when the data was fetched.
+    """
+    tasks = {name: functools.partial(LOOKUPS[kind], city) for name, (kind, city) in snapshot_lookups(cities).items()}
+    results, sources = fetch_all(tasks, RETRIEVAL_DEADLINE)
+    
+    return build_snapshot(cities, results, sources)
+
+
+def build_snapshot(cities, results, sources):
+    """city_snapshot() result from the lookup results"""
+    snapshot = {}
+    for city in cities:
+        fetched = {kind: live_cache.fetched_at((city, kind)) for kind in ('aqi', 'weather')}
+        known = [t for t in fetched.values() if t]
+        place = GAZETTEER.get(city)
+        snapshot[city] = {
+            'name': place.name,
+            'state': place.state,
+            'lat': place.lat,
+            'lon': place.lon,
+            'aqi': results.get(f'{city}:aqi'),
+            'weather': results.get(f'{city}:weather'),
+            'sources': {kind: sources[f'{city}:{kind}'] for kind in ('aqi', 'weather')},
+            # Freshness of the oldest reading shown for this city
+            'updatedAt': iso_time(min(known)) if known else None,
+            'fetchedAt': {kind: iso_time(t) for kind, t in fetched.items()},
+        }
+    
+    return snapshot
+
+
+def snapshot_cities(args):
+    """(cities, nearest) for /snapshot query arguments; ValueError for bad ones"""
+    requested = [c.strip() for c in args.get('cities', '').split(',') if c.strip()]
+    unknown = [c for c in requested if c not in GAZETTEER]
+    
+    if unknown:
+        raise ValueError(f'Unknown cities: {", ".join(unknown)}')
+    
+    cities = [GAZETTEER.get(c).key for c in requested]
+    nearest = None
+    if 'lat' in args or 'lon' in args:
+        try:
+            lat, lon = float(args['lat']), float(args['lon'])
+        except (KeyError, ValueError):
+            raise ValueError('lat and lon must both be numbers')
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            raise ValueError('lat must be within -90..90 and lon within -180..180')
+        place, km = GAZETTEER.nearest(lat, lon)
+        if place is None:
+            raise ValueError('No known city near that location')
+        nearest = {'city': place.key, 'distanceKm': round(km, 1)}
+        cities.append(place.key)
+    
+    return list(dict.fromkeys(cities or CITIES)), nearest
+
+
+@app.route('/snapshot', methods=['GET'])
+def snapshot():
+    """Live AQI and weather for the featured cities, ?cities=delhi,pune or the city nearest ?lat=&lon="""
+    try:
+        try:
+            cities, nearest = snapshot_cities(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e), 'success': False}), 400
+        
+        result = {
             'success': True,
-            'response': response,
-            'liveData': live_data
-        })
+            'generatedAt': iso_time(time.time()),
+            'cities': city_snapshot(cities)
+        }
+        if nearest:
+            result['nearest'] = nearest
+        
+        return jsonify(result)
         
     except Exception as e:
         print(f'❌ Error: {e}')
         return jsonify({'error': str(e), 'success': False}), 500
 
 
+@app.before_request
+def track_request():
+    g.started_at = time.perf_counter()
+    g.endpoint = request.endpoint or 'unknown'
+    IN_FLIGHT.inc(endpoint=g.endpoint)
+
+
+@app.after_request
+def count_request(response):
+    REQUESTS.inc(endpoint=getattr(g, 'endpoint', 'unknown'), status=response.status_code)
+    return response
+
+
+@app.teardown_request
+def finish_request(exc):
+    # A streamed response is torn down twice: when the view returns and again
+    # after stream_with_context has sent the body. Only the second one counts
+    if g.pop('stream_pending', False):
+        return
+    started_at = g.pop('started_at', None)
+    if started_at is not None:
+        IN_FLIGHT.dec(endpoint=g.endpoint)
+        REQUEST_SECONDS.observe(time.perf_counter() - started_at, endpoint=g.endpoint)
+
+
+@metrics.collector
+def collect_cache_stats():
+    caches = {'live': live_cache, 'prefix': prefix_cache, 'response': response_cache}
+    for name, cache in caches.items():
+        if cache is None:
+            continue
+        stats = cache.stats()
+        CACHE_HITS.set(stats['hits'] + stats.get('coalesced', 0), cache=name)
+        CACHE_MISSES.set(stats['misses'], cache=name)
+        CACHE_HIT_RATIO.set(round(stats['hit_rate'], 4), cache=name)
+        CACHE_ENTRIES.set(stats.get('entries', stats.get('size', 0)), cache=name)
+
+
+@app.route('/metrics', methods=['GET'], endpoint='metrics')
+def metrics_endpoint():
+    """Prometheus metrics: per-stage latency histograms, token counts, cache hit rates"""
+    return Response(metrics.render(), content_type=CONTENT_TYPE)
+
+
+def health_report():
+    """Model, batching, cache, refresher, router and upstream state"""
+    return {
+        'status': 'healthy',
+        'model_loaded': model is not None,
+        'batching': dict(scheduler.totals) if scheduler is not None else None,
+        'speculative': {
+            'draft_model': DRAFT_MODEL_PATH,
+            'draft_tokens': SPECULATIVE_TOKENS,
+            'acceptance_rate': scheduler.acceptance_rate() if scheduler is not None else None,
+        } if DRAFT_MODEL_PATH else None,
+        'live_cache': live_cache.stats(),
+        'prefix_cache': prefix_cache.stats() if prefix_cache is not None else None,
+        'response_cache': response_cache.stats() if response_cache is not None else None,
+        'refresher': refresher.stats() if refresher is not None else None,
+        'router': router_log.stats(),
+        'upstream': http_client.stats(),
+    }
+
+
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
-    return jsonify({'status': 'healthy', 'model_loaded': model is not None})
+    return jsonify(health_report())
 
 
 if __name__ == '__main__':
+    if PRELOAD_MODEL:
+        # Warm up in the background so the port opens right away
+        threading.Thread(target=init_model, name='model-preload', daemon=True).start()
+    if LIVE_REFRESH_INTERVAL > 0 and OPENWEATHER_API_KEY:
+        start_refresher()
     print('🚀 Starting Flask server on http://localhost:5001')
-    app.run(host='0.0.0.0', port=5001, debug=False)
+    app.run(host='0.0.0.0', port=5001, debug=False, threaded=True)